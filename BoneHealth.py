@@ -1,49 +1,21 @@
+import time
+_rerun_started = time.perf_counter()
+
 import streamlit as st
+import streamlit.components.v1 as components
+from streamlit.errors import StreamlitAPIException
 import os
-from dotenv import load_dotenv
-import google.generativeai as genai
-from PIL import Image, ImageFile
-import sqlite3
-
-# Prevent truncated image error
-ImageFile.LOAD_TRUNCATED_IMAGES = True
-
-# Load environment variables
-load_dotenv()
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-
-# Function to get AI response
-def get_gemini_response(task_prompt, user_type, image=None, additional_input=""):
-    """Generates AI response using Google's Gemini model"""
-    model = genai.GenerativeModel('gemini-2.0-flash-thinking-exp-01-21')
-
-    # Expertise level prompt based on user type
-    expertise_prompt = f"Generate a response suitable for a {'common user' if user_type == 'Common User' else 'doctor'}"
-
-    input_data = [task_prompt, expertise_prompt, additional_input]
-
-    # Include image if provided
-    if image:
-        input_data.insert(1, image[0])
-
-    response = model.generate_content(input_data)
-    return response.text
-
-# Database setup
-conn = sqlite3.connect("users.db")
-cursor = conn.cursor()
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS users (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    username TEXT UNIQUE,
-    password TEXT,
-    user_type TEXT,
-    license_number TEXT,
-    specialization TEXT,
-    affiliation TEXT
-)
-""")
-conn.commit()
+import settings  # noqa: F401  (loads .env once per process)
+from db import authenticate, register
+from metrics import span, stage_seconds, start_exporters
+from session_memory import SessionVault, StoredImage, start_sweeper
+from shared_state import LOGIN_TTL, create_login_session, end_login_session, resume_login_session
+from stylesheet import stylesheet_tag
+
+# Prometheus endpoint / metrics file / structured logs, when configured
+start_exporters()
+# Parks idle sessions' chat state on disk
+start_sweeper()
 
 # Streamlit Page Config - Landscape and Wide Layout
 st.set_page_config(
@@ -52,458 +24,59 @@ st.set_page_config(
     layout="wide"
 )
 
-# --- UPDATED PREMIUM CSS STYLING WITH SIDEBAR ANIMATION & 3D EFFECTS ---
-st.markdown(
-    """
-    <style>
-    @import url('https://fonts.googleapis.com/css2?family=Roboto:wght@400;500;700&display=swap');
-
-    body {
-        background: linear-gradient(to bottom, #E6F7FF, #D0E8FA);
-        color: #333;
-        font-family: 'Roboto', sans-serif;
-        overflow-x: hidden;
-    }
-
-    .stApp {
-        max-width: 100vw;
-        min-height: 100vh;
-        margin: 0;
-        padding: 35px 40px;
-        display: flex;
-        flex-direction: column;
-        align-items: stretch;
-        background: transparent;
-    }
-
-    .highlight-box {
-        background: rgba(255, 255, 255, 0.85);
-        backdrop-filter: blur(5px);
-        padding: 30px;
-        border-radius: 15px;
-        margin-bottom: 30px;
-        box-shadow: 12px 12px 25px rgba(0,0,0,0.1), -8px -8px 15px rgba(255,255,255,0.6);
-        animation: fadeIn 1.5s ease-out forwards;
-        opacity: 0;
-    }
-    @keyframes fadeIn {
-        to { opacity: 1; }
-    }
-
-    .highlight-box:hover {
-        box-shadow: 15px 15px 30px rgba(0,0,0,0.12), -10px -10px 18px rgba(255,255,255,0.7);
-        transform: scale(1.005);
-    }
-
-    .highlight-box h1 {
-        color: #0B5394;
-        font-size: 3.6em;
-        margin-bottom: 12px;
-        text-shadow: 2px 2px 5px rgba(0, 0, 0, 0.15), 0 0 10px rgba(255, 255, 255, 0.4);
-        font-weight: 700;
-        letter-spacing: -1.8px;
-        animation: pulseTitle 3s infinite alternate, fadeInTitle 1.5s ease-out forwards 0.5s;
-        opacity: 0;
-        transition: text-shadow 0.3s ease;
-    }
-
-    @keyframes fadeInTitle {
-        to { opacity: 1; }
-    }
-
-    @keyframes pulseTitle {
-        0% { text-shadow: 2px 2px 5px rgba(0, 0, 0, 0.15), 0 0 10px rgba(255, 255, 255, 0.4); transform: scale(1); }
-        100% { text-shadow: 3px 3px 7px rgba(0, 0, 0, 0.2), 0 0 14px rgba(255, 255, 255, 0.6); transform: scale(1.02); }
-    }
-
-    .highlight-box h4 {
-        color: #555;
-        font-size: 1.2em;
-        margin-bottom: 20px;
-        text-shadow: 0.5px 0.5px 1px rgba(255, 255, 255, 0.5);
-        font-style: normal;
-        font-weight: 400;
-        opacity: 0.9;
-        line-height: 1.6;
-    }
-
-    .task-option-box {
-        background: rgba(255, 255, 255, 0.9);
-        backdrop-filter: blur(5px);
-        padding: 25px;
-        border-radius: 20px;
-        margin-bottom: 30px;
-        box-shadow:
-            15px 15px 25px rgba(0,0,0,0.08),
-            -10px -10px 18px rgba(255,255,255,0.7);
-        transition: box-shadow 0.3s ease, transform 0.3s ease;
-        animation: fadeInUp 1s ease-out forwards 0.8s;
-        transform: translateY(20px);
-        opacity: 0;
-        border: 1px solid #AED6F1;
-    }
-
-    @keyframes fadeInUp {
-        to { transform: translateY(0); opacity: 1; }
-    }
-
-    .task-option-box:hover {
-        box-shadow:
-            18px 18px 30px rgba(0,0,0,0.1),
-            -12px -12px 20px rgba(255,255,255,0.8);
-        transform: scale(1.01);
-    }
-
-    .task-option-box h2 {
-        color: #0B5394;
-        font-size: 2.1em;
-        margin-bottom: 15px;
-        text-shadow: 1px 1px 3px rgba(255, 255, 255, 0.7);
-        font-weight: 600;
-        opacity: 1;
-        letter-spacing: -1px;
-        animation: fadeInText 1s ease-out forwards 1.2s;
-        opacity: 0;
-    }
-    @keyframes fadeInText {
-        to { opacity: 1; }
-    }
-
-    .task-option-box p {
-        color: #666;
-        font-size: 1.1em;
-        margin-bottom: 15px;
-        text-shadow: 0.4px 0.4px 0.8px rgba(255, 255, 255, 0.6);
-        transform: translateY(0);
-        opacity: 0.85;
-        animation: fadeInParagraph 1s ease-out forwards 1.5s;
-        opacity: 0;
-        line-height: 1.5;
-    }
-    @keyframes fadeInParagraph {
-        to { opacity: 0.85; }
-    }
-
-    /* Animated Sidebar */
-    .stSidebar {
-        background: rgba(255, 255, 255, 0.9);
-        backdrop-filter: blur(8px);
-        padding: 30px 25px;
-        border-radius: 15px;
-        border: none;
-        box-shadow: 12px 12px 25px rgba(0,0,0,0.1), -8px -8px 15px rgba(255,255,255,0.6);
-        position: fixed; /* Fixed position for animation */
-        left: 0;
-        top: 0;
-        height: 100%;
-        width: 280px; /* Adjust sidebar width as needed */
-        transform: translateX(-280px); /* Initially hidden */
-        transition: transform 0.5s ease-in-out, opacity 0.5s ease-in-out; /* Smooth animation */
-        opacity: 0.95;
-        z-index: 1000; /* Ensure sidebar is on top */
-    }
-
-    .stSidebar.expanded {
-        transform: translateX(0); /* Slide in when expanded class is added */
-    }
-
-    .stSidebar:hover {
-        box-shadow: 15px 15px 30px rgba(0,0,0,0.12), -10px -10px 18px rgba(255,255,255,0.75);
-    }
-
-    .stSidebar h2 {
-        color: #0B5394;
-        font-size: 1.8em;
-        margin-bottom: 12px;
-        text-shadow: 1px 1px 2px rgba(255, 255, 255, 0.6);
-        font-weight: 600;
-        opacity: 1;
-    }
-
-    .stSidebar .stButton > button, .stButton > button.st-ef {
-        background: linear-gradient(to bottom, #0C69C6, #085394);
-        color: white;
-        border: none;
-        border-radius: 10px;
-        padding: 12px 24px;
-        font-weight: 500;
-        width: auto;
-        min-width: 110px;
-        box-shadow: 5px 5px 12px rgba(0,0,0,0.15), -4px -4px 8px rgba(255,255,255,0.5);
-        animation: none;
-        transition: transform 0.2s ease-in-out, box-shadow 0.2s ease-in-out;
-    }
-
-    .stSidebar .stButton > button:hover, .stButton > button.st-ef:hover {
-        transform: translateY(-3px);
-        box-shadow: 6px 6px 15px rgba(0,0,0,0.18), -5px -5px 10px rgba(255,255,255,0.6);
-    }
-    .stSidebar .stButton > button:active, .stButton > button.st-ef:active {
-        transform: translateY(0);
-        box-shadow: 3px 3px 7px rgba(0,0,0,0.2) inset, -2px -2px 4px rgba(255,255,255,0.5) inset;
-    }
-
-    .stTextInput > div > div > input, .stChatInputContainer > div > div > textarea {
-        border-radius: 10px;
-        border: 1px solid #AED6F1;
-        padding: 12px;
-        font-size: 1.05rem;
-        box-shadow: inset 3px 3px 6px rgba(0,0,0,0.05), inset -2px -2px 4px rgba(255,255,255,0.4);
-        opacity: 0.95;
-        transform: translateY(0);
-        transition: border-color 0.3s ease, box-shadow 0.3s ease;
-    }
-
-    .stTextInput > div > div > input:focus, .stChatInputContainer > div > div > textarea:focus {
-        border-color: #0C69C6;
-        box-shadow: inset 4px 4px 8px rgba(0,0,0,0.07), inset -3px -3px 5px rgba(255,255,255,0.5), 0 0 0 0.2rem rgba(11, 105, 198, .2);
-        outline: none;
-    }
-
-    .stRadio > div {
-        gap: 2rem;
-        display: flex;
-        flex-direction: column;
-        opacity: 1;
-    }
-
-    .stRadio > div > label {
-        display: flex;
-        align-items: center;
-        margin-bottom: 12px;
-        cursor: pointer;
-        background-color: rgba(255, 255, 255, 0.95);
-        padding: 10px 18px;
-        border-radius: 20px;
-        box-shadow: 3px 3px 6px rgba(0,0,0,0.04), -2px -2px 4px rgba(255,255,255,0.3);
-        transition: transform 0.2s ease-in-out, box-shadow 0.2s ease-in-out, background-color 0.2s ease-in-out;
-    }
-    .stRadio > div > label:hover {
-        transform: scale(1.01);
-        box-shadow: 4px 4px 8px rgba(0,0,0,0.06), -3px -3px 5px rgba(255,255,255,0.35);
-        background-color: rgba(255, 255, 255, 1);
-    }
-
-    .stRadio > div > label > div:first-child input[type="radio"] {
-        appearance: none;
-        -webkit-appearance: none;
-        -moz-appearance: none;
-        width: 22px;
-        height: 22px;
-        border: 2px solid #0C69C6;
-        border-radius: 50%;
-        background: linear-gradient(160deg, #ffffff, #f0f0f0);
-        margin-right: 12px;
-        position: relative;
-        cursor: pointer;
-        display: inline-block;
-    }
-    .stRadio > div > label > div:first-child input[type="radio"]:hover {
-        border-color: #085394;
-        box-shadow: 2px 2px 5px rgba(0,0,0,0.1), -2px -2px 3px rgba(255,255,255,0.35);
-        transform: scale(1.03);
-    }
-
-    .stRadio > div > label > div:first-child input[type="radio"]:checked {
-        background-color: #0C69C6 !important;
-        border-color: #0C69C6 !important;
-        box-shadow: inset 2px 2px 4px rgba(0,0,0,0.08) !important, inset -1px -1px 2px rgba(255,255,255,0.3) !important;
-    }
-    .stRadio > div > label > div:first-child input[type="radio"]:checked + span::before {
-        content: '';
-        display: block;
-        position: absolute;
-        top: 50%;
-        left: 50%;
-        transform: translate(-50%, -50%);
-        width: 12px;
-        height: 12px;
-        background-color: white !important;
-        border-radius: 50%;
-    }
-
-    .stRadio > div > label > span {
-        font-size: 1.15rem;
-        color: #444;
-        font-weight: 500;
-        position: relative;
-        text-shadow: 0.5px 0.5px 1px rgba(255, 255, 255, 0.5);
-    }
-    .stRadio > div > label > span:hover {
-         text-shadow: 1px 1px 2px rgba(255, 255, 255, 0.6);
-    }
-
-    .stChatMessage {
-        border-radius: 15px;
-        padding: 12px 20px;
-        margin-bottom: 12px;
-        box-shadow: 2px 2px 5px rgba(0,0,0,0.03), -1px -1px 3px rgba(255,255,255,0.2);
-        transform: translateY(0);
-        opacity: 0.98;
-        transition: transform 0.2s ease-in-out, box-shadow 0.2s ease-in-out;
-    }
-
-    .stChatMessage:hover {
-        transform: scale(1.002);
-        box-shadow: 3px 3px 6px rgba(0,0,0,0.05), -2px -2px 4px rgba(255,255,255,0.3);
-    }
-
-    .stChatMessage.user {
-        background: rgba(228, 243, 255, 0.8);
-        border: none;
-        color: #444;
-        box-shadow: 1px 1px 3px rgba(0,0,0,0.02), -1px -1px 2px rgba(255,255,255,0.15);
-    }
-    .stChatMessage.assistant {
-        background: rgba(245, 250, 255, 0.8);
-        border: none;
-        color: #444;
-        box-shadow: 1px 1px 3px rgba(0,0,0,0.02), -1px -1px 2px rgba(255,255,255,0.15);
-    }
-
-    hr {
-        border: none;
-        height: 2px;
-        background: linear-gradient(to right, #AED6F1, #D0E8FA, #AED6F1);
-        margin-bottom: 35px;
-        box-shadow: 1px 1px 2px rgba(0,0,0,0.03), -1px -1px 2px rgba(255,255,255,0.2);
-        transform: scaleX(1);
-        animation: growHorizontal 1s ease-out forwards 1.8s;
-        transform-origin: left center;
-        transform: scaleX(0);
-    }
-    @keyframes growHorizontal {
-        to { transform: scaleX(1); }
-    }
-
-    div.stButton > button:first-child {
-        background: linear-gradient(to bottom, #000080, #000060) !important;
-        color: white !important;
-        box-shadow: 5px 5px 12px rgba(0,0,0,0.2), -4px -4px 8px rgba(255,255,255,0.3) !important;
-        border-color: transparent !important;
-        animation: fadeInButton 1s ease-out forwards 2.1s;
-        opacity: 0;
-        border-radius: 12px !important;
-        padding: 12px 24px !important;
-        font-weight: 500 !important;
-        transition: transform 0.2s ease-in-out, box-shadow 0.2s ease-in-out;
-    }
-    @keyframes fadeInButton {
-        to { opacity: 1; }
-    }
-
-    div.stButton > button:first-child:hover {
-        box-shadow: 6px 6px 15px rgba(0,0,0,0.25), -5px -5px 10px rgba(255,255,255,0.4) !important;
-        transform: translateY(-2px);
-    }
-    div.stButton > button:first-child:active {
-        box-shadow: 3px 3px 7px rgba(0,0,0,0.25) inset, -2px -2px 4px rgba(255,255,255,0.3) inset !important;
-        transform: translateY(0);
-    }
-
-    .stImage > div > div > img {
-        border: 10px solid #f8f8f8;
-        border-radius: 15px;
-        box-shadow: 8px 8px 15px rgba(0,0,0,0.1), -5px -5px 10px rgba(255,255,255,0.4);
-        animation: zoomInImage 1s ease-out forwards 2.4s;
-        transform: scale(0.8);
-        opacity: 0;
-    }
-    @keyframes zoomInImage {
-        to { transform: scale(1); opacity: 1; }
-    }
-
-    .stApp h3 {
-        color: #0B5394;
-        font-size: 2.3em;
-        margin-bottom: 20px;
-        text-shadow: 1.5px 1.5px 3px rgba(255, 255, 255, 0.6);
-        font-weight: 600;
-        letter-spacing: -1.2px;
-        opacity: 1;
-        animation: fadeInSectionTitle 1s ease-out forwards 2.7s;
-        opacity: 0;
-    }
-    @keyframes fadeInSectionTitle {
-        to { opacity: 1; }
-    }
-
-    .stApp h3 i {
-        margin-right: 8px;
-        font-size: 1.1em;
-        vertical-align: middle;
-        color: #0B5394;
-        opacity: 0.9;
-    }
-
-    .stApp p[style*="color: #4D5656;"] {
-        color: #666 !important;
-        line-height: 1.6;
-        animation: fadeInParagraphs 1s ease-out forwards 3s;
-        opacity: 0;
-    }
-     @keyframes fadeInParagraphs {
-        to { opacity: 0.85; }
-    }
-
-    .task-option-box .stRadio > div > label > span {
-        font-size: 1.2rem;
-        color: #444;
-        font-weight: 500;
-        text-shadow: 0.5px 0.5px 1px rgba(255, 255, 255, 0.5);
-    }
-    .task-option-box .stRadio > div > label {
-        background-color: rgba(255, 255, 255, 0.98);
-        padding: 12px 20px;
-        margin-bottom: 15px;
-        border-radius: 22px;
-        box-shadow: 3px 3px 6px rgba(0,0,0,0.05), -2px -2px 4px rgba(255,255,255,0.3);
-    }
-    .task-option-box .stRadio > div > label:hover {
-         box-shadow: 4px 4px 8px rgba(0,0,0,0.07), -3px -3px 5px rgba(255,255,255,0.35);
-         background-color: rgba(255, 255, 255, 1);
-    }
-
-    .stChatContainer {
-        padding-top: 20px;
-    }
-
-    /* Hamburger Menu Button for Sidebar Toggle */
-    .sidebar-toggle-button {
-        position: fixed; /* Fixed button position */
-        top: 15px;
-        left: 15px;
-        background-color: rgba(255, 255, 255, 0.8);
-        backdrop-filter: blur(5px);
-        border: none;
-        border-radius: 8px;
-        padding: 8px 12px;
-        cursor: pointer;
-        z-index: 1001; /* Above sidebar */
-        box-shadow: 3px 3px 6px rgba(0,0,0,0.08), -2px -2px 4px rgba(255,255,255,0.3);
-        transition: background-color 0.3s ease, box-shadow 0.3s ease;
-    }
-    .sidebar-toggle-button:hover {
-        background-color: rgba(255, 255, 255, 0.95);
-        box-shadow: 4px 4px 8px rgba(0,0,0,0.1), -3px -3px 5px rgba(255,255,255,0.4);
-    }
-    .sidebar-toggle-button:active {
-        box-shadow: inset 2px 2px 4px rgba(0,0,0,0.1), inset -1px -1px 2px rgba(255,255,255,0.3);
-    }
-    .sidebar-toggle-button i {
-        font-size: 1.4em;
-        color: #0B5394;
-    }
-
-
-    </style>
-    """,
-    unsafe_allow_html=True,
-)
+def chat_state():
+    """This session's chat log and analysis context; parked on disk while the session is idle"""
+    if "chat_state" not in st.session_state:
+        st.session_state.chat_state = SessionVault(derived=("conversation",))
+    st.session_state.chat_state.touch()
+    return st.session_state.chat_state
+
+LOGIN_COOKIE = "bonehealth_login"
+
+def set_login_cookie(token, max_age=LOGIN_TTL):
+    """Stores the login token in a browser cookie; max_age=0 removes it"""
+    components.html(
+        f"""<script>
+        parent.document.cookie = "{LOGIN_COOKIE}={token}; Max-Age={int(max_age)}; Path=/; SameSite=Strict"
+            + (parent.location.protocol === "https:" ? "; Secure" : "");
+        </script>""",
+        height=0,
+    )
 
-# Premium Header Section with Highlight Box
+# Tokens from older releases travelled in the URL, where they leak through history and shared links
+if "session" in st.query_params:
+    end_login_session(st.query_params["session"])
+    del st.query_params["session"]
+
+# A reconnect can land on another app process; the login cookie picks the session up there.
+# The cookies seen at connect time don't change during a session, so they are checked once.
+if not st.session_state.get("logged_in") and "login_cookie_checked" not in st.session_state:
+    st.session_state["login_cookie_checked"] = True
+    login_cookie = st.context.cookies.get(LOGIN_COOKIE)
+    if isinstance(login_cookie, str) and login_cookie:
+        login = resume_login_session(login_cookie)
+        if login is None:
+            set_login_cookie("", max_age=0)
+        else:
+            st.session_state["logged_in"] = True
+            st.session_state["user_type"] = login["user_type"]
+            st.session_state["username"] = login["username"]
+            st.session_state["login_token"] = login["token"]
+            set_login_cookie(login["token"])
+
+# Sidebar State Management
+if "sidebar_expanded" not in st.session_state:
+    st.session_state.sidebar_expanded = False
+
+def toggle_sidebar():
+    st.session_state.sidebar_expanded = not st.session_state.sidebar_expanded
+
+# Stylesheet, sidebar position and premium header go out as a single element per rerun
+sidebar_offset = "0" if st.session_state.sidebar_expanded else "-280px"  # slide in / slide out
 st.markdown(
-    """
+    stylesheet_tag(st.get_option("server.enableStaticServing"))
+    + f"<style>.stSidebar {{ transform: translateX({sidebar_offset}); }}</style>"
+    + """
     <div class="highlight-box">
         <div style="text-align: center; margin-bottom: 15px;">
             <h1 style="color: #0B5394; font-size: 3.2em; margin-bottom: 10px; text-shadow: 1px 1px 2px rgba(0, 0, 0, 0.1); transition: text-shadow 0.3s ease;">
@@ -519,33 +92,19 @@ st.markdown(
     unsafe_allow_html=True
 )
 
-# Authentication Functions (No change in logic except for register function)
-def authenticate(username, password):
-    cursor.execute("SELECT user_type FROM users WHERE username=? AND password=?", (username, password))
-    user = cursor.fetchone()
-    return user[0] if user else None
-
-def register(username, password, user_type, license_number=None, specialization=None, affiliation=None): # Added specialization and affiliation
-    try:
-        cursor.execute("INSERT INTO users (username, password, user_type, license_number, specialization, affiliation) VALUES (?, ?, ?, ?, ?, ?)", # Added specialization and affiliation
-                       (username, password, user_type, license_number, specialization, affiliation)) # Added specialization and affiliation
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False
-
-# Sidebar State Management
-if "sidebar_expanded" not in st.session_state:
-    st.session_state.sidebar_expanded = False
-
-def toggle_sidebar():
-    st.session_state.sidebar_expanded = not st.session_state.sidebar_expanded
-
 # Hamburger Menu Button (Outside Sidebar)
 st.button("☰ Menu", on_click=toggle_sidebar, key="sidebar_toggle_button", type="primary", use_container_width=False) # Changed to st.button instead of markdown for button functionality
 # Premium Sidebar for Login/Signup
 with st.sidebar:
     st.markdown(f"## 🔑 **Account Access**", unsafe_allow_html=True) # Title with Key Emoji
+    if st.session_state.get("logged_in"):
+        st.markdown(f"Signed in as **{st.session_state['username']}**")
+        if st.button("🚪 Logout"):
+            end_login_session(st.session_state.pop("login_token", ""))
+            set_login_cookie("", max_age=0)
+            chat_state().clear()
+            for key in ("logged_in", "username", "user_type", "analysis_id", "stored_images", "selected_task"):
+                st.session_state.pop(key, None)
     auth_option = st.radio("**Choose an option:**", ["Login", "Signup"])
 
     if auth_option == "Signup":
@@ -582,54 +141,67 @@ with st.sidebar:
             if user_role:
                 # Account switch handling
                 if "username" in st.session_state and st.session_state["username"] != username:
-                    st.session_state.pop('message_log', None)
-                    st.session_state.pop('analysis_context', None)
-                    st.session_state.pop('uploaded_image', None)
+                    chat_state().clear()
+                    st.session_state.pop('analysis_id', None)
+                    st.session_state.pop('stored_images', None)
                     st.session_state.pop('selected_task', None)
 
                 st.session_state["logged_in"] = True
                 st.session_state["user_type"] = user_role
                 st.session_state["username"] = username
-                if "message_log" not in st.session_state:
-                    st.session_state.message_log = [{"role": "ai", "content": "👋 Welcome to Bone Health AI Suite! How can I help you today?"}]
+                if "login_token" in st.session_state:
+                    end_login_session(st.session_state["login_token"])
+                st.session_state["login_token"] = create_login_session(username, user_role)
+                set_login_cookie(st.session_state["login_token"])
+                if "message_log" not in chat_state():
+                    chat_state()["message_log"] = [{"role": "ai", "content": "👋 Welcome to Bone Health AI Suite! How can I help you today?"}]
                 st.success(f"✅ Logged in as **{user_role}**")
             else:
                 st.error("❌ Invalid credentials!")
 
-# Apply sidebar expanded class based on state
-if st.session_state.sidebar_expanded:
-    st.markdown(
-        """
-        <style>
-            .stSidebar {
-                transform: translateX(0); /* Slide in */
-            }
-        </style>
-        """,
-        unsafe_allow_html=True,
-    )
-else:
-    st.markdown(
-        """
-        <style>
-            .stSidebar {
-                transform: translateX(-280px); /* Slide out */
-            }
-        </style>
-        """,
-        unsafe_allow_html=True,
-    )
-
-
 # Initialize message_log if not present
-if "message_log" not in st.session_state:
-    st.session_state.message_log = [{"role": "ai", "content": "👋 Welcome to Bone Health AI Suite! Please log in to start."}]
+if "message_log" not in chat_state():
+    chat_state()["message_log"] = [{"role": "ai", "content": "👋 Welcome to Bone Health AI Suite! Please log in to start."}]
 
 # Check login status
 if "logged_in" not in st.session_state or not st.session_state["logged_in"]:
     st.warning("⚠️ Please log in to access the AI analysis tool.")
+    stage_seconds.observe(time.perf_counter() - _rerun_started, stage="script_run", page="login")
     st.stop()
 
+# Model, imaging and chat modules load here, after the login gate, so the login page never pays for them
+from analysis import get_chat_response, stream_chat_response
+from conversation import ConversationContext
+from intent_router import intent_router, analysis_fingerprint
+from history import PAGE_SIZE, save_message, load_messages, list_analyses, get_analysis
+from image_prep import make_preview, format_bytes
+from series import is_series
+from prompts import expertise_prompt_for
+from jobs import ACTIVE_STATUSES, submit_analysis, cancel, get_job, undelivered_jobs, mark_delivered
+from model_files import attachments_for, file_handles, prefetch
+from usage_ledger import QuotaExceeded, usage_ledger
+
+STREAMING_ENABLED = os.getenv("BONEHEALTH_STREAMING", "1").lower() not in ("0", "false", "no")
+
+def generate_followup_response(contents, user_type, task=None):
+    """Returns follow-up reply chunks, streamed when streaming is enabled"""
+    username = st.session_state["username"]
+    if STREAMING_ENABLED:
+        return stream_chat_response(contents, user_type, task, username)
+    with st.spinner("🧠 AI is thinking... Please wait"):
+        return [get_chat_response(contents, user_type, task, username)]
+
+def render_ai_stream(chunks):
+    """Renders response chunks into an assistant chat bubble and returns the full text"""
+    with st.chat_message("assistant"):
+        placeholder = st.empty()
+        placeholder.markdown("**AI Assistant:** 🧠 _Thinking..._")
+        text = ""
+        for chunk in chunks:
+            text += chunk
+            placeholder.markdown(f"**AI Assistant:** {text} 🤖")
+    return text
+
 # Task Selection with 3D Box
 st.markdown('<div class="task-option-box">', unsafe_allow_html=True) # Apply task-option-box class
 st.markdown(f"<h3><i class='fas fa-tasks'></i> 🦴 <b>Select Analysis Task</b></h3>", unsafe_allow_html=True) # Enhanced Section Title
@@ -653,144 +225,241 @@ st.markdown('</div>', unsafe_allow_html=True) # Close task-option-box
 
 task = task_radio # Use the assigned variable for task value
 
-# Task Prompts (No change in content)
-task_prompts = {
-    "Bone Fracture Detection": (
-        "Analyze the X-ray, MRI, or CT scan image for fractures and classify into different fracture types with detailed severity assessment. "
-        "For common users: The image will be analyzed to check for fractures, identifying the affected bone and the type of break. "
-        "You will receive an easy-to-understand explanation of the fracture, including its severity and possible effects on movement, provide nutrition plan,steps to recover like remedies and exercises if required. "
-        "For doctors: Suggest medical treatment options, possible surgeries, immobilization techniques, and follow-up care strategies,provide nutrition plan,steps to recover like remedies and exercises if required. "
-    ),
-
-    "Bone Marrow Cell Classification": (
-        "Analyze the biopsy or MRI image and classify bone marrow cells into relevant categories, identifying concerning cells. "
-        "For common users: The image will be analyzed to check for abnormalities in bone marrow cells. "
-        "You will receive a simple explanation of the findings, including whether there are unusual cell changes and what they might indicate,provide nutrition plan,steps to recover like remedies and exercises if required. "
-        "For doctors: Provide detailed insights into abnormal cell structures, possible diagnoses, and recommended medical interventions,provide nutrition plan,steps to recover like remedies and exercises if required. "
-    ),
-
-    "Knee Joint Osteoarthritis Detection": (
-        "Analyze the knee X-ray or MRI and classify osteoarthritis severity based on clinical grading. "
-        "For common users: The image will be assessed for signs of knee osteoarthritis, including joint space narrowing and bone changes. "
-        "You will get an easy-to-understand report on whether osteoarthritis is present and its severity level, along with its impact on knee function,provide nutrition plan,steps to recover like remedies and exercises if required. "
-        "For doctors: Suggest advanced treatments, medications, physiotherapy plans, and surgical options such as knee replacement,provide nutrition plan,steps to recover like remedies and exercises if required."
-
-    ),
-
-    "Osteoporosis Stage Prediction & BMD Score": (
-        "Analyze the bone X-ray and determine osteoporosis stage with estimated Bone Mineral Density (BMD) score. "
-        "For common users: The scan will be analyzed to determine how strong or weak the bones are and whether osteoporosis is present. "
-        "You will receive a simple explanation of the results, including whether bone density is lower than normal and what it means for bone health,provide nutrition plan,steps to recover like remedies and exercises if required. "
-        "For doctors: Recommend specific medications, hormone therapy, and advanced treatments to manage and prevent complications,provide nutrition plan,steps to recover like remedies and exercises if required."
-    ),
-
-    "Bone Age Detection": (
-        "Analyze the X-ray of a child's hand and predict bone age with insights into growth patterns. "
-        "For common users: The scan will be assessed to check how well the bones are developing compared to the expected growth pattern for the child’s age. "
-        "You will receive an easy-to-understand result explaining whether the bone growth is normal, advanced, or delayed,provide nutrition plan,steps to recover like remedies and exercises if required. "
-        "For doctors: Offer insights into growth abnormalities, hormonal imbalances, and necessary medical interventions if delayed growth is detected,provide nutrition plan,steps to recover like remedies and exercises if required."
-    ),
-
-    "Cervical Spine Fracture Detection": (
-        "Analyze the X-ray, MRI, or CT scan of the cervical spine for fractures and provide a severity assessment. "
-        "For common users: The scan will be analyzed for fractures in the neck bones, and you will receive an explanation of the findings. "
-        "The report will describe whether a fracture is present, its severity, and how it may affect movement or pain levels,provide nutrition plan,steps to recover like remedies and exercises if required."
-        "For doctors: Suggest medical treatment plans, possible surgical options, and rehabilitation strategies for full recovery,provide nutrition plan,steps to recover like remedies and exercises if required"
-    ),
-
-    "Bone Tumor/Cancer Detection": (
-        "Analyze the X-ray, MRI, CT scan, or biopsy image for possible bone tumors or cancerous growths. "
-        "For common users: The image will be checked for any unusual growths or masses in the bone, and you will receive a simple explanation of the findings. "
-        "If any suspicious areas are detected, the report will describe their size, location, and whether they appear concerning,provide nutrition plan,steps to recover like remedies and exercises if required."
-        "For doctors: Provide detailed insights into tumor classification, possible malignancy assessment, and treatment options,provide nutrition plan,steps to recover like remedies and exercises if required. "
-    ),
-
-    "Bone Infection (Osteomyelitis) Detection": (
-        "Analyze the X-ray, MRI, CT scan, or biopsy image for signs of bone infection (osteomyelitis). "
-        "For common users: The image will be checked for any signs of infection in the bone, such as swelling, bone damage, or abscess formation. "
-        "You will receive an easy-to-understand explanation of whether an infection is present and how it may be affecting the bone,provide nutrition plan,steps to recover like remedies and exercises if required."
-        "For doctors: Provide insights on infection severity, possible antibiotic treatments, and surgical recommendations if needed,provide nutrition plan,steps to recover like remedies and exercises if required."
-    )
-}
-# Store the task prompt
-task_prompt = task_prompts.get(task, "Perform the selected medical imaging analysis.")
-
-# Clear previous responses and uploaded image when switching tasks
+# Clear previous responses and uploaded image when switching tasks; restore the latest page of saved chat
 if "selected_task" not in st.session_state or st.session_state.selected_task != task:
     st.session_state.selected_task = task
-    st.session_state.message_log = [{"role": "ai", "content": f"📢 Analyzing **{task}**. Upload an image and ask questions. 🚀"}]
-    st.session_state.pop("uploaded_image", None)
-
-# Image uploader
-st.markdown(f"<h3><i class='fas fa-upload'></i> 📤 <b>Upload Medical Image</b></h3>", unsafe_allow_html=True) # Enhanced Section Title
-st.markdown("<p style='color: #4D5656;'>Supported formats: JPG, JPEG, PNG</p>", unsafe_allow_html=True)
-uploaded_file = st.file_uploader(
-    "",
-    type=["jpg", "jpeg", "png"],
-    label_visibility="collapsed"
-)
-if uploaded_file:
-    st.session_state.uploaded_image = uploaded_file
-    image = Image.open(uploaded_file)
-    st.image(image, caption="Uploaded Image Preview 🖼️", width=350, use_container_width=False)
-
-# Analyze button
-if st.button("🔍 **Analyze Image**", type="primary"):
-    if uploaded_file:
-        with st.spinner("🧠 AI is analyzing your image... Please wait"):
-            image_data = [{"mime_type": uploaded_file.type, "data": uploaded_file.getvalue()}]
-            ai_analysis = get_gemini_response(task_prompt, st.session_state["user_type"], image_data)
-
-            st.session_state["analysis_context"] = ai_analysis
-            st.session_state.message_log.append({"role": "ai", "content": ai_analysis})
-            st.success("✅ Analysis Complete! Scroll down to see results. ✨")
+    chat_state()["message_log"] = load_messages(st.session_state["username"], task) or [
+        {"role": "ai", "content": f"📢 Analyzing **{task}**. Upload an image and ask questions. 🚀"}
+    ]
+    st.session_state.pop("history_exhausted", None)
+    st.session_state.pop("stored_images", None)
+    # Analyses for the previous task are no longer wanted; pick up any undelivered ones for this task
+    for job_id in st.session_state.get("active_jobs", []):
+        cancel(job_id)
+    st.session_state.active_jobs = undelivered_jobs(st.session_state["username"], task)
+    st.session_state.study_jobs = set()
+    chat_state()["study_results"] = []
+    chat_state()["analysis_images"] = []
+
+def log_message(role, content):
+    """Appends a chat turn to the visible page and persists it"""
+    message_id = save_message(st.session_state["username"], st.session_state.selected_task, role, content,
+                              st.session_state.get("analysis_id"))
+    chat_state()["message_log"].append({"id": message_id, "role": role, "content": content})
+    # Only the latest page stays in memory; older turns are reloaded from the database on demand
+    if len(chat_state()["message_log"]) > PAGE_SIZE:
+        del chat_state()["message_log"][:-PAGE_SIZE]
+        st.session_state.pop("history_exhausted", None)
+
+def deliver_job(job):
+    """Moves a finished job's result into the chat log and analysis context"""
+    name = job["image_name"] or "image"
+    in_study = job["id"] in st.session_state.study_jobs
+    if job["status"] == "done":
+        content = f"🖼️ **{name}**\n\n{job['result']}" if in_study else job["result"]
+        st.session_state.analysis_id = job["analysis_id"]
+        # Follow-ups attach the processed images the model saw; upload them while the user reads
+        stored = get_analysis(job["analysis_id"], st.session_state["username"])
+        image_parts = stored["image_parts"] if stored else []
+        prefetch(image_parts)
+        if in_study:
+            # A study's follow-up context covers every view analyzed so far
+            chat_state()["study_results"].append(content)
+            chat_state()["analysis_context"] = "\n\n".join(chat_state()["study_results"])
+            chat_state()["analysis_images"] = chat_state().get("analysis_images", []) + image_parts
+        else:
+            chat_state()["analysis_context"] = job["result"]
+            chat_state()["analysis_images"] = image_parts
     else:
-        st.warning("⚠️ Please upload an image before analyzing. 📤")
-
-# Chat Container
-st.markdown("---")
-st.markdown("## 💬 **Analysis & Chat**", unsafe_allow_html=True)
-chat_container = st.container()
-with chat_container:
-    for message in st.session_state.message_log:
-        if message["role"] == "ai":
+        content = f"⚠️ Analysis of **{name}** {job['status']}: {job['error'] or 'no result'}"
+    log_message("ai", content)
+    mark_delivered(job["id"])
+
+@st.fragment(run_every=1.0)
+def active_jobs_panel():
+    """Polls this session's background analyses without rerunning the whole page"""
+    delivered = False
+    for job_id in list(st.session_state.active_jobs):
+        job = get_job(job_id)
+        if job is None:
+            st.session_state.active_jobs.remove(job_id)
+        elif job["status"] in ACTIVE_STATUSES:
             with st.chat_message("assistant"):
-                st.markdown(f"**AI Assistant:** {message['content']} 🤖")
+                if job["upload_stats"]:
+                    stats = job["upload_stats"]
+                    st.caption(f"📉 {job['image_name']}: {format_bytes(stats['original_bytes'])} → {format_bytes(stats['processed_bytes'])}")
+                if job["partial"]:
+                    st.markdown(f"**AI Assistant:** {job['partial']} 🤖")
+                else:
+                    st.markdown(f"**AI Assistant:** 🧠 _Analyzing {job['image_name'] or 'your image'}... ({job['status']})_")
         else:
-            with st.chat_message("user"):
-                st.markdown(f"**You:** {message['content']} 🧑‍⚕️")
-
-# Chat input
-irrelevant_keywords = ["pm", "president", "capital", "weather", "politics", "sports"]
-greeting_keywords = ["hi", "hello", "hey", "good morning", "good afternoon", "good evening"]
-appreciation_keywords = ["thank you", "thanks", "great work", "well done", "appreciate", "good job"]
-
-user_query = st.chat_input("Ask follow-up questions or request more details... ℹ️")
-
-if user_query:
-    st.session_state.message_log.append({"role": "user", "content": user_query})
-
-    response_text = ""
-
-    if any(word.lower() == user_query.lower().strip() for word in greeting_keywords):
-        response_text = "😊 Hello! How can I assist you further today?"
-
-    elif any(word in user_query.lower() for word in appreciation_keywords):
-        response_text = "🙏 You're very welcome! I'm here to help. Is there anything else I can assist you with?"
+            deliver_job(job)
+            st.session_state.active_jobs.remove(job_id)
+            delivered = True
+    if delivered:
+        # Full rerun so the finished results render in the chat log (and polling stops when idle)
+        st.rerun()
+
+@st.fragment
+def upload_panel(task):
+    """Uploader, previews and Analyze button; picking files reruns only this panel"""
+    # Image uploader
+    st.markdown(f"<h3><i class='fas fa-upload'></i> 📤 <b>Upload Medical Images</b></h3>", unsafe_allow_html=True) # Enhanced Section Title
+    st.markdown("<p style='color: #4D5656;'>Supported formats: JPG, JPEG, PNG. Upload several views to analyze a whole study, or a ZIP of slices / multi-frame TIFF for a CT or MRI series.</p>", unsafe_allow_html=True)
+    uploaded_files = st.file_uploader(
+        "",
+        type=["jpg", "jpeg", "png", "zip", "tif", "tiff"],
+        accept_multiple_files=True,
+        label_visibility="collapsed"
+    )
+    if uploaded_files:
+        # Image bytes live in content-addressed files, not in session memory
+        stored = st.session_state.get("stored_images", {})
+        # A handle whose file is gone (e.g. swept while this process was down) is stored again from the uploader
+        stored = {f.file_id: image if (image := stored.get(f.file_id)) and image.available()
+                  else StoredImage(f.name, f.type, f.getvalue()) for f in uploaded_files}
+        st.session_state.stored_images = stored
+        with span("image_preview", task=task):
+            previews = {file_id: image.preview_path(make_preview) for file_id, image in stored.items()
+                        if not is_series(image.name)}
+        preview_columns = st.columns(min(len(uploaded_files), 4))
+        for i, f in enumerate(uploaded_files):
+            with preview_columns[i % len(preview_columns)]:
+                if f.file_id in previews:
+                    st.image(previews[f.file_id], caption=f"{f.name} 🖼️", width=350, use_container_width=False)
+                else:
+                    # Slices are scored and tiled into montages when the analysis runs
+                    st.info(f"🗂️ **{f.name}**: CT/MRI series — the most informative slices will be analyzed.")
+
+    # Analyze button
+    force_fresh = st.checkbox("♻️ Force fresh analysis (skip cached results)", value=False)
+    if st.button("🔍 **Analyze Image**", type="primary"):
+        if uploaded_files:
+            try:
+                # Checked against in-memory counters before any job is queued
+                usage_ledger.check_quota(st.session_state["username"])
+            except QuotaExceeded as exc:
+                st.error(f"⛔ {exc}")
+                return
+            # Analyses run on the shared worker pool; the chat panel polls for their progress
+            job_ids = [
+                submit_analysis(st.session_state["username"], task, st.session_state["user_type"],
+                                image.name, image.getvalue(), image.type, use_cache=not force_fresh)
+                for image in stored.values()
+            ]
+            st.session_state.active_jobs.extend(job_ids)
+            st.session_state.study_jobs = set(job_ids) if len(job_ids) > 1 else set()
+            chat_state()["study_results"] = []
+            chat_state()["analysis_images"] = []
+            # Full rerun so the chat panel starts polling the new jobs
+            st.rerun()
+        else:
+            st.warning("⚠️ Please upload an image before analyzing. 📤")
+
+@st.fragment
+def chat_panel(task):
+    """Past analyses, chat history and follow-up questions; a chat turn reruns only this panel"""
+    panel_started = time.perf_counter()
+    # Chat Container
+    st.markdown("---")
+    st.markdown("## 💬 **Analysis & Chat**", unsafe_allow_html=True)
+    # Past analyses can be reopened as chat context without another model call
+    past_analyses = list_analyses(st.session_state["username"], task)
+    if past_analyses:
+        with st.expander("🗂️ Past analyses for this task"):
+            for past in past_analyses:
+                label = f"{past['image_name'] or 'Image'} — {time.strftime('%Y-%m-%d %H:%M', time.localtime(past['created_at']))}"
+                if st.button(f"Reopen {label}", key=f"reopen_{past['id']}"):
+                    stored = get_analysis(past["id"], st.session_state["username"])
+                    chat_state()["analysis_context"] = stored["response"]
+                    chat_state()["analysis_images"] = stored["image_parts"]
+                    prefetch(stored["image_parts"])
+                    st.session_state.analysis_id = stored["id"]
+                    chat_state()["message_log"].append({"role": "ai", "content": f"🗂️ Reopened analysis of **{label}**:\n\n{stored['response']}"})
+
+    chat_container = st.container()
+    with chat_container:
+        # Older messages stay in the database until explicitly requested
+        persisted_ids = [m["id"] for m in chat_state()["message_log"] if "id" in m]
+        if persisted_ids and not st.session_state.get("history_exhausted"):
+            if st.button("⬆️ Load older messages"):
+                older = load_messages(st.session_state["username"], task, before_id=min(persisted_ids))
+                if len(older) < PAGE_SIZE:
+                    st.session_state.history_exhausted = True
+                chat_state()["message_log"][:0] = older
+
+        for message in chat_state()["message_log"]:
+            if message["role"] == "ai":
+                with st.chat_message("assistant"):
+                    st.markdown(f"**AI Assistant:** {message['content']} 🤖")
+            else:
+                with st.chat_message("user"):
+                    st.markdown(f"**You:** {message['content']} 🧑‍⚕️")
 
-    elif any(word in user_query.lower() for word in irrelevant_keywords):
-        response_text = "⚠️ Please ask questions related to the medical image analysis for the best results. 🩺"
+        if st.session_state.active_jobs:
+            active_jobs_panel()
 
-    else:
-        analysis_context = st.session_state.get("analysis_context", None)
-        if analysis_context:
-            response_text = get_gemini_response(
-                task_prompt="Answer the follow-up question based on the previous context.",
-                user_type=st.session_state["user_type"],
-                additional_input=f"Context: {analysis_context}\nUser Query: {user_query}"
-            )
-        else:
-            response_text = "⚠️ I don't have the previous analysis context. Please ensure you have analyzed an image first, or rephrase your question. 🖼️"
+    # Chat input
+    user_query = st.chat_input("Ask follow-up questions or request more details... ℹ️")
 
-    st.session_state.message_log.append({"role": "ai", "content": response_text})
-    st.rerun()
+    if user_query:
+        log_message("user", user_query)
+        with chat_container:
+            with st.chat_message("user"):
+                st.markdown(f"**You:** {user_query} 🧑‍⚕️")
+
+        with span("chat_dispatch", task=task) as dispatch_labels:
+            # Greetings, thanks, off-topic and repeated questions are answered without the model
+            analysis_context = chat_state().get("analysis_context")
+            analysis_key = analysis_fingerprint(analysis_context, st.session_state["user_type"]) if analysis_context else None
+            route, response_text = intent_router.route(user_query, analysis_key)
+            dispatch_labels["route"] = route
+
+            if route == "model":
+                if analysis_context:
+                    # Compact the analysis once, then send it with a budgeted window of recent turns
+                    conversation = chat_state().get("conversation")
+                    if conversation is None or conversation[0] != analysis_key:
+                        conversation = (analysis_key, ConversationContext(
+                            analysis_context, expertise_prompt_for(st.session_state["user_type"]), task=task))
+                        chat_state()["conversation"] = conversation
+                    turns = [(m["role"], m["content"]) for m in chat_state()["message_log"][:-1]
+                             if m["content"] != analysis_context]
+                    # The same file handles serve every turn; nothing is re-sent inline
+                    image_parts = chat_state().get("analysis_images", [])
+                    attachments = attachments_for(image_parts)
+                    contents = conversation[1].build_contents(turns, user_query, attachments)
+                    try:
+                        with chat_container:
+                            response_text = render_ai_stream(
+                                generate_followup_response(contents, st.session_state["user_type"], task)
+                            )
+                        intent_router.remember(analysis_key, user_query, response_text)
+                    except QuotaExceeded as exc:
+                        dispatch_labels["error"] = "QuotaExceeded"
+                        response_text = f"⛔ {exc}"
+                    except Exception as exc:
+                        # Retries already ran in the request layer; keep the session alive
+                        dispatch_labels["error"] = type(exc).__name__
+                        # A handle the service no longer knows is uploaded again next turn
+                        file_handles.forget(digest for digest, _ in image_parts)
+                        response_text = "⚠️ The AI service is busy or unavailable right now. Please try again in a moment. 🔁"
+                else:
+                    response_text = "⚠️ I don't have the previous analysis context. Please ensure you have analyzed an image first, or rephrase your question. 🖼️"
+
+            log_message("ai", response_text)
+        stage_seconds.observe(time.perf_counter() - panel_started, stage="fragment_run", panel="chat")
+        # Only the chat panel redraws; header, sidebar, task list and uploader are left as they are
+        try:
+            st.rerun(scope="fragment")
+        except StreamlitAPIException:
+            # The turn arrived with a full-app run (e.g. queued behind another widget), which has no fragment to rerun
+            st.rerun()
+
+    # Between interactions at most the session budget of chat state stays in memory
+    chat_state().enforce_budget()
+
+upload_panel(task)
+chat_panel(task)
+
+stage_seconds.observe(time.perf_counter() - _rerun_started, stage="script_run", page="app")
@@ -0,0 +1,147 @@
+"""Model access shared by the Streamlit app and the batch CLI; the prompts live in prompts.py.
+
+Nothing in here imports Streamlit, so it can run headless.
+"""
+import hashlib
+import time
+
+from metrics import record_usage, span
+from model_client import get_model, model_name_for, request_options
+from request_layer import claim, guarded_call, guarded_stream, release
+from result_cache import analysis_cache, make_cache_key
+from usage_ledger import usage_ledger
+
+def _account(usage, started, username, task, user_type, call):
+    """Records a finished model call in the token metrics and the per-user usage ledger"""
+    record_usage(usage, task=task, call=call)
+    usage_ledger.record(username, task, user_type, call, usage, time.perf_counter() - started)
+
+def _prepare_request(task_prompt, image, additional_input, task=None):
+    """Builds the model input and, for image analyses, the cache key"""
+    # task_prompt is a compiled prompt (prompts.prompt_for), which already addresses the audience
+    input_data = [task_prompt, additional_input]
+
+    # Include image if provided
+    cache_key = None
+    if image:
+        input_data[1:1] = image
+        # Image analyses are cached by content so repeat uploads skip the model call
+        image_bytes = image[0]["data"] if len(image) == 1 else b"".join(
+            hashlib.sha256(part["data"]).digest() for part in image)  # series montages
+        cache_key = make_cache_key(image_bytes, task_prompt, model_name_for(task), additional_input)
+
+    return input_data, cache_key
+
+def _cached_or_claim(cache_key, use_cache):
+    """Returns (cached response or None, whether this process claimed the analysis)"""
+    if not cache_key or not use_cache:
+        return None, False
+    cached = analysis_cache.get(cache_key)
+    if cached is not None or not analysis_cache.enabled:
+        return cached, False
+    # Another process already running this analysis puts it in the cache; wait for that instead
+    claimed, cached = claim(cache_key, lambda: analysis_cache.get(cache_key))
+    return cached, claimed
+
+# Function to get AI response
+def get_gemini_response(task_prompt, user_type, image=None, additional_input="", use_cache=True, task=None,
+                        username=None):
+    """Generates AI response using Google's Gemini model; usage is charged to username"""
+    input_data, cache_key = _prepare_request(task_prompt, image, additional_input, task)
+    call = "analysis" if image else "followup"
+
+    with span("get_gemini_response", task=task, call=call) as labels:
+        # use_cache=False bypasses the lookup but still refreshes the stored result
+        cached, claimed = _cached_or_claim(cache_key, use_cache)
+        if cached is not None:
+            labels["cache"] = "hit"
+            return cached
+
+        try:
+            usage_ledger.check_quota(username)
+            model = get_model(task, user_type)
+
+            def generate():
+                started = time.perf_counter()
+                response = model.generate_content(input_data, request_options=request_options())
+                _account(getattr(response, "usage_metadata", None), started, username, task, user_type, call)
+                return response
+
+            # Identical concurrent analyses (same cache key) share one model call
+            response = guarded_call(generate, key=cache_key)
+            if cache_key:
+                analysis_cache.set(cache_key, response.text)
+            return response.text
+        finally:
+            if claimed:
+                release(cache_key)
+
+def stream_gemini_response(task_prompt, user_type, image=None, additional_input="", use_cache=True, task=None,
+                           username=None):
+    """Yields the Gemini response in chunks as they are generated; usage is charged to username"""
+    input_data, cache_key = _prepare_request(task_prompt, image, additional_input, task)
+    call = "analysis" if image else "followup"
+
+    with span("get_gemini_response", task=task, call=call, stream="yes") as labels:
+        cached, claimed = _cached_or_claim(cache_key, use_cache)
+        if cached is not None:
+            labels["cache"] = "hit"
+            yield cached
+            return
+
+        try:
+            usage_ledger.check_quota(username)
+            model = get_model(task, user_type)
+
+            def generate():
+                started = time.perf_counter()
+                chunks = model.generate_content(input_data, stream=True, request_options=request_options())
+                return _iter_text(chunks, started, username, task, user_type, call)
+
+            parts = []
+            for text in guarded_stream(generate, key=cache_key):
+                parts.append(text)
+                yield text
+
+            if cache_key:
+                analysis_cache.set(cache_key, "".join(parts))
+        finally:
+            if claimed:
+                release(cache_key)
+
+def _iter_text(chunks, started, username, task, user_type, call):
+    """Yields chunk texts and accounts the final usage metadata once the stream ends"""
+    usage = None
+    for chunk in chunks:
+        usage = getattr(chunk, "usage_metadata", None) or usage
+        try:
+            yield chunk.text
+        except ValueError:
+            # Chunks without text parts (e.g. safety or finish metadata)
+            continue
+    _account(usage, started, username, task, user_type, call)
+
+def get_chat_response(contents, user_type, task=None, username=None):
+    """Answers a multi-turn conversation (see conversation.ConversationContext)"""
+    with span("get_gemini_response", task=task, call="followup"):
+        usage_ledger.check_quota(username)
+
+        def generate():
+            started = time.perf_counter()
+            response = get_model(task, user_type).generate_content(contents, request_options=request_options())
+            _account(getattr(response, "usage_metadata", None), started, username, task, user_type, "followup")
+            return response
+
+        return guarded_call(generate).text
+
+def stream_chat_response(contents, user_type, task=None, username=None):
+    """Yields the reply to a multi-turn conversation in chunks"""
+    with span("get_gemini_response", task=task, call="followup", stream="yes"):
+        usage_ledger.check_quota(username)
+
+        def generate():
+            started = time.perf_counter()
+            chunks = get_model(task, user_type).generate_content(contents, stream=True, request_options=request_options())
+            return _iter_text(chunks, started, username, task, user_type, "followup")
+
+        yield from guarded_stream(generate)
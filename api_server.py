@@ -0,0 +1,302 @@
+"""HTTP API for submitting analyses by machine, e.g. from a PACS integration.
+
+Usage:
+    python api_server.py --port 8000
+
+Clients authenticate with HTTP Basic using their app account. Submitted images
+run on the same background job pool, prompts, cache, quotas and history as the
+Streamlit UI; one event loop keeps any number of uploads and polls in flight
+while the model calls run on the job workers.
+
+    curl -u alice:secret -F task="Bone Fracture Detection" -F file=@wrist.png http://localhost:8000/v1/jobs
+    curl -u alice:secret --data-binary @series.zip "http://localhost:8000/v1/jobs?task=Osteoporosis%20Stage%20Prediction&filename=series.zip"
+    curl -u alice:secret "http://localhost:8000/v1/jobs/<id>?wait=30"
+    curl -u alice:secret http://localhost:8000/v1/jobs/<id>/result
+"""
+import argparse
+import asyncio
+import base64
+import binascii
+import json
+import math
+import mimetypes
+import os
+import time
+
+from aiohttp import web
+
+import settings  # noqa: F401  (loads .env)
+from db import authenticate
+from jobs import ACTIVE_STATUSES, active_job_count, cancel, get_job, submit_analysis
+from metrics import Counter, register, span, start_exporters
+from prompts import USER_TYPES, task_prompts
+from series import SERIES_EXTENSIONS
+from session_memory import start_sweeper
+from usage_ledger import QuotaExceeded, usage_ledger
+
+# API server settings (override through environment variables / .env)
+API_HOST = os.getenv("BONEHEALTH_API_HOST", "0.0.0.0")
+API_PORT = int(os.getenv("BONEHEALTH_API_PORT", "8000"))
+MAX_UPLOAD_BYTES = int(float(os.getenv("BONEHEALTH_API_MAX_UPLOAD_MB", "50")) * 1024 * 1024)  # per file
+MAX_FILES = int(os.getenv("BONEHEALTH_API_MAX_FILES", "20"))  # per request
+MAX_REQUEST_BYTES = int(float(os.getenv("BONEHEALTH_API_MAX_REQUEST_MB", "200")) * 1024 * 1024)  # all files together
+MAX_ACTIVE_JOBS = int(os.getenv("BONEHEALTH_API_MAX_ACTIVE_JOBS", "20"))  # queued + running per user; 0 = unlimited
+MAX_FIELD_BYTES = 64 * 1024
+MAX_WAIT_SECONDS = 60  # longest ?wait= a poll may hold the connection
+POLL_SECONDS = 0.5
+READ_CHUNK = 256 * 1024
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png") + SERIES_EXTENSIONS
+
+api_requests = register(Counter("bonehealth_api_requests_total", "HTTP API requests by route and status"))
+
+
+def _error(exc_class, message, **headers):
+    """An aiohttp HTTP exception with a JSON body"""
+    return exc_class(text=json.dumps({"error": message}), content_type="application/json", headers=headers)
+
+
+def _credentials(request):
+    header = request.headers.get("Authorization", "")
+    if not header.startswith("Basic "):
+        return None
+    try:
+        username, _, password = base64.b64decode(header[6:]).decode("utf-8").partition(":")
+    except (binascii.Error, UnicodeDecodeError):
+        return None
+    return username, password
+
+
+@web.middleware
+async def observe(request, handler):
+    """Times each request as an api_request span and counts it by route and status"""
+    route = request.match_info.route.resource.canonical if request.match_info.route.resource else "unmatched"
+    status = 500
+    try:
+        with span("api_request", route=route):
+            response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as exc:
+        status = exc.status
+        raise
+    finally:
+        api_requests.inc(route=route, status=str(status))
+
+
+@web.middleware
+async def require_login(request, handler):
+    """HTTP Basic authentication against the app's users table"""
+    if request.path == "/healthz":
+        return await handler(request)
+    credentials = _credentials(request)
+    user_type = await asyncio.to_thread(authenticate, *credentials) if credentials else None
+    if user_type is None:
+        raise _error(web.HTTPUnauthorized, "Invalid username or password",
+                     **{"WWW-Authenticate": 'Basic realm="Bone Health AI"'})
+    request["username"], request["user_type"] = credentials[0], user_type
+    return await handler(request)
+
+
+def _job_view(job):
+    """The public fields of a job row"""
+    return {
+        "id": job["id"],
+        "task": job["task"],
+        "user_type": job["user_type"],
+        "image_name": job["image_name"],
+        "status": job["status"],
+        "error": job["error"],
+        "analysis_id": job["analysis_id"],
+        "partial_chars": len(job["partial"]),
+        "upload_stats": job["upload_stats"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+        "links": {"self": f"/v1/jobs/{job['id']}", "result": f"/v1/jobs/{job['id']}/result"},
+    }
+
+
+async def _own_job(request):
+    """The requested job, if it belongs to the caller; other users' jobs are reported as missing"""
+    job = await asyncio.to_thread(get_job, request.match_info["job_id"])
+    if job is None or job["username"] != request["username"]:
+        raise _error(web.HTTPNotFound, "No such job")
+    return job
+
+
+def _too_large(message, limit, size):
+    return web.HTTPRequestEntityTooLarge(limit, size, text=json.dumps({"error": message}),
+                                         content_type="application/json")
+
+
+async def _read_limited(read, name, limit):
+    """Reads an upload in chunks, refusing anything over limit bytes before it is all in memory"""
+    chunks, size = [], 0
+    while True:
+        chunk = await read(READ_CHUNK)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > limit:
+            raise _too_large(f"{name} goes over the {limit:,}-byte upload limit", limit, size)
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def _check_image_name(name):
+    if not name or not name.lower().endswith(IMAGE_EXTENSIONS):
+        raise _error(web.HTTPUnsupportedMediaType,
+                     f"{name or 'Upload'}: expected one of {', '.join(IMAGE_EXTENSIONS)}")
+
+
+def _truthy(value):
+    return str(value).lower() in ("1", "true", "yes")
+
+
+async def _admit(request, fields, count):
+    """Checks the task and the caller's limits before reading the body of upload number count"""
+    task = fields.get("task")
+    if task not in task_prompts:
+        raise _error(web.HTTPBadRequest, f"Unknown task {task!r}; send it before the files. GET /v1/tasks lists them")
+    if count > MAX_FILES:
+        raise _too_large(f"At most {MAX_FILES} files per request", MAX_FILES, count)
+    if MAX_ACTIVE_JOBS:
+        if "active_jobs" not in request:
+            request["active_jobs"] = await asyncio.to_thread(active_job_count, request["username"])
+        if request["active_jobs"] + count > MAX_ACTIVE_JOBS:
+            raise _error(web.HTTPTooManyRequests,
+                         f"{request['active_jobs']} analyses already queued or running; {count} more would pass the limit of {MAX_ACTIVE_JOBS}",
+                         **{"Retry-After": "10"})
+
+
+async def _read_uploads(request):
+    """Returns (fields, [(name, bytes, mime type)]) from a multipart form or a raw request body.
+
+    Fields may also come in the query string. Every file is admitted (task, file count,
+    active jobs) before its body is read, so form fields must precede the files.
+    """
+    fields = dict(request.query)
+    if request.content_length is not None and request.content_length > MAX_REQUEST_BYTES:
+        raise _too_large(f"Requests are limited to {MAX_REQUEST_BYTES:,} bytes", MAX_REQUEST_BYTES, request.content_length)
+
+    if request.content_type.startswith("multipart/"):
+        files, total = [], 0
+        reader = await request.multipart()
+        async for part in reader:
+            if part.filename is None:
+                value = await _read_limited(part.read_chunk, f"Field {part.name!r}", MAX_FIELD_BYTES)
+                fields[part.name] = value.decode("utf-8", "replace")
+                continue
+            _check_image_name(part.filename)
+            await _admit(request, fields, len(files) + 1)
+            data = await _read_limited(part.read_chunk, part.filename, min(MAX_UPLOAD_BYTES, MAX_REQUEST_BYTES - total))
+            total += len(data)
+            mime_type = part.headers.get("Content-Type")
+            if not mime_type or mime_type == "application/octet-stream":
+                mime_type = mimetypes.guess_type(part.filename)[0] or "image/jpeg"
+            files.append((part.filename, data, mime_type))
+        return fields, files
+
+    # A raw body: the image itself, with the options in the query string
+    name = fields.get("filename")
+    _check_image_name(name)
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_BYTES:
+        raise _too_large(f"{name} goes over the {MAX_UPLOAD_BYTES:,}-byte upload limit", MAX_UPLOAD_BYTES, request.content_length)
+    await _admit(request, fields, 1)
+    data = await _read_limited(request.content.read, name, MAX_UPLOAD_BYTES)
+    mime_type = request.content_type
+    if not mime_type or mime_type in ("application/octet-stream", "application/x-www-form-urlencoded"):
+        mime_type = mimetypes.guess_type(name)[0] or "image/jpeg"
+    return fields, [(name, data, mime_type)]
+
+
+async def healthz(request):
+    return web.json_response({"status": "ok"})
+
+
+async def list_tasks(request):
+    return web.json_response({"tasks": list(task_prompts), "user_types": list(USER_TYPES)})
+
+
+async def submit_jobs(request):
+    username, user_type = request["username"], request["user_type"]
+    try:
+        await asyncio.to_thread(usage_ledger.check_quota, username)
+    except QuotaExceeded as exc:
+        raise _error(web.HTTPTooManyRequests, str(exc))
+
+    fields, files = await _read_uploads(request)
+    if not files:
+        raise _error(web.HTTPBadRequest, "No image uploaded")
+    task = fields["task"]
+
+    use_cache = not _truthy(fields.get("force_fresh", ""))
+    job_ids = []
+    for name, data, mime_type in files:
+        job_ids.append(await asyncio.to_thread(
+            submit_analysis, username, task, user_type, name, data, mime_type, use_cache, "api"))
+    jobs = await asyncio.gather(*(asyncio.to_thread(get_job, job_id) for job_id in job_ids))
+    return web.json_response({"jobs": [_job_view(job) for job in jobs]}, status=202,
+                             headers={"Location": f"/v1/jobs/{job_ids[0]}"})
+
+
+async def poll_job(request):
+    job = await _own_job(request)
+    try:
+        wait = float(request.query.get("wait", 0))
+    except ValueError:
+        wait = math.nan
+    if not math.isfinite(wait):
+        raise _error(web.HTTPBadRequest, "wait must be a number of seconds")
+    wait = min(max(wait, 0), MAX_WAIT_SECONDS)
+    # Long poll: hold the request until the job finishes or the wait runs out
+    deadline = time.monotonic() + wait
+    while job["status"] in ACTIVE_STATUSES and time.monotonic() < deadline:
+        await asyncio.sleep(POLL_SECONDS)
+        job = await _own_job(request)
+    return web.json_response(_job_view(job))
+
+
+async def job_result(request):
+    job = await _own_job(request)
+    if job["status"] in ACTIVE_STATUSES:
+        return web.json_response(_job_view(job), status=202, headers={"Retry-After": "2"})
+    if job["status"] != "done":
+        raise _error(web.HTTPConflict, job["error"] or f"Job {job['status']}")
+    return web.json_response({"id": job["id"], "task": job["task"], "user_type": job["user_type"],
+                              "image_name": job["image_name"], "analysis_id": job["analysis_id"],
+                              "analysis": job["result"]})
+
+
+async def cancel_job(request):
+    job = await _own_job(request)
+    if job["status"] in ACTIVE_STATUSES:
+        await asyncio.to_thread(cancel, job["id"])
+        job = await _own_job(request)
+    return web.json_response(_job_view(job))
+
+
+def create_app():
+    # Multipart parts are size-checked as they stream in; client_max_size only bounds non-streamed reads
+    app = web.Application(middlewares=[observe, require_login], client_max_size=MAX_UPLOAD_BYTES)
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/v1/tasks", list_tasks)
+    app.router.add_post("/v1/jobs", submit_jobs)
+    app.router.add_get("/v1/jobs/{job_id}", poll_job)
+    app.router.add_get("/v1/jobs/{job_id}/result", job_result)
+    app.router.add_delete("/v1/jobs/{job_id}", cancel_job)
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the Bone Health AI analysis API.")
+    parser.add_argument("--host", default=API_HOST)
+    parser.add_argument("--port", type=int, default=API_PORT)
+    args = parser.parse_args(argv)
+    start_exporters()
+    start_sweeper()
+    web.run_app(create_app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
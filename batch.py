@@ -0,0 +1,23 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Upper bound on model calls in flight for one batch (override through .env)
+MAX_CONCURRENCY = int(os.getenv("BONEHEALTH_MAX_CONCURRENCY", "4"))
+
+
+def run_batch(items, worker, max_workers=MAX_CONCURRENCY):
+    """Runs worker(item) on a bounded thread pool.
+
+    Yields (index, result, error) tuples in completion order, so callers can
+    report progress while the slower calls are still running.
+    """
+    if not items:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as pool:
+        futures = {pool.submit(worker, item): index for index, item in enumerate(items)}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                yield index, future.result(), None
+            except Exception as exc:
+                yield index, None, exc
@@ -0,0 +1,148 @@
+"""Headless batch analysis over a directory or manifest of images.
+
+Usage:
+    python batch_cli.py scans/ --task "Bone Age Detection" --output results.jsonl
+    python batch_cli.py manifest.csv --workers 8 --user-type Doctor
+
+A manifest is a CSV or JSONL file with a ``path`` column/key and optional
+``task`` and ``user_type`` overrides per image. ZIP files of slices and
+multi-frame TIFFs are analyzed as CT/MRI series. Completed items are recorded in
+a checkpoint file, so an interrupted run resumes without repeating model calls.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import mimetypes
+import os
+import sys
+import time
+
+import settings  # noqa: F401  (loads .env)
+from analysis import get_gemini_response
+from batch import run_batch, MAX_CONCURRENCY
+from metrics import start_exporters
+from prompts import USER_TYPES, prompt_for, task_prompts
+from series import SERIES_EXTENSIONS, prepare_upload
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png") + SERIES_EXTENSIONS
+
+
+def item_id(path, task, user_type):
+    """Stable identifier for one (image, task, audience) job"""
+    return hashlib.sha256(f"{os.path.abspath(path)}|{task}|{user_type}".encode("utf-8")).hexdigest()
+
+
+def load_items(source, task, user_type):
+    """Builds the job list from a directory walk or a CSV/JSONL manifest"""
+    if os.path.isdir(source):
+        items = []
+        for root, _, files in os.walk(source):
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    items.append({"path": os.path.join(root, name), "task": task, "user_type": user_type})
+        return sorted(items, key=lambda item: item["path"])
+
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, newline="", encoding="utf-8") as f:
+        if source.lower().endswith((".jsonl", ".ndjson")):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+
+    items = []
+    for row in rows:
+        path = row["path"]
+        items.append({
+            "path": path if os.path.isabs(path) else os.path.join(base, path),
+            "task": row.get("task") or task,
+            "user_type": row.get("user_type") or user_type,
+        })
+    return items
+
+
+def load_checkpoint(path):
+    """Returns the set of item ids already completed"""
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def analyze_item(item, use_cache=True, username=None):
+    """Runs one image or series through preprocessing and the model; usage is charged to username"""
+    with open(item["path"], "rb") as f:
+        data = f.read()
+    mime_type = mimetypes.guess_type(item["path"])[0] or "image/jpeg"
+    image_parts, stats, series_note = prepare_upload(data, os.path.basename(item["path"]), item["task"], mime_type)
+
+    started = time.time()
+    prompt = prompt_for(item["task"], item["user_type"])
+    analysis = get_gemini_response(prompt.text, item["user_type"], image_parts, series_note,
+                                   use_cache=use_cache, task=item["task"], username=username)
+    result = {
+        "analysis": analysis,
+        "prompt_id": prompt.id,
+        "latency_seconds": round(time.time() - started, 3),
+        "original_bytes": stats["original_bytes"],
+        "processed_bytes": stats["processed_bytes"],
+    }
+    if "slices" in stats:
+        result["slices"] = stats["slices"]
+        result["selected_slices"] = stats["selected_slices"]
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run Bone Health AI analyses over many images without the UI.")
+    parser.add_argument("source", help="Directory of images, or a CSV/JSONL manifest with a 'path' column")
+    parser.add_argument("--task", choices=list(task_prompts), default="Bone Fracture Detection",
+                        help="Task for images that don't set one in the manifest")
+    parser.add_argument("--user-type", choices=USER_TYPES, default="Doctor",
+                        help="Audience for images that don't set one in the manifest")
+    parser.add_argument("--output", default="results.jsonl", help="JSONL file results are appended to")
+    parser.add_argument("--checkpoint", help="Checkpoint file (default: <output>.checkpoint)")
+    parser.add_argument("--workers", type=int, default=MAX_CONCURRENCY, help="Concurrent model calls")
+    parser.add_argument("--no-cache", action="store_true", help="Skip cached analyses")
+    parser.add_argument("--username", default="batch-cli", help="Account the model usage is charged to")
+    args = parser.parse_args(argv)
+    start_exporters()
+
+    items = load_items(args.source, args.task, args.user_type)
+    for item in items:
+        if item["task"] not in task_prompts:
+            parser.error(f"unknown task {item['task']!r} for {item['path']}")
+        if item["user_type"] not in USER_TYPES:
+            parser.error(f"unknown user type {item['user_type']!r} for {item['path']}")
+
+    checkpoint_path = args.checkpoint or args.output + ".checkpoint"
+    completed = load_checkpoint(checkpoint_path)
+    pending = [item for item in items if item_id(item["path"], item["task"], item["user_type"]) not in completed]
+    print(f"{len(items)} images, {len(items) - len(pending)} already done, {len(pending)} to analyze", file=sys.stderr)
+
+    failures = 0
+    with open(args.output, "a", encoding="utf-8") as out, open(checkpoint_path, "a", encoding="utf-8") as ckpt:
+        results = run_batch(pending, lambda item: analyze_item(item, use_cache=not args.no_cache, username=args.username), args.workers)
+        for done, (index, result, error) in enumerate(results, start=1):
+            item = pending[index]
+            record = {"path": item["path"], "task": item["task"], "user_type": item["user_type"]}
+            if error is not None:
+                failures += 1
+                record["error"] = f"{type(error).__name__}: {error}"
+            else:
+                record.update(result)
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+
+            # Only successes are checkpointed, so failed images are retried on the next run
+            if error is None:
+                ckpt.write(item_id(item["path"], item["task"], item["user_type"]) + "\n")
+                ckpt.flush()
+                os.fsync(ckpt.fileno())
+            print(f"[{done}/{len(pending)}] {'FAILED' if error else 'ok'} {item['path']}", file=sys.stderr)
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
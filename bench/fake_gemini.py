@@ -0,0 +1,171 @@
+"""Local stand-in for google.generativeai used by the benchmarks.
+
+install() swaps genai.GenerativeModel for FakeGenerativeModel and the file API
+for FakeFileService, so the app and the CLI run unchanged with no network access.
+"""
+import datetime
+import random
+import threading
+import time
+import uuid
+
+import google.generativeai as genai
+from google.api_core import exceptions as api_exceptions
+
+import model_client
+
+LOREM = (
+    "The radiograph shows well-corticated osseous structures with preserved joint spaces. "
+    "No displaced fracture line is identified. Soft tissues are unremarkable. "
+    "Recommended: calcium and vitamin D rich diet, weight-bearing exercise and follow-up imaging. "
+)
+
+
+class FakeBackendError(api_exceptions.ResourceExhausted):
+    """Raised for injected failures; a 429, so the request layer treats it as transient"""
+
+
+class FakeUsage:
+    def __init__(self, prompt_tokens, output_tokens, thinking_tokens=0):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.thoughts_token_count = thinking_tokens
+        self.total_token_count = prompt_tokens + output_tokens + thinking_tokens
+
+
+class FakeChunk:
+    def __init__(self, text, usage_metadata=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class FakeResponse(FakeChunk):
+    pass
+
+
+class FakeCountTokens:
+    def __init__(self, total_tokens):
+        self.total_tokens = total_tokens
+
+
+class FakeFile:
+    def __init__(self, mime_type, size, ttl):
+        self.name = f"files/{uuid.uuid4().hex[:12]}"
+        self.uri = f"https://fake.invalid/v1beta/{self.name}"
+        self.mime_type = mime_type
+        self.size_bytes = size
+        self.expiration_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=ttl)
+
+
+class FakeFileService:
+    """In-memory file API with upload latency and counters"""
+
+    def __init__(self, latency=0.2, ttl=48 * 3600):
+        self.latency = latency
+        self.ttl = ttl
+        self.files = {}
+        self.uploads = 0
+        self.deletes = 0
+        self.lock = threading.Lock()
+
+    def upload_file(self, path, mime_type=None, display_name=None, **kwargs):
+        size = len(path.read()) if hasattr(path, "read") else 0
+        time.sleep(self.latency)
+        handle = FakeFile(mime_type, size, self.ttl)
+        with self.lock:
+            self.uploads += 1
+            self.files[handle.name] = handle
+        return handle
+
+    def get_file(self, name):
+        return self.files[name]
+
+    def delete_file(self, name):
+        with self.lock:
+            self.deletes += 1
+            self.files.pop(getattr(name, "name", name), None)
+
+
+class FakeBackend:
+    """Shared latency/throughput/failure settings and call counters"""
+
+    def __init__(self, latency=0.5, tokens_per_second=200.0, output_tokens=600, failure_rate=0.0,
+                 thinking_tokens=0, seed=None):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.failure_rate = failure_rate
+        self.thinking_tokens = thinking_tokens
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _prompt_tokens(self, contents):
+        total = 0
+        for item in contents if isinstance(contents, (list, tuple)) else [contents]:
+            if isinstance(item, str):
+                total += len(item) // 4
+            elif isinstance(item, dict) and "parts" in item:
+                total += self._prompt_tokens(item["parts"])
+            elif isinstance(item, dict) and "data" in item:
+                total += 258  # Gemini bills a fixed token count per image tile
+            else:
+                total += 258
+        return total
+
+    def _start_call(self):
+        with self.lock:
+            self.calls += 1
+            fail = self.random.random() < self.failure_rate
+        time.sleep(self.latency)
+        if fail:
+            raise FakeBackendError("Resource has been exhausted (injected failure)")
+
+    def _words(self):
+        words = (LOREM * (self.output_tokens // 40 + 1)).split()
+        return words[: self.output_tokens]
+
+    def generate(self, contents, stream=False):
+        self._start_call()
+        usage = FakeUsage(self._prompt_tokens(contents), self.output_tokens, self.thinking_tokens)
+        words = self._words()
+        if not stream:
+            time.sleep(self.output_tokens / self.tokens_per_second)
+            return FakeResponse(" ".join(words), usage)
+        return self._stream(words, usage)
+
+    def _stream(self, words, usage):
+        chunk_size = 20
+        for start in range(0, len(words), chunk_size):
+            chunk = words[start:start + chunk_size]
+            time.sleep(len(chunk) / self.tokens_per_second)
+            last = start + chunk_size >= len(words)
+            yield FakeChunk(" ".join(chunk) + " ", usage if last else None)
+
+
+class FakeGenerativeModel:
+    backend = FakeBackend()
+
+    def __init__(self, model_name="fake-model", generation_config=None, **kwargs):
+        self.model_name = model_name
+        self.generation_config = generation_config
+
+    def generate_content(self, contents, stream=False, request_options=None, **kwargs):
+        return self.backend.generate(contents, stream=stream)
+
+    def count_tokens(self, contents):
+        return FakeCountTokens(self.backend._prompt_tokens(contents))
+
+
+def install(backend=None, files=None):
+    """Routes all model construction and file uploads to the fakes and returns the backend"""
+    FakeGenerativeModel.backend = backend or FakeBackend()
+    FakeGenerativeModel.backend.files = files or FakeFileService()
+    genai.configure = lambda **kwargs: None
+    genai.GenerativeModel = FakeGenerativeModel
+    genai.upload_file = FakeGenerativeModel.backend.files.upload_file
+    genai.get_file = FakeGenerativeModel.backend.files.get_file
+    genai.delete_file = FakeGenerativeModel.backend.files.delete_file
+    # Drop handles built before the swap
+    model_client._models.clear()
+    return FakeGenerativeModel.backend
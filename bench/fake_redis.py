@@ -0,0 +1,183 @@
+"""Local stand-in for a Redis server, for the benchmarks and for trying the redis state backend.
+
+Speaks enough of the Redis protocol (RESP2, and the RESP3 handshake newer clients
+send) for shared_state.RedisState: HELLO, GET, GETDEL, SET with EX/PX/NX, DEL,
+INCR/INCRBY, EXPIRE/PEXPIRE, PTTL, PING and FLUSHDB. There is no Lua; EVAL,
+EVALSHA and SCRIPT LOAD run Python equivalents of the scripts the app sends.
+
+    python -m bench.fake_redis --port 6390
+    BONEHEALTH_STATE_BACKEND=redis BONEHEALTH_REDIS_URL=redis://localhost:6390/0 streamlit run BoneHealth.py
+"""
+import argparse
+import hashlib
+import math
+import socketserver
+import threading
+import time
+
+from shared_state import TOKEN_BUCKET_LUA
+
+
+class _Simple(str):
+    """A simple-string or error reply, as opposed to a stored value"""
+
+
+OK = _Simple("+OK")
+
+
+def _sha(script):
+    return hashlib.sha1(script.encode("utf-8")).hexdigest()
+
+
+def _token_bucket(store, keys, args, now):
+    # Python twin of shared_state.TOKEN_BUCKET_LUA; caller holds store.lock
+    interval, limit = float(args[0]), float(args[1])
+    entry = store._live(keys[0], now)
+    tat = max(float(entry[0]) if entry else 0.0, now)
+    if tat + interval - now > limit:
+        return str(tat + interval - now - limit)
+    store.values[keys[0]] = (str(tat + interval), now + (math.ceil(limit * 1000) + 1000) / 1000)
+    return "0"
+
+
+SCRIPTS = {_sha(TOKEN_BUCKET_LUA): _token_bucket}
+
+
+class FakeRedisStore:
+    def __init__(self):
+        self.values = {}  # key -> (value, expires_at or None)
+        self.loaded = set()  # script hashes sent with SCRIPT LOAD or EVAL
+        self.lock = threading.Lock()
+
+    def _live(self, key, now):
+        # Caller holds self.lock
+        entry = self.values.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self.values[key]
+            return None
+        return entry
+
+    def execute(self, command, args):
+        now = time.time()
+        with self.lock:
+            if command == "HELLO":
+                proto = int(args[0]) if args else 2
+                fields = [b"$6\r\nserver\r\n$5\r\nredis\r\n", b"$7\r\nversion\r\n$5\r\n7.0.0\r\n",
+                          b"$5\r\nproto\r\n:%d\r\n" % proto]
+                return (b"%3\r\n" if proto == 3 else b"*6\r\n") + b"".join(fields)
+            if command == "PING":
+                return _Simple("+PONG")
+            if command in ("SELECT", "CLIENT"):
+                return OK
+            if command == "FLUSHDB":
+                self.values.clear()
+                return OK
+            if command == "GET":
+                entry = self._live(args[0], now)
+                return entry[0] if entry else None
+            if command == "SET":
+                key, value, options = args[0], args[1], [a.upper() for a in args[2:]]
+                expires_at = None
+                if "EX" in options:
+                    expires_at = now + float(args[2 + options.index("EX") + 1])
+                if "PX" in options:
+                    expires_at = now + float(args[2 + options.index("PX") + 1]) / 1000
+                if "NX" in options and self._live(key, now) is not None:
+                    return None
+                self.values[key] = (value, expires_at)
+                return OK
+            if command == "SCRIPT" and args and args[0].upper() == "LOAD":
+                self.loaded.add(_sha(args[1]))
+                return _sha(args[1])
+            if command in ("EVAL", "EVALSHA"):
+                sha = _sha(args[0]) if command == "EVAL" else args[0].lower()
+                if command == "EVAL":
+                    self.loaded.add(sha)
+                if sha not in self.loaded:
+                    return _Simple("-NOSCRIPT No matching script. Please use EVAL.")
+                if sha not in SCRIPTS:
+                    return _Simple("-ERR fake_redis cannot run this script")
+                key_count = int(args[1])
+                return SCRIPTS[sha](self, args[2:2 + key_count], args[2 + key_count:], now)
+            if command == "GETDEL":
+                entry = self._live(args[0], now)
+                self.values.pop(args[0], None)
+                return entry[0] if entry else None
+            if command == "DEL":
+                return sum(1 for key in args if self.values.pop(key, None) is not None)
+            if command in ("INCR", "INCRBY"):
+                entry = self._live(args[0], now)
+                value = int(entry[0] if entry else 0) + (int(args[1]) if command == "INCRBY" else 1)
+                self.values[args[0]] = (str(value), entry[1] if entry else None)
+                return value
+            if command in ("EXPIRE", "PEXPIRE"):
+                entry = self._live(args[0], now)
+                if entry is None:
+                    return 0
+                seconds = float(args[1]) / (1000 if command == "PEXPIRE" else 1)
+                self.values[args[0]] = (entry[0], now + seconds)
+                return 1
+            if command == "PTTL":
+                entry = self._live(args[0], now)
+                if entry is None:
+                    return -2
+                return -1 if entry[1] is None else int((entry[1] - now) * 1000)
+        return _Simple(f"-ERR unknown command '{command}'")
+
+
+def _encode(reply, proto=2):
+    if reply is None:
+        return b"_\r\n" if proto == 3 else b"$-1\r\n"
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, bytes):
+        return reply  # already encoded
+    if isinstance(reply, _Simple):
+        return reply.encode() + b"\r\n"
+    data = reply.encode("utf-8", "surrogateescape")
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        proto = 2
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if not line.startswith(b"*"):
+                continue
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+            args = [arg.decode("utf-8", "surrogateescape") for arg in args]
+            if args[0].upper() == "HELLO" and len(args) > 1:
+                proto = int(args[1])
+            self.wfile.write(_encode(self.server.store.execute(args[0].upper(), args[1:]), proto))
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.store = FakeRedisStore()
+
+    @property
+    def url(self):
+        return f"redis://127.0.0.1:{self.server_address[1]}/0"
+
+    def start(self):
+        """Serves on a background thread and returns the server"""
+        threading.Thread(target=self.serve_forever, name="fake-redis", daemon=True).start()
+        return self
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Redis-protocol stand-in for local runs.")
+    parser.add_argument("--port", type=int, default=6390)
+    server = FakeRedisServer(parser.parse_args().port)
+    print(f"Serving {server.url}")
+    server.serve_forever()
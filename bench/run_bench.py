@@ -0,0 +1,375 @@
+"""Offline benchmarks for the Bone Health AI Suite.
+
+Runs entirely against the fake Gemini backend in bench/fake_gemini.py, so it
+needs no API key or network access:
+
+    python -m bench.run_bench --runs 10 --latency 0.8 --tokens-per-second 150
+    python -m bench.run_bench --json bench_output.json
+
+Reports cold-start time (fresh interpreter, first logged-out run) and which heavy
+libraries it loaded, per-rerun script time (logged out and logged in), time spent on CSS
+injection and image preview, image decode/preprocessing per task and image size,
+analysis latency per task, image-grounded follow-up latency and file uploads per
+conversation, shared-state operation latency, analysis throughput with one vs several
+app processes (and how many model calls identical concurrent analyses cost), chat
+round-trip latency and peak memory per session.
+
+    python -m bench.run_bench --state-backend redis --processes 4   # Redis-protocol stand-in
+
+Streamlit's AppTest cannot drive st.file_uploader, so image decode, preview and
+analysis latency are measured by calling the same functions the script calls.
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(ROOT, "BoneHealth.py")
+
+SPANS = defaultdict(list)
+PEAK_MEMORY_MB = []
+
+
+def record(name, seconds):
+    SPANS[name].append(seconds)
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    p95 = ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))]
+    return {"n": len(ordered), "p50_ms": statistics.median(ordered) * 1000, "p95_ms": p95 * 1000,
+            "max_ms": ordered[-1] * 1000}
+
+
+def isolate_environment(workdir):
+    """Points every database at a scratch directory before the app modules are imported"""
+    os.environ["GOOGLE_API_KEY"] = "offline-benchmark"
+    os.environ["BONEHEALTH_DB_PATH"] = os.path.join(workdir, "users.db")
+    os.environ["BONEHEALTH_CACHE_DB"] = os.path.join(workdir, "analysis_cache.db")
+    os.environ["BONEHEALTH_STATE_DB"] = os.path.join(workdir, "shared_state.db")
+    os.environ["BONEHEALTH_CACHE_DISABLED"] = "1"  # measure model latency, not cache hits
+    os.environ["BONEHEALTH_SPILL_DIR"] = os.path.join(workdir, "spill")
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+
+def synthetic_image(side, fmt):
+    """A noisy gradient, closer to a radiograph's entropy than a flat fill"""
+    from PIL import Image
+
+    gradient = Image.linear_gradient("L").resize((side, side))
+    noise = Image.effect_noise((side, side), 40)
+    image = Image.blend(gradient, noise, 0.35).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, **({"quality": 95} if fmt == "JPEG" else {}))
+    return buffer.getvalue()
+
+
+def timed(name, fn, *args, **kwargs):
+    started = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+def instrument_streamlit():
+    """Wraps st.markdown/st.image so CSS injection (time and size) and preview rendering are timed inside AppTest runs"""
+    import streamlit as st
+
+    markdown, image = st.markdown, st.image
+
+    def timed_markdown(body, *args, **kwargs):
+        if "<style>" in str(body) or "bonehealth.css" in str(body):
+            # What the stylesheet element adds to every rerun's delta, inline or as a <link>
+            SPANS["css_element bytes"].append(len(str(body).encode("utf-8")))
+            return timed("css_injection", markdown, body, *args, **kwargs)
+        return markdown(body, *args, **kwargs)
+
+    def timed_image(*args, **kwargs):
+        return timed("preview_render", image, *args, **kwargs)
+
+    st.markdown, st.image = timed_markdown, timed_image
+
+
+def bench_images(sizes, runs):
+    from image_prep import make_preview, preprocess_image
+    from prompts import task_prompts
+
+    payloads = {}
+    for side in sizes:
+        for fmt, mime in (("JPEG", "image/jpeg"), ("PNG", "image/png")):
+            data = synthetic_image(side, fmt)
+            payloads[(side, fmt)] = (data, mime)
+            for _ in range(runs):
+                timed(f"preview {fmt} {side}px", make_preview, data)
+            for task in task_prompts:
+                for _ in range(runs):
+                    part, stats = timed(f"preprocess {fmt} {side}px", preprocess_image, data, task, mime)
+                record(f"payload_ratio {fmt} {side}px", stats["processed_bytes"] / stats["original_bytes"])
+    return payloads
+
+
+def bench_analysis(payloads, runs):
+    from analysis import get_gemini_response
+    from image_prep import preprocess_image
+    from prompts import USER_TYPES, prompt_for, task_prompts
+
+    data, mime = next(iter(payloads.values()))
+    for task in task_prompts:
+        part, _ = preprocess_image(data, task, mime)
+        for user_type in USER_TYPES:
+            for _ in range(runs):
+                try:
+                    timed(f"analysis {task}", get_gemini_response, prompt_for(task, user_type).text, user_type, [part],
+                          use_cache=False, task=task)
+                except Exception:
+                    record("analysis_failures", 0)
+
+
+def bench_followups(payloads, turns, files):
+    """One analyzed image, several follow-up turns; the image should be uploaded once"""
+    from analysis import get_chat_response
+    from conversation import ConversationContext
+    from image_prep import preprocess_image
+    from model_files import attachments_for
+    from prompts import expertise_prompt_for, task_prompts
+    from session_memory import store_bytes
+
+    data, mime = next(iter(payloads.values()))
+    task = next(iter(task_prompts))
+    part, _ = preprocess_image(data, task, mime)
+    image_parts = [(store_bytes(part["data"]), part["mime_type"])]
+    context = ConversationContext("Findings: no acute fracture. " * 200, expertise_prompt_for("Doctor"), task=task)
+    uploads_before, history = files.uploads, []
+    for turn in range(turns):
+        query = f"What does the image show near the joint, variant {turn}?"
+        started = time.perf_counter()
+        try:
+            contents = context.build_contents(history, query, attachments_for(image_parts))
+            answer = get_chat_response(contents, "Doctor", task)
+        except Exception:
+            record("followup_failures", 0)
+            continue
+        record("followup grounded", time.perf_counter() - started)
+        history += [("user", query), ("ai", answer)]
+    record("followup file_uploads", files.uploads - uploads_before)
+
+
+def bench_shared_state(runs):
+    from shared_state import state
+
+    for i in range(runs * 20):
+        timed("state set", state.set, f"bench:{i}", "x" * 256, ttl=60)
+        timed("state get", state.get, f"bench:{i}")
+        timed("state incr", state.incr, "bench:counter", ttl=60)
+
+
+SCALE_OUT_SCRIPT = """
+import json, sys, time
+from concurrent.futures import ThreadPoolExecutor
+sys.path.insert(0, sys.argv[1])
+from bench import fake_gemini
+from bench.run_bench import synthetic_image
+backend = fake_gemini.install(fake_gemini.FakeBackend(latency=float(sys.argv[3]), tokens_per_second=1e6, seed=0))
+from analysis import get_gemini_response
+from image_prep import preprocess_image
+from prompts import prompt_for
+mode, count, side = sys.argv[2], int(sys.argv[4]), int(sys.argv[5])
+data = synthetic_image(side, "JPEG")
+task = "Bone Fracture Detection"
+prompt = prompt_for(task, "Doctor").text
+
+def analyze(i):
+    part, _ = preprocess_image(data, task, "image/jpeg")
+    # Distinct cases unless every process is asked for the same analysis
+    note = "" if mode == "same" else f"Case {sys.argv[6]}-{i}"
+    return get_gemini_response(prompt, "Doctor", [part], note, task=task)
+
+# Imports are done; wait until every process is, so startup isn't timed as throughput
+print("ready", flush=True)
+sys.stdin.readline()
+started = time.perf_counter()
+with ThreadPoolExecutor(max_workers=4) as pool:
+    list(pool.map(analyze, range(count)))
+print(json.dumps({"seconds": time.perf_counter() - started, "calls": backend.calls}))
+"""
+
+
+def bench_scale_out(processes, runs, latency, side=2048):
+    """The same analysis load run by one app process, then spread over several; startup is not timed"""
+    env = dict(os.environ, BONEHEALTH_CACHE_DISABLED="", BONEHEALTH_RATE_LIMIT_RPS="0")
+    total = 8 * processes
+
+    def launch(count, mode, tag):
+        return subprocess.Popen([sys.executable, "-c", SCALE_OUT_SCRIPT, ROOT, mode, str(latency), str(count),
+                                 str(side), tag], cwd=ROOT, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                text=True)
+
+    def run_together(workers):
+        # Start the clock once every process has finished importing, stop it at the last result
+        for worker in workers:
+            worker.stdout.readline()
+        started = time.perf_counter()
+        for worker in workers:
+            worker.stdin.write("go\n")
+            worker.stdin.flush()
+        outputs = [json.loads(worker.stdout.readline()) for worker in workers]
+        seconds = time.perf_counter() - started
+        for worker in workers:
+            worker.communicate()
+        return seconds, outputs
+
+    for run in range(runs):
+        for count in sorted({1, processes}):
+            workers = [launch(total // count, "distinct", f"{run}-{count}-{i}") for i in range(count)]
+            seconds, _ = run_together(workers)
+            record(f"scale_out {count} process(es), {total} analyses", seconds)
+        # Every process asks for the same analysis at once; claims should leave one model call
+        _, outputs = run_together([launch(1, "same", str(run)) for _ in range(processes)])
+        calls = sum(output["calls"] for output in outputs)
+        record(f"model_calls same analysis in {processes} processes", calls)
+
+
+COLD_START_SCRIPT = """
+import sys, time
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(sys.argv[1], default_timeout=60)
+at.run()
+elapsed = time.perf_counter() - started
+heavy = [m for m in ("google.generativeai", "PIL.Image") if m in sys.modules]
+print(elapsed, ",".join(heavy))
+"""
+
+
+def bench_cold_start(runs):
+    """First logged-out run in a fresh interpreter, where every import is paid for"""
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", COLD_START_SCRIPT, APP_PATH], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.split()
+        record("cold_start logged_out", float(output[0]))
+        for module in output[1].split(",") if len(output) > 1 else []:
+            record(f"cold_start_loaded {module}", 0)
+
+
+def bench_app(runs, sessions, backend):
+    from streamlit.testing.v1 import AppTest
+
+    import db
+
+    db.register("bench_doctor", "bench", "Doctor", "LIC-1", "Orthopedics", "Bench Clinic")
+
+    for _ in range(runs):
+        at = AppTest.from_file(APP_PATH, default_timeout=60)
+        started = time.perf_counter()
+        at.run()
+        record("rerun logged_out", time.perf_counter() - started)
+
+    for session in range(sessions):
+        tracemalloc.start()
+        at = AppTest.from_file(APP_PATH, default_timeout=120)
+        at.session_state["logged_in"] = True
+        at.session_state["user_type"] = "Doctor"
+        at.session_state["username"] = "bench_doctor"
+        at.run()
+        for _ in range(runs):
+            started = time.perf_counter()
+            at.run()
+            record("rerun logged_in", time.perf_counter() - started)
+
+        # The app reads the analysis from the session's SessionVault, not from session_state itself
+        at.session_state["chat_state"]["analysis_context"] = "Findings: no acute fracture. " * 200
+        for turn in range(runs):
+            calls_before = backend.calls
+            started = time.perf_counter()
+            at.chat_input[0].set_value(f"What exercises help with recovery, variant {session}-{turn}?").run()
+            record("chat round_trip", time.perf_counter() - started)
+            # A round trip that never reached the model measured the wrong path
+            if backend.calls == calls_before:
+                record("chat_route_failures", 0)
+        for _ in at.exception:
+            record("app_exceptions", 0)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        PEAK_MEMORY_MB.append(peak / (1024 * 1024))
+
+
+def report(as_json):
+    results = {}
+    for name, samples in sorted(SPANS.items()):
+        if name.startswith("payload_ratio"):
+            results[name] = {"mean_ratio": statistics.mean(samples)}
+        elif name == "followup file_uploads" or name.startswith("model_calls"):
+            results[name] = {"count": int(sum(samples))}
+        elif name.endswith(" bytes"):
+            results[name] = {"n": len(samples), "max_bytes": max(samples)}
+        elif name.endswith("_failures") or name == "app_exceptions" or name.startswith("cold_start_loaded"):
+            results[name] = {"count": len(samples)}
+        else:
+            results[name] = summarize(samples)
+    if PEAK_MEMORY_MB:
+        results["peak_memory session"] = {"max_mb": max(PEAK_MEMORY_MB), "mean_mb": statistics.mean(PEAK_MEMORY_MB)}
+
+    if as_json:
+        with open(as_json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    width = max(len(name) for name in results) if results else 0
+    for name, values in results.items():
+        formatted = "  ".join(f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}" for k, v in values.items())
+        print(f"{name.ljust(width)}  {formatted}")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline Bone Health AI Suite benchmarks (fake Gemini backend).")
+    parser.add_argument("--runs", type=int, default=5, help="Repetitions per measurement")
+    parser.add_argument("--sessions", type=int, default=2, help="Independent AppTest sessions")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 2048, 4096], help="Synthetic image sides in px")
+    parser.add_argument("--latency", type=float, default=0.5, help="Fake model time-to-first-token in seconds")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="Fake model output throughput")
+    parser.add_argument("--output-tokens", type=int, default=600, help="Fake response length")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of fake calls that raise")
+    parser.add_argument("--state-backend", choices=["sqlite", "redis"], default="sqlite",
+                        help="Shared state backend; 'redis' starts the local Redis-protocol stand-in")
+    parser.add_argument("--processes", type=int, default=max(2, min(4, os.cpu_count() or 1)),
+                        help="App processes for the scale-out scenario")
+    parser.add_argument("--skip-app", action="store_true", help="Skip the AppTest (Streamlit) scenarios")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="bonehealth-bench-") as workdir:
+        isolate_environment(workdir)
+        if args.state_backend == "redis":
+            from bench.fake_redis import FakeRedisServer
+
+            os.environ["BONEHEALTH_STATE_BACKEND"] = "redis"
+            os.environ["BONEHEALTH_REDIS_URL"] = FakeRedisServer().start().url
+        from bench import fake_gemini
+
+        backend = fake_gemini.install(fake_gemini.FakeBackend(
+            latency=args.latency, tokens_per_second=args.tokens_per_second,
+            output_tokens=args.output_tokens, failure_rate=args.failure_rate, seed=0,
+        ))
+        payloads = bench_images(args.sizes, args.runs)
+        bench_analysis(payloads, max(1, args.runs // 2))
+        bench_followups(payloads, args.runs, backend.files)
+        bench_shared_state(args.runs)
+        bench_scale_out(args.processes, max(1, args.runs // 2), args.latency)
+        if not args.skip_app:
+            bench_cold_start(max(1, args.runs // 2))
+            instrument_streamlit()
+            bench_app(args.runs, args.sessions, backend)
+        report(args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import os
+import re
+
+from model_client import get_model
+
+# Follow-up context budget (override through environment variables / .env)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("BONEHEALTH_CONTEXT_BUDGET", "2000"))
+SUMMARY_SHARE = float(os.getenv("BONEHEALTH_CONTEXT_SUMMARY_SHARE", "0.6"))
+# "local" uses a character-based estimate; "model" asks the API's count_tokens
+TOKEN_COUNTER = os.getenv("BONEHEALTH_TOKEN_COUNTER", "local").lower()
+IMAGE_TOKENS = 258  # what the API bills for an attached image
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_HEADING = re.compile(r"^(?:#{1,6}\s|\*\*[^*]+\*\*:?$|__[^_]+__:?$)")  # markdown headings and bold-only lines
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token for English text)"""
+    return max(1, len(text) // 4) if text else 0
+
+
+def count_tokens(text, task=None):
+    """Counts tokens with the configured counter"""
+    if TOKEN_COUNTER == "model":
+        return get_model(task).count_tokens(text).total_tokens
+    return estimate_tokens(text)
+
+
+def _sections(analysis):
+    """Splits an analysis into (heading or None, [non-empty lines]) sections"""
+    sections = [(None, [])]
+    for block in analysis.split("\n"):
+        stripped = block.strip()
+        if not stripped:
+            continue
+        if _HEADING.match(stripped):
+            sections.append((stripped, []))
+        else:
+            sections[-1][1].append(stripped)
+    return [section for section in sections if section[0] is not None or section[1]]
+
+
+def compact_analysis(analysis, budget_tokens, counter=estimate_tokens):
+    """Shrinks an analysis to roughly budget_tokens, keeping its outline.
+
+    Every heading is kept and the rest of the budget goes round the sections in turn:
+    the first sentence of each section's first line, then of each second line, and so
+    on, and only then second sentences. Closing recommendations therefore survive
+    alongside the opening findings, and sentences are only cut when the budget is short.
+    """
+    if counter(analysis) <= budget_tokens:
+        return analysis
+
+    sections = _sections(analysis)
+    used = sum(counter(heading) + 1 for heading, _ in sections if heading)
+    sentences = [[_SENTENCE_END.split(line) for line in lines] for _, lines in sections]
+    kept = [[0] * len(lines) for lines in sentences]
+    order = sorted((depth, line, section) for section, lines in enumerate(sentences)
+                   for line, parts in enumerate(lines) for depth in range(len(parts)))
+    for depth, line, section in order:
+        # A line keeps a prefix of its sentences, so skip past one whose earlier sentence didn't fit
+        if kept[section][line] != depth:
+            continue
+        cost = counter(sentences[section][line][depth]) + 1
+        if used + cost <= budget_tokens:
+            kept[section][line] += 1
+            used += cost
+
+    output = []
+    for (heading, _), lines, counts in zip(sections, sentences, kept):
+        if heading:
+            output.append(heading)
+        output.extend(" ".join(parts[:count]) for parts, count in zip(lines, counts) if count)
+    return "\n".join(output)
+
+
+class ConversationContext:
+    """Token-budgeted context for follow-up questions about one analysis.
+
+    The analysis is compacted once; each follow-up then sends that summary plus
+    as many recent turns as fit, so input size stays flat as the chat grows.
+    """
+
+    def __init__(self, analysis, expertise_prompt, budget_tokens=CONTEXT_TOKEN_BUDGET, task=None):
+        self.budget_tokens = budget_tokens
+        self.task = task
+        self.summary = compact_analysis(analysis, int(budget_tokens * SUMMARY_SHARE), self._count)
+        self.preamble = (
+            "Answer the follow-up question based on the previous context. "
+            f"{expertise_prompt}\n\nAnalysis summary:\n{self.summary}"
+        )
+        self.preamble_tokens = self._count(self.preamble)
+
+    def _count(self, text):
+        return count_tokens(text, self.task)
+
+    def build_contents(self, turns, query, attachments=()):
+        """Returns multi-turn contents for generate_content.
+
+        turns is a list of (role, text) pairs, oldest first, with role "user" or "ai".
+        attachments (uploaded file handles) go in front of the analysis summary.
+        """
+        remaining = (self.budget_tokens - self.preamble_tokens - estimate_tokens(query)
+                     - IMAGE_TOKENS * len(attachments))
+        window = []
+        # Walk backwards so the newest turns win the budget; local estimates keep this cheap
+        for role, text in reversed(turns):
+            cost = estimate_tokens(text)
+            if cost > remaining:
+                break
+            window.append(("user" if role == "user" else "model", text))
+            remaining -= cost
+        window.reverse()
+
+        # Roles must alternate starting with the user; merge runs of the same role
+        while window and window[0][0] == "model":
+            window.pop(0)
+        contents = [{"role": "user", "parts": [*attachments, self.preamble]}]
+        for role, text in window + [("user", f"User Query: {query}")]:
+            if contents[-1]["role"] == role:
+                contents[-1]["parts"].append(text)
+            else:
+                contents.append({"role": role, "parts": [text]})
+        return contents
@@ -0,0 +1,251 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from metrics import span
+
+# Database settings (override through environment variables / .env)
+DB_PATH = os.getenv("BONEHEALTH_DB_PATH", "users.db")
+BUSY_TIMEOUT_MS = int(os.getenv("BONEHEALTH_DB_BUSY_TIMEOUT_MS", "5000"))
+POOL_SIZE = int(os.getenv("BONEHEALTH_DB_POOL_SIZE", "8"))
+STATEMENT_CACHE_SIZE = 128
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version.
+# Append new steps; never edit one that has shipped.
+MIGRATIONS = [
+    # 1: users table (matches the table created by earlier releases)
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE,
+        password TEXT,
+        user_type TEXT,
+        license_number TEXT,
+        specialization TEXT,
+        affiliation TEXT
+    );
+    """,
+    # 2: persisted analyses and chat turns, paged newest-first per user and task
+    """
+    CREATE TABLE IF NOT EXISTS analyses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        task TEXT NOT NULL,
+        user_type TEXT,
+        image_name TEXT,
+        image_hash TEXT,
+        response TEXT NOT NULL,
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_analyses_user_task_time ON analyses (username, task, created_at DESC);
+    CREATE TABLE IF NOT EXISTS chat_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        task TEXT NOT NULL,
+        analysis_id INTEGER REFERENCES analyses (id) ON DELETE SET NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_chat_messages_user_task_id ON chat_messages (username, task, id DESC);
+    """,
+    # 3: background analysis jobs
+    """
+    CREATE TABLE IF NOT EXISTS analysis_jobs (
+        id TEXT PRIMARY KEY,
+        username TEXT NOT NULL,
+        task TEXT NOT NULL,
+        user_type TEXT,
+        image_name TEXT,
+        status TEXT NOT NULL,
+        result TEXT,
+        error TEXT,
+        analysis_id INTEGER REFERENCES analyses (id) ON DELETE SET NULL,
+        delivered INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_analysis_jobs_user_task ON analysis_jobs (username, task, delivered, created_at);
+    CREATE INDEX IF NOT EXISTS idx_analysis_jobs_status ON analysis_jobs (status);
+    """,
+    # 4: perceptual hashes of analyzed images, split into bands for multi-index Hamming search
+    """
+    CREATE TABLE IF NOT EXISTS image_fingerprints (
+        analysis_id INTEGER PRIMARY KEY REFERENCES analyses (id) ON DELETE CASCADE,
+        task TEXT NOT NULL,
+        user_type TEXT,
+        model_name TEXT,
+        hash INTEGER NOT NULL,
+        band0 INTEGER NOT NULL,
+        band1 INTEGER NOT NULL,
+        band2 INTEGER NOT NULL,
+        band3 INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_image_fingerprints_band0 ON image_fingerprints (task, user_type, band0);
+    CREATE INDEX IF NOT EXISTS idx_image_fingerprints_band1 ON image_fingerprints (task, user_type, band1);
+    CREATE INDEX IF NOT EXISTS idx_image_fingerprints_band2 ON image_fingerprints (task, user_type, band2);
+    CREATE INDEX IF NOT EXISTS idx_image_fingerprints_band3 ON image_fingerprints (task, user_type, band3);
+    """,
+    # 5: versioned id of the compiled prompt each analysis was produced with
+    """
+    ALTER TABLE analyses ADD COLUMN prompt_id TEXT;
+    """,
+    # 6: the processed images an analysis saw, as a JSON list of [content hash, mime type]
+    """
+    ALTER TABLE analyses ADD COLUMN image_parts TEXT;
+    """,
+    # 7: hourly model usage per user, task and call type, plus optional per-user daily token quotas
+    """
+    CREATE TABLE IF NOT EXISTS model_usage (
+        bucket_start INTEGER NOT NULL,
+        username TEXT NOT NULL,
+        task TEXT NOT NULL,
+        user_type TEXT NOT NULL,
+        call TEXT NOT NULL,
+        calls INTEGER NOT NULL,
+        prompt_tokens INTEGER NOT NULL,
+        output_tokens INTEGER NOT NULL,
+        thinking_tokens INTEGER NOT NULL,
+        latency_seconds REAL NOT NULL,
+        max_latency_seconds REAL NOT NULL,
+        PRIMARY KEY (bucket_start, username, task, user_type, call)
+    );
+    CREATE INDEX IF NOT EXISTS idx_model_usage_user_time ON model_usage (username, bucket_start);
+    CREATE INDEX IF NOT EXISTS idx_model_usage_task_time ON model_usage (task, bucket_start);
+    ALTER TABLE users ADD COLUMN daily_token_quota INTEGER;
+    """,
+    # 8: key-value state shared by app processes (shared_state.SQLiteState) and the process running each job
+    """
+    CREATE TABLE IF NOT EXISTS shared_state (
+        key TEXT PRIMARY KEY,
+        value,
+        expires_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS idx_shared_state_expires ON shared_state (expires_at);
+    ALTER TABLE analysis_jobs ADD COLUMN worker TEXT;
+    """,
+    # 9: where a job was submitted from ('ui' or 'api'); only UI jobs are delivered into the chat
+    """
+    ALTER TABLE analysis_jobs ADD COLUMN source TEXT NOT NULL DEFAULT 'ui';
+    """,
+    # 10: 32x32 grayscale thumbnails that confirm a perceptual-hash match before an analysis is reused
+    """
+    ALTER TABLE image_fingerprints ADD COLUMN thumbnail BLOB;
+    """,
+    # 11: shared state moved to a database file of its own (shared_state.STATE_DB_PATH)
+    """
+    DROP TABLE IF EXISTS shared_state;
+    """,
+]
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _open(path):
+    # Pooled connections move between Streamlit script threads, but each one
+    # is only ever used by a single thread at a time.
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,  # prepared statements reused per connection
+    )
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA journal_mode=WAL")  # readers no longer block the writer
+    conn.execute("PRAGMA synchronous=NORMAL")  # safe with WAL, fsync only at checkpoints
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+
+def _statements(script):
+    """Splits a migration script into single statements; executescript would commit the open transaction"""
+    statements, current = [], ""
+    for line in script.splitlines(keepends=True):
+        current += line
+        if sqlite3.complete_statement(current):
+            statements.append(current.strip())
+            current = ""
+    return statements
+
+
+def migrate(conn, migrations=MIGRATIONS):
+    """Brings the schema up to the latest migration.
+
+    Each step takes the write lock with BEGIN IMMEDIATE and re-reads user_version
+    under it, so processes opening a fresh database together apply every step once.
+    """
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(migrations):
+                conn.rollback()
+                return
+            for statement in _statements(migrations[version]):
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version={version + 1}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+def _pool(path, migrations):
+    with _pools_lock:
+        pool = _pools.get(path)
+        if pool is None:
+            conn = _open(path)
+            migrate(conn, migrations)
+            pool = _pools[path] = queue.LifoQueue(maxsize=POOL_SIZE)
+            pool.put(conn)
+        return pool
+
+
+@contextmanager
+def connection(path=None, migrations=MIGRATIONS):
+    """Checks a connection out of the process-wide pool for the duration of a block.
+
+    Streamlit runs every rerun on a fresh thread, so a pool keeps connections
+    (and their prepared statements) alive across reruns where thread-locals would not.
+    path and migrations select another database file and its schema.
+    """
+    pool = _pool(path or DB_PATH, migrations)
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _open(path or DB_PATH)
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+# User accounts
+def authenticate(username, password):
+    """Returns the user's type for valid credentials, otherwise None"""
+    with span("authenticate"), connection() as conn:
+        user = conn.execute(
+            "SELECT user_type FROM users WHERE username=? AND password=?", (username, password)
+        ).fetchone()
+    return user[0] if user else None
+
+
+def register(username, password, user_type, license_number=None, specialization=None, affiliation=None):
+    """Creates an account; returns False if the username is taken"""
+    try:
+        with span("register"), connection() as conn, conn:
+            conn.execute(
+                "INSERT INTO users (username, password, user_type, license_number, specialization, affiliation) VALUES (?, ?, ?, ?, ?, ?)",
+                (username, password, user_type, license_number, specialization, affiliation),
+            )
+        return True
+    except sqlite3.IntegrityError:
+        return False
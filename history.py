@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+import time
+
+from db import connection
+
+# Chat messages rendered per page (override through .env)
+PAGE_SIZE = int(os.getenv("BONEHEALTH_HISTORY_PAGE_SIZE", "20"))
+
+
+def save_analysis(username, task, user_type, response, image_name=None, image_bytes=None, prompt_id=None,
+                  image_parts=None, conn=None):
+    """Stores an analysis result and returns its id.
+
+    prompt_id identifies the compiled prompt; image_parts lists the (content hash,
+    mime type) of each processed image the model saw. Pass conn to make the insert
+    part of the caller's transaction.
+    """
+    if conn is None:
+        with connection() as conn, conn:
+            return save_analysis(username, task, user_type, response, image_name, image_bytes, prompt_id,
+                                 image_parts, conn)
+    image_hash = hashlib.sha256(image_bytes).hexdigest() if image_bytes is not None else None
+    cursor = conn.execute(
+        "INSERT INTO analyses (username, task, user_type, image_name, image_hash, response, prompt_id, image_parts, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (username, task, user_type, image_name, image_hash, response, prompt_id,
+         json.dumps(image_parts) if image_parts else None, time.time()),
+    )
+    return cursor.lastrowid
+
+
+def save_message(username, task, role, content, analysis_id=None):
+    """Stores one chat turn and returns its id"""
+    with connection() as conn, conn:
+        cursor = conn.execute(
+            "INSERT INTO chat_messages (username, task, analysis_id, role, content, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (username, task, analysis_id, role, content, time.time()),
+        )
+        return cursor.lastrowid
+
+
+def load_messages(username, task, before_id=None, limit=PAGE_SIZE):
+    """Returns one page of chat messages, oldest first.
+
+    Pages are keyed on the message id (newest page when before_id is None),
+    so each page is a single index range scan regardless of history length.
+    """
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT id, role, content FROM chat_messages WHERE username=? AND task=? AND id < ? ORDER BY id DESC LIMIT ?",
+            (username, task, before_id if before_id is not None else 2 ** 63 - 1, limit),
+        ).fetchall()
+    return [{"id": row[0], "role": row[1], "content": row[2]} for row in reversed(rows)]
+
+
+def list_analyses(username, task, limit=10):
+    """Returns the most recent analyses for a user and task, newest first"""
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT id, image_name, created_at FROM analyses WHERE username=? AND task=? ORDER BY created_at DESC LIMIT ?",
+            (username, task, limit),
+        ).fetchall()
+    return [{"id": row[0], "image_name": row[1], "created_at": row[2]} for row in rows]
+
+
+def get_analysis(analysis_id, username):
+    """Returns a stored analysis owned by username, or None"""
+    with connection() as conn:
+        row = conn.execute(
+            "SELECT id, task, image_name, response, created_at, image_parts FROM analyses WHERE id=? AND username=?",
+            (analysis_id, username),
+        ).fetchone()
+    if row is None:
+        return None
+    return {"id": row[0], "task": row[1], "image_name": row[2], "response": row[3], "created_at": row[4],
+            "image_parts": [tuple(part) for part in json.loads(row[5])] if row[5] else []}
@@ -0,0 +1,128 @@
+import io
+import os
+
+# Output encoding (override through environment variables / .env)
+OUTPUT_FORMAT = os.getenv("BONEHEALTH_IMAGE_FORMAT", "JPEG").upper()
+OUTPUT_QUALITY = int(os.getenv("BONEHEALTH_IMAGE_QUALITY", "85"))
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+# Per-task limits: radiographs survive aggressive downscaling and carry no colour,
+# while stained biopsy slides need both colour and enough pixels to resolve cells.
+TASK_PROFILES = {
+    "Bone Fracture Detection": {"max_side": 1536, "grayscale": True},
+    "Bone Marrow Cell Classification": {"max_side": 2048, "grayscale": False},
+    "Knee Joint Osteoarthritis Detection": {"max_side": 1280, "grayscale": True},
+    "Osteoporosis Stage Prediction & BMD Score": {"max_side": 1280, "grayscale": True},
+    "Bone Age Detection": {"max_side": 1024, "grayscale": True},
+    "Cervical Spine Fracture Detection": {"max_side": 1536, "grayscale": True},
+    "Bone Tumor/Cancer Detection": {"max_side": 1536, "grayscale": False},
+    "Bone Infection (Osteomyelitis) Detection": {"max_side": 1536, "grayscale": False},
+}
+DEFAULT_PROFILE = {"max_side": 1536, "grayscale": False}
+
+
+def _pil():
+    """Imports Pillow on first use, so pages that never touch an image don't load it"""
+    from PIL import Image, ImageFile, ImageOps
+
+    # Prevent truncated image error
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+    return Image, ImageOps
+
+
+def _stretch_to_l(image):
+    """8-bit grayscale from an I or F image, stretched over its own value range"""
+    image = image.convert("F" if image.mode == "F" else "I")
+    low, high = image.getextrema()
+    scale = 255 / (high - low) if high > low else 0
+    return image.point(lambda v: v * scale - low * scale).convert("L")
+
+
+def _to_output_mode(image, grayscale):
+    """Converts any PIL mode into L or RGB for lossy encoding"""
+    if image.mode in ("I;16", "I;16B", "I;16L"):
+        # 16-bit radiographs: rescale instead of letting convert() clip
+        image = image.convert("I").point(lambda v: v * (1 / 256)).convert("L")
+    elif image.mode in ("I", "F"):
+        # 32-bit int and float images have no fixed range to rescale from
+        image = _stretch_to_l(image)
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        Image, _ = _pil()
+        background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    if grayscale:
+        return image.convert("L")
+    return image.convert("RGB") if image.mode != "L" else image
+
+
+def preprocess_image(data, task, mime_type="image/jpeg"):
+    """Downscales, re-encodes and strips metadata from an uploaded image.
+
+    Returns the image part for get_gemini_response and a dict of size stats.
+    """
+    Image, ImageOps = _pil()
+    profile = TASK_PROFILES.get(task, DEFAULT_PROFILE)
+    image = Image.open(io.BytesIO(data))
+    original_size = image.size
+    has_metadata = bool(image.info.get("exif") or image.getexif())
+
+    # Apply the EXIF orientation before the metadata is dropped
+    image = ImageOps.exif_transpose(image)
+    image = _to_output_mode(image, profile["grayscale"])
+
+    resized = max(image.size) > profile["max_side"]
+    if resized:
+        image.thumbnail((profile["max_side"], profile["max_side"]), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    save_kwargs = {"quality": OUTPUT_QUALITY} if OUTPUT_FORMAT in ("JPEG", "WEBP") else {}
+    if OUTPUT_FORMAT == "JPEG":
+        save_kwargs["optimize"] = True
+    # No exif= argument, so the encoder writes a metadata-free file
+    image.save(buffer, format=OUTPUT_FORMAT, **save_kwargs)
+    processed = buffer.getvalue()
+
+    # Re-encoding an already small, clean file can make it bigger; keep the original then
+    if len(processed) >= len(data) and not resized and not has_metadata:
+        processed, out_mime = data, mime_type
+    else:
+        out_mime = MIME_TYPES.get(OUTPUT_FORMAT, "image/jpeg")
+
+    stats = {
+        "original_bytes": len(data),
+        "processed_bytes": len(processed),
+        "original_size": original_size,
+        "processed_size": image.size,
+        "grayscale": profile["grayscale"],
+    }
+    return {"mime_type": out_mime, "data": processed}, stats
+
+
+PREVIEW_MAX_SIDE = 700  # 2x the 350px preview width, for high-DPI screens
+
+
+def make_preview(data, max_side=PREVIEW_MAX_SIDE):
+    """Decodes a reduced-size preview and returns it as JPEG bytes"""
+    Image, ImageOps = _pil()
+    image = Image.open(io.BytesIO(data))
+    if image.format == "JPEG":
+        # Let libjpeg decode at 1/2, 1/4 or 1/8 scale instead of full resolution
+        image.draft(image.mode, (max_side, max_side))
+    image = ImageOps.exif_transpose(image)
+    image = _to_output_mode(image, grayscale=False)
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=80)
+    return buffer.getvalue()
+
+
+def format_bytes(num_bytes):
+    """Human-readable byte count for captions"""
+    for unit in ("B", "KB", "MB"):
+        if num_bytes < 1024:
+            return f"{num_bytes:.0f} {unit}" if unit == "B" else f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} GB"
@@ -0,0 +1,140 @@
+import hashlib
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+
+from metrics import CallbackGauge, register
+
+# Follow-up answer cache size (override through .env)
+ANSWER_CACHE_ENTRIES = int(os.getenv("BONEHEALTH_ANSWER_CACHE_ENTRIES", "2048"))
+
+GREETING_RESPONSE = "😊 Hello! How can I assist you further today?"
+APPRECIATION_RESPONSE = "🙏 You're very welcome! I'm here to help. Is there anything else I can assist you with?"
+IRRELEVANT_RESPONSE = "⚠️ Please ask questions related to the medical image analysis for the best results. 🩺"
+
+irrelevant_keywords = ["pm", "president", "capital", "weather", "politics", "sports"]
+greeting_keywords = ["hi", "hello", "hey", "good morning", "good afternoon", "good evening"]
+appreciation_keywords = ["thank you", "thanks", "great work", "well done", "appreciate", "good job"]
+
+# Words that may surround a thank-you without making it a question
+courtesy_words = {"a", "again", "all", "and", "awesome", "doc", "doctor", "for", "good", "great", "help", "it",
+                  "lot", "much", "nice", "ok", "okay", "perfect", "really", "so", "that", "the", "this", "very",
+                  "you", "your"}
+# Any of these makes a message about the analysis, whatever off-topic keyword it also contains
+domain_words = ["analysis", "arthritis", "bone", "bones", "calcium", "ct", "density", "diagnosis", "exercise",
+                "fracture", "fractures", "healing", "hip", "image", "injury", "joint", "knee", "medication", "mri",
+                "osteoporosis", "pain", "recovery", "report", "result", "scan", "spine", "surgery", "swelling",
+                "symptom", "symptoms", "treatment", "vitamin", "wrist", "x ray", "xray"]
+# Follow-ups that lean on the conversation so far; the same words can need a different answer next time
+referential_words = {"above", "again", "earlier", "else", "it", "its", "more", "previous", "same", "that", "them",
+                     "these", "they", "this", "those"}
+MIN_CACHED_WORDS = 4
+
+
+def _alternatives(keywords):
+    # Longest first, and any run of whitespace between the words of a phrase
+    return "|".join(r"\s+".join(map(re.escape, k.split())) for k in sorted(keywords, key=len, reverse=True))
+
+
+def _keyword_pattern(keywords):
+    # Word boundaries so "pm" no longer matches inside "symptoms"
+    return re.compile(rf"\b(?:{_alternatives(keywords)})\b", re.IGNORECASE)
+
+
+# Compiled once per process. Greetings must be the whole message, as before.
+GREETING_RE = re.compile(rf"^\s*(?:{_alternatives(greeting_keywords)})\s*[!.,]*\s*$", re.IGNORECASE)
+APPRECIATION_RE = _keyword_pattern(appreciation_keywords)
+IRRELEVANT_RE = _keyword_pattern(irrelevant_keywords)
+DOMAIN_RE = _keyword_pattern(domain_words)
+CLOCK_TIME_RE = re.compile(r"\b\d{1,2}(?::\d{2})?\s*(?:am|pm)\b", re.IGNORECASE)  # "8 pm" is a time, not a prime minister
+_NON_WORD = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_question(query):
+    """Lower-cases and strips punctuation/extra spaces so trivial variants share a cache entry"""
+    return _SPACES.sub(" ", _NON_WORD.sub(" ", query.lower())).strip()
+
+
+def is_only_thanks(query):
+    """True when the message is a thank-you and nothing more"""
+    if not APPRECIATION_RE.search(query):
+        return False
+    rest = normalize_question(APPRECIATION_RE.sub(" ", query)).split()
+    return all(word in courtesy_words for word in rest)
+
+
+def is_off_topic(query):
+    """True when the message has an off-topic keyword and nothing about the analysis"""
+    return bool(IRRELEVANT_RE.search(CLOCK_TIME_RE.sub(" ", query))) and not DOMAIN_RE.search(normalize_question(query))
+
+
+def is_cacheable(query):
+    """Whether a question means the same thing wherever it comes in a conversation"""
+    words = normalize_question(query).split()
+    return len(words) >= MIN_CACHED_WORDS and not referential_words.intersection(words)
+
+
+def analysis_fingerprint(analysis, user_type=""):
+    """Stable key for the analysis (and audience) a follow-up refers to"""
+    return hashlib.sha256(f"{user_type}\0{analysis}".encode("utf-8")).hexdigest()
+
+
+class IntentRouter:
+    """Answers canned and repeated follow-ups locally before they reach the model"""
+
+    def __init__(self, max_answers=ANSWER_CACHE_ENTRIES):
+        self.max_answers = max_answers
+        self._answers = OrderedDict()  # (analysis fingerprint, normalized question) -> answer
+        self._lock = threading.Lock()
+        self.counts = Counter()
+
+    def route(self, query, analysis_key=None):
+        """Returns (route, response); response is None when the model must answer"""
+        if GREETING_RE.match(query):
+            route, response = "greeting", GREETING_RESPONSE
+        elif is_only_thanks(query):
+            route, response = "appreciation", APPRECIATION_RESPONSE
+        elif is_off_topic(query):
+            route, response = "irrelevant", IRRELEVANT_RESPONSE
+        else:
+            route, response = "model", None
+            if analysis_key is not None and is_cacheable(query):
+                key = (analysis_key, normalize_question(query))
+                with self._lock:
+                    cached = self._answers.get(key)
+                    if cached is not None:
+                        self._answers.move_to_end(key)
+                        route, response = "answer_cache", cached
+
+        with self._lock:
+            self.counts[route] += 1
+        return route, response
+
+    def remember(self, analysis_key, query, answer):
+        """Caches a model answer for repeats of the same question on the same analysis"""
+        if not is_cacheable(query):
+            return
+        key = (analysis_key, normalize_question(query))
+        with self._lock:
+            self._answers[key] = answer
+            self._answers.move_to_end(key)
+            while len(self._answers) > self.max_answers:
+                self._answers.popitem(last=False)
+
+    def stats(self):
+        """Route counters plus the share of queries that never reached the model"""
+        with self._lock:
+            counts = dict(self.counts)
+        total = sum(counts.values())
+        local = total - counts.get("model", 0)
+        return {"routes": counts, "total": total, "local_share": local / total if total else 0.0}
+
+
+# Process-wide instance shared by all sessions
+intent_router = IntentRouter()
+register(CallbackGauge(
+    "bonehealth_chat_routes", "Follow-up queries by route (everything except 'model' was answered locally)",
+    lambda: {(("route", k),): v for k, v in intent_router.stats()["routes"].items()},
+))
@@ -0,0 +1,265 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from analysis import stream_gemini_response
+from db import connection
+from history import save_analysis
+from metrics import span
+from model_client import model_name_for
+from near_duplicates import NEAR_DUP_DISABLED, fingerprint, find_near_duplicate, index_fingerprint, reuse_note
+from prompts import prompt_for
+from series import is_series, prepare_upload
+from session_memory import store_bytes
+from shared_state import PROCESS_ID, state
+from usage_ledger import QuotaExceeded
+
+# Total analyses running at once across all sessions in this process (override through .env)
+JOB_WORKERS = int(os.getenv("BONEHEALTH_JOB_WORKERS", "8"))
+# Finished jobs are dropped from memory after this long; their rows stay in the database
+JOB_MEMORY_TTL = float(os.getenv("BONEHEALTH_JOB_MEMORY_TTL", "3600"))
+# Other app processes see a running job's partial output this often
+PROGRESS_INTERVAL = float(os.getenv("BONEHEALTH_JOB_PROGRESS_INTERVAL", "1"))
+PROGRESS_TTL = 600
+HEARTBEAT_SECONDS = 10
+WORKER_TTL = 3 * HEARTBEAT_SECONDS  # jobs of a process silent for this long are failed
+
+ACTIVE_STATUSES = ("queued", "running")
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="analysis-job")
+_jobs = {}  # job id -> _Job, for live progress and cancellation
+_jobs_lock = threading.Lock()
+
+
+class _Job:
+    def __init__(self, job_id):
+        self.id = job_id
+        self.partial = []  # streamed chunks so far
+        self.cancelled = threading.Event()
+        self.future = None
+        self.finished_at = None
+        self.upload_stats = None  # preprocessing byte counts, once known
+        self.published_at = 0.0
+
+
+def _update(job_id, **fields):
+    fields["updated_at"] = time.time()
+    assignments = ", ".join(f"{name}=?" for name in fields)
+    with connection() as conn, conn:
+        conn.execute(f"UPDATE analysis_jobs SET {assignments} WHERE id=?", (*fields.values(), job_id))
+
+
+def _finish(job_id, **fields):
+    """Moves a job out of queued/running; returns False if cancel() (or anything else) got there first"""
+    fields["updated_at"] = time.time()
+    assignments = ", ".join(f"{name}=?" for name in fields)
+    with connection() as conn, conn:
+        return conn.execute(
+            f"UPDATE analysis_jobs SET {assignments} WHERE id=? AND status IN ('queued', 'running')",
+            (*fields.values(), job_id),
+        ).rowcount > 0
+
+
+def _row_to_dict(row):
+    keys = ("id", "username", "task", "user_type", "image_name", "status", "result", "error",
+            "analysis_id", "delivered", "created_at", "updated_at")
+    return dict(zip(keys, row))
+
+
+def _publish(job):
+    """Shares the job's partial output and picks up cancellations made in other processes"""
+    now = time.monotonic()
+    if now - job.published_at < PROGRESS_INTERVAL:
+        return
+    job.published_at = now
+    try:
+        state.set(f"job:{job.id}:partial", "".join(job.partial), ttl=PROGRESS_TTL)
+        if state.get(f"job:{job.id}:cancel") is not None:
+            job.cancelled.set()
+    except Exception:
+        pass  # progress is best effort; the result itself goes to the database
+
+
+def _prune():
+    now = time.time()
+    with _jobs_lock:
+        for job_id in [j.id for j in _jobs.values() if j.finished_at and now - j.finished_at > JOB_MEMORY_TTL]:
+            del _jobs[job_id]
+
+
+def _run(job, username, task, user_type, image_name, image_bytes, mime_type, use_cache):
+    try:
+        if job.cancelled.is_set():
+            return
+        with connection() as conn, conn:
+            started = conn.execute("UPDATE analysis_jobs SET status='running', updated_at=? WHERE id=? AND status='queued'",
+                                   (time.time(), job.id)).rowcount
+        if not started:
+            return  # cancelled from another process before a worker picked it up
+        prompt = prompt_for(task, user_type)
+        with span("analysis_job", task=task):
+            # CT/MRI series become a few montages of representative slices
+            image_parts, job.upload_stats, series_note = prepare_upload(image_bytes, image_name, task, mime_type)
+            # Kept by content hash so follow-up questions can attach the same images
+            stored_parts = [(store_bytes(part["data"]), part["mime_type"]) for part in image_parts]
+
+            image_fingerprint = match = None
+            if not NEAR_DUP_DISABLED and not is_series(image_name):
+                # Re-compressed, rescaled or re-screenshotted uploads reuse the user's earlier analysis
+                image_fingerprint = fingerprint(image_bytes)
+                if use_cache:
+                    match = find_near_duplicate(image_fingerprint, username, task, user_type,
+                                                model_name_for(task), prompt.id)
+
+            if match is not None:
+                job.partial.append(reuse_note(match) + match["response"])
+            else:
+                chunks = stream_gemini_response(prompt.text, user_type, image_parts, series_note,
+                                                use_cache=use_cache, task=task, username=username)
+                for chunk in chunks:
+                    if job.cancelled.is_set():
+                        chunks.close()
+                        break
+                    job.partial.append(chunk)
+                    _publish(job)
+
+        if job.cancelled.is_set():
+            _finish(job.id, status="cancelled")
+            return
+        result = "".join(job.partial)
+        with connection() as conn, conn:
+            # A cancel() that landed while the model was streaming wins: nothing is saved, indexed or delivered
+            done = conn.execute(
+                "UPDATE analysis_jobs SET status='done', result=?, updated_at=? WHERE id=? AND status='running'",
+                (result, time.time(), job.id),
+            ).rowcount
+            if done:
+                # Persist to history here so the result survives even if the session is gone
+                analysis_id = save_analysis(username, task, user_type, result, image_name, image_bytes, prompt.id,
+                                            stored_parts, conn=conn)
+                conn.execute("UPDATE analysis_jobs SET analysis_id=? WHERE id=?", (analysis_id, job.id))
+        if done and image_fingerprint is not None and match is None:
+            index_fingerprint(analysis_id, image_fingerprint, task, user_type, model_name_for(task))
+    except Exception as exc:
+        _finish(job.id, status="failed", error=str(exc) if isinstance(exc, QuotaExceeded) else f"{type(exc).__name__}: {exc}")
+    finally:
+        job.finished_at = time.time()
+        try:
+            state.delete(f"job:{job.id}:partial")
+        except Exception:
+            pass
+
+
+def submit_analysis(username, task, user_type, image_name, image_bytes, mime_type, use_cache=True, source="ui"):
+    """Queues an image analysis on the shared worker pool and returns its job id"""
+    _prune()
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with connection() as conn, conn:
+        conn.execute(
+            "INSERT INTO analysis_jobs (id, username, task, user_type, image_name, status, worker, source, created_at, updated_at) VALUES (?, ?, ?, ?, ?, 'queued', ?, ?, ?, ?)",
+            (job_id, username, task, user_type, image_name, PROCESS_ID, source, now, now),
+        )
+    job = _Job(job_id)
+    with _jobs_lock:
+        _jobs[job_id] = job
+    job.future = _executor.submit(_run, job, username, task, user_type, image_name, image_bytes, mime_type, use_cache)
+    return job_id
+
+
+def cancel(job_id):
+    """Cancels a queued or running job; a model call already in flight is abandoned, not interrupted"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is not None:
+        job.cancelled.set()
+        if job.future is not None and job.future.cancel():
+            job.finished_at = time.time()
+    else:
+        # Running in another process; it checks for this flag as it streams
+        state.set(f"job:{job_id}:cancel", "1", ttl=PROGRESS_TTL)
+    with connection() as conn, conn:
+        conn.execute(
+            "UPDATE analysis_jobs SET status='cancelled', updated_at=? WHERE id=? AND status IN ('queued', 'running')",
+            (time.time(), job_id),
+        )
+
+
+def get_job(job_id):
+    """Returns the job's row as a dict (with 'partial' text while running), or None"""
+    with connection() as conn:
+        row = conn.execute("SELECT * FROM analysis_jobs WHERE id=?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = _row_to_dict(row)
+    with _jobs_lock:
+        live = _jobs.get(job_id)
+    if live is not None:
+        job["partial"] = "".join(live.partial)
+    elif job["status"] in ACTIVE_STATUSES:
+        job["partial"] = state.get(f"job:{job_id}:partial") or ""  # running in another process
+    else:
+        job["partial"] = ""
+    job["upload_stats"] = live.upload_stats if live is not None else None
+    return job
+
+
+def undelivered_jobs(username, task):
+    """Jobs for a user and task whose results haven't been shown yet, oldest first"""
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT id FROM analysis_jobs WHERE username=? AND task=? AND delivered=0 AND status != 'cancelled' AND source='ui' ORDER BY created_at",
+            (username, task),
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
+def active_job_count(username):
+    """Queued and running jobs of a user, across all app processes"""
+    with connection() as conn:
+        return conn.execute(
+            "SELECT COUNT(*) FROM analysis_jobs WHERE username=? AND status IN ('queued', 'running')", (username,)
+        ).fetchone()[0]
+
+
+def mark_delivered(job_id):
+    """Records that the job's result was shown to the user"""
+    _update(job_id, delivered=1)
+
+
+def _recover_interrupted():
+    # Jobs queued or running in a process that stopped heartbeating will never finish
+    with connection() as conn:
+        workers = [row[0] for row in conn.execute(
+            "SELECT DISTINCT worker FROM analysis_jobs WHERE status IN ('queued', 'running')")]
+    dead = [worker for worker in workers
+            if worker != PROCESS_ID and (worker is None or state.get(f"worker:{worker}") is None)]
+    if not dead:
+        return
+    with connection() as conn, conn:
+        conn.executemany(
+            "UPDATE analysis_jobs SET status='failed', error='Interrupted by a server restart', updated_at=? WHERE status IN ('queued', 'running') AND worker IS ?",
+            [(time.time(), worker) for worker in dead],
+        )
+
+
+def _heartbeat():
+    state.set(f"worker:{PROCESS_ID}", "1", ttl=WORKER_TTL)
+    _recover_interrupted()
+    state.purge_expired()
+
+
+def _heartbeat_forever():
+    while True:
+        time.sleep(HEARTBEAT_SECONDS)
+        try:
+            _heartbeat()
+        except Exception:
+            pass  # a missed beat is retried; WORKER_TTL allows for a few
+
+
+# Announce this process before looking for jobs other processes abandoned
+_heartbeat()
+threading.Thread(target=_heartbeat_forever, name="job-heartbeat", daemon=True).start()
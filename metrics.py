@@ -0,0 +1,225 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Export settings (override through environment variables / .env)
+METRICS_PORT = int(os.getenv("BONEHEALTH_METRICS_PORT", "0"))  # 0 = no HTTP endpoint
+METRICS_FILE = os.getenv("BONEHEALTH_METRICS_FILE", "")  # Prometheus text file, e.g. for node_exporter
+METRICS_FILE_INTERVAL = float(os.getenv("BONEHEALTH_METRICS_FILE_INTERVAL", "15"))
+METRICS_LOG = os.getenv("BONEHEALTH_METRICS_LOG", "").lower() in ("1", "true", "yes")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+logger = logging.getLogger("bonehealth.metrics")
+
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name, self.help_text = name, help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name, self.help_text = name, help_text
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _labels_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.setdefault(key, [0] * (len(self.buckets) + 2))
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def quantile(self, q, **labels):
+        """Bucket-interpolated quantile, the same estimate histogram_quantile() gives"""
+        with self._lock:
+            series = self._series.get(_labels_key(labels))
+            if not series or not series[-1]:
+                return None
+            counts, total = series[:len(self.buckets)], series[-1]
+        rank, cumulative, lower = q * total, 0, 0.0
+        for bound, count in zip(self.buckets, counts):
+            if count and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return self.buckets[-1]
+
+    def quantiles(self, qs):
+        """{labels + quantile label: estimate} for every series, for a CallbackGauge"""
+        with self._lock:
+            keys = list(self._series)
+        return {key + (("quantile", repr(q)),): self.quantile(q, **dict(key)) for key in keys for q in qs}
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(key, [('le', repr(float(bound)))])} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {series[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+
+class CallbackGauge:
+    """Gauge whose values are read from a callback at scrape time"""
+
+    def __init__(self, name, help_text, callback):
+        self.name, self.help_text = name, help_text
+        self.callback = callback  # returns {label dict as tuple of pairs: value} or a number
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+# Metric families
+stage_seconds = Histogram("bonehealth_stage_seconds", "Time spent per request stage")
+stage_errors = Counter("bonehealth_stage_errors_total", "Stages that raised an exception")
+model_tokens = Counter("bonehealth_model_tokens_total", "Model tokens by kind (prompt, output, thinking)")
+# p50/p95 precomputed for the text file and for reading /metrics without a Prometheus server
+stage_quantiles = CallbackGauge("bonehealth_stage_seconds_quantile", "Estimated time per request stage (p50, p95)",
+                                lambda: stage_seconds.quantiles((0.5, 0.95)))
+REGISTRY = [stage_seconds, stage_quantiles, stage_errors, model_tokens]
+
+
+def register(metric):
+    """Adds a metric family to the exported registry"""
+    REGISTRY.append(metric)
+    return metric
+
+
+@contextmanager
+def span(stage, **labels):
+    """Times a block into bonehealth_stage_seconds{stage=...} and emits a structured log line"""
+    started = time.perf_counter()
+    error = None
+    try:
+        yield labels
+    except BaseException as exc:
+        error = type(exc).__name__
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage=stage, **labels)
+        if error and error not in ("StopException", "RerunException", "GeneratorExit"):  # control flow, not failures
+            stage_errors.inc(stage=stage, error=error, **labels)
+        if METRICS_LOG:
+            logger.info(json.dumps({"event": "span", "stage": stage, "seconds": round(elapsed, 6),
+                                    "error": error, **{k: v for k, v in labels.items() if v is not None}}))
+
+
+def record_usage(usage, **labels):
+    """Adds a response's usage_metadata token counts to bonehealth_model_tokens_total"""
+    if usage is None:
+        return
+    for kind, field in (("prompt", "prompt_token_count"), ("output", "candidates_token_count"),
+                        ("thinking", "thoughts_token_count")):
+        value = getattr(usage, field, 0) or 0
+        if value:
+            model_tokens.inc(value, kind=kind, **labels)
+
+
+def exposition():
+    """Prometheus text exposition of every registered metric"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = exposition().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _write_file_forever(path, interval):
+    while True:
+        time.sleep(interval)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(exposition())
+        os.replace(tmp_path, path)  # scrapers never see a half-written file
+
+
+_exporters_started = False
+_exporters_lock = threading.Lock()
+
+
+def start_exporters():
+    """Starts the configured HTTP endpoint / file writer once per process"""
+    global _exporters_started
+    with _exporters_lock:
+        if _exporters_started:
+            return
+        _exporters_started = True
+    if METRICS_LOG and not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+    if METRICS_PORT:
+        server = ThreadingHTTPServer(("0.0.0.0", METRICS_PORT), _MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    if METRICS_FILE:
+        threading.Thread(target=_write_file_forever, args=(METRICS_FILE, METRICS_FILE_INTERVAL),
+                         name="metrics-file", daemon=True).start()
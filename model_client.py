@@ -0,0 +1,88 @@
+import io
+import json
+import os
+import threading
+
+import settings  # noqa: F401  (loads .env)
+
+# Model settings (override through environment variables / .env)
+DEFAULT_MODEL_NAME = os.getenv("BONEHEALTH_MODEL", "gemini-2.0-flash-thinking-exp-01-21")
+# JSON object mapping task name -> model name, e.g. {"Bone Age Detection": "gemini-2.0-flash"}
+MODEL_OVERRIDES = json.loads(os.getenv("BONEHEALTH_MODEL_OVERRIDES", "{}") or "{}")
+REQUEST_TIMEOUT = float(os.getenv("BONEHEALTH_REQUEST_TIMEOUT", "120"))
+
+
+def _generation_config():
+    """Collects the generation settings that are set in the environment"""
+    config = {}
+    for key, env, cast in (
+        ("temperature", "BONEHEALTH_TEMPERATURE", float),
+        ("top_p", "BONEHEALTH_TOP_P", float),
+        ("max_output_tokens", "BONEHEALTH_MAX_OUTPUT_TOKENS", int),
+    ):
+        value = os.getenv(env)
+        if value:
+            config[key] = cast(value)
+    return config
+
+
+GENERATION_CONFIG = _generation_config()
+
+# Process-wide registry. Streamlit re-executes only the main script on each
+# rerun, so handles stored in this imported module are shared by all sessions.
+_models = {}
+_lock = threading.Lock()
+_configured = False
+
+
+def _sdk():
+    # The Gemini SDK is the slowest import in the app; load it on the first model call
+    import google.generativeai as genai
+    return genai
+
+
+def configure():
+    """Configures the Gemini SDK once per process"""
+    global _configured
+    with _lock:
+        if not _configured:
+            _sdk().configure(api_key=os.getenv("GOOGLE_API_KEY"))
+            _configured = True
+
+
+def model_name_for(task=None):
+    """Returns the model name configured for a task"""
+    return MODEL_OVERRIDES.get(task, DEFAULT_MODEL_NAME)
+
+
+def get_model(task=None, user_type=None):
+    """Returns the shared GenerativeModel handle for a (task, user type) pair"""
+    key = (task, user_type)
+    model = _models.get(key)
+    if model is not None:
+        return model
+
+    configure()
+    with _lock:
+        model = _models.get(key)
+        if model is None:
+            model = _sdk().GenerativeModel(model_name_for(task), generation_config=GENERATION_CONFIG or None)
+            _models[key] = model
+    return model
+
+
+def upload_file(data, mime_type, display_name=None):
+    """Uploads bytes through the Gemini file API and returns the file handle"""
+    configure()
+    return _sdk().upload_file(path=io.BytesIO(data), mime_type=mime_type, display_name=display_name)
+
+
+def delete_file(name):
+    """Deletes an uploaded file from the Gemini file API"""
+    configure()
+    _sdk().delete_file(name)
+
+
+def request_options():
+    """Per-call options (timeouts) passed to generate_content"""
+    return {"timeout": REQUEST_TIMEOUT}
@@ -0,0 +1,113 @@
+"""File API handles for analyzed images, so follow-up questions can look at the image again.
+
+Each image is uploaded once per content hash. Every session and turn that asks about
+it shares the handle until shortly before the file service expires it.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import Counter, register, span
+from model_client import delete_file, upload_file
+from request_layer import guarded_call
+from session_memory import read_bytes
+
+# Follow-up grounding (override through environment variables / .env)
+FOLLOWUP_IMAGES = int(os.getenv("BONEHEALTH_FOLLOWUP_IMAGES", "4"))  # images attached per follow-up; 0 = text only
+FILE_TTL = float(os.getenv("BONEHEALTH_MODEL_FILE_TTL", str(47 * 3600)))  # the service keeps files for 48 hours
+REFRESH_MARGIN = 600  # re-upload rather than hand out a handle about to expire
+
+file_events = register(Counter("bonehealth_model_file_events_total",
+                               "Model file API handle events (hit, upload, expired, unavailable)"))
+
+
+def _expiry(handle, now):
+    # Trust the service's expiration_time when it has one, but never keep a handle past FILE_TTL
+    expires = getattr(handle, "expiration_time", None)
+    timestamp = expires.timestamp() if hasattr(expires, "timestamp") else None
+    return min(now + FILE_TTL, timestamp) if timestamp else now + FILE_TTL
+
+
+class FileHandleCache:
+    """Process-wide content hash -> uploaded file handle map with expiry"""
+
+    def __init__(self):
+        self._entries = {}  # digest -> (handle, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, digest, mime_type):
+        """Returns a live handle for the image, uploading it if needed, or None if its bytes are gone"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(digest)
+        if entry is not None and entry[1] - REFRESH_MARGIN > now:
+            file_events.inc(event="hit")
+            return entry[0]
+
+        try:
+            data = read_bytes(digest)
+        except FileNotFoundError:
+            file_events.inc(event="unavailable")
+            return None
+        with span("model_file_upload"):
+            # Sessions asking for the same image at once share one upload
+            handle = guarded_call(lambda: upload_file(data, mime_type, display_name=digest[:16]), key=f"upload:{digest}")
+        file_events.inc(event="upload")
+        with self._lock:
+            self._entries[digest] = (handle, _expiry(handle, time.time()))
+        if entry is not None:
+            self._delete_quietly(entry[0])
+        return handle
+
+    def forget(self, digests):
+        """Drops handles the service rejected, so the next turn uploads again"""
+        with self._lock:
+            for digest in digests:
+                self._entries.pop(digest, None)
+
+    def sweep(self):
+        """Deletes expired handles locally and, best effort, on the service"""
+        now = time.time()
+        with self._lock:
+            expired = [digest for digest, (_, expires_at) in self._entries.items() if expires_at <= now]
+            handles = [self._entries.pop(digest)[0] for digest in expired]
+        for handle in handles:
+            file_events.inc(event="expired")
+            self._delete_quietly(handle)
+
+    @staticmethod
+    def _delete_quietly(handle):
+        try:
+            delete_file(handle.name)
+        except Exception:
+            pass  # the service expires files on its own anyway
+
+
+# Process-wide instance; Streamlit reruns the script but keeps imported modules
+file_handles = FileHandleCache()
+_prefetcher = ThreadPoolExecutor(max_workers=2, thread_name_prefix="model-file-upload")
+
+
+def attachments_for(image_parts):
+    """File handles for an analysis's images, a list of (digest, mime type); at most the last FOLLOWUP_IMAGES"""
+    if FOLLOWUP_IMAGES <= 0:
+        return []
+    file_handles.sweep()
+    handles = []
+    for digest, mime_type in image_parts[-FOLLOWUP_IMAGES:]:
+        try:
+            handle = file_handles.get(digest, mime_type)
+        except Exception:
+            # A failed upload shouldn't block the question; answer from the text context instead
+            file_events.inc(event="unavailable")
+            handle = None
+        if handle is not None:
+            handles.append(handle)
+    return handles
+
+
+def prefetch(image_parts):
+    """Starts uploading an analysis's images in the background, ahead of the first follow-up"""
+    if FOLLOWUP_IMAGES > 0 and image_parts:
+        _prefetcher.submit(attachments_for, image_parts)
@@ -0,0 +1,139 @@
+"""Perceptual-hash index for spotting re-uploads of an already analyzed image.
+
+Each image gets a 64-bit difference hash (dHash), which survives re-compression,
+rescaling and screenshots. Lookups use multi-index hashing: the hash is split
+into four 16-bit bands stored in indexed columns, and any hash within Hamming
+distance d of the query must match one band to within d // 4 bits. A lookup is
+a handful of index probes no matter how large the table grows.
+
+A 64-bit hash cannot tell apart films of the same anatomy from different
+patients (e.g. bone-age hand films), so candidates are confirmed by correlating
+32x32 thumbnails, and only the uploading user's own analyses are considered.
+"""
+import io
+import itertools
+import os
+
+from db import connection
+from image_prep import _pil
+from metrics import Counter, register
+
+# Largest Hamming distance (of 64 bits) for a candidate, and the thumbnail correlation
+# that confirms it is the same image (override through .env)
+MAX_DISTANCE = min(int(os.getenv("BONEHEALTH_NEAR_DUP_DISTANCE", "6")), 11)
+MIN_CORRELATION = float(os.getenv("BONEHEALTH_NEAR_DUP_MIN_CORRELATION", "0.995"))
+THUMB_SIDE = 32
+NEAR_DUP_DISABLED = os.getenv("BONEHEALTH_NEAR_DUP_DISABLED", "").lower() in ("1", "true", "yes")
+
+BANDS = 4
+BAND_BITS = 16
+BAND_MASK = (1 << BAND_BITS) - 1
+
+near_dup_lookups = register(Counter("bonehealth_near_duplicate_lookups_total",
+                                    "Perceptual-hash lookups before an image analysis, by outcome (hit, miss, rejected)"))
+
+
+def fingerprint(image_bytes):
+    """Returns (64-bit difference hash, 32x32 grayscale thumbnail bytes) for an image.
+
+    The hash records whether each pixel is brighter than its right neighbour on a 9x8 thumbnail.
+    """
+    Image, ImageOps = _pil()
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.draft("L", (128, 128))  # JPEGs decode at reduced scale; nothing here needs more
+        gray = ImageOps.exif_transpose(image).convert("L")
+    pixels = list(gray.resize((9, 8), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value, gray.resize((THUMB_SIDE, THUMB_SIDE), Image.LANCZOS).tobytes()
+
+
+def _correlation(a, b):
+    """Pearson correlation of two thumbnails; insensitive to exposure and contrast changes"""
+    n = len(a)
+    mean_a, mean_b = sum(a) / n, sum(b) / n
+    cov = sum((x - mean_a) * (y - mean_b) for x, y in zip(a, b))
+    var_a = sum((x - mean_a) ** 2 for x in a)
+    var_b = sum((y - mean_b) ** 2 for y in b)
+    return cov / (var_a * var_b) ** 0.5 if var_a and var_b else float(a == b)
+
+
+def _bands(value):
+    return [(value >> (BAND_BITS * i)) & BAND_MASK for i in range(BANDS)]
+
+
+def _signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _band_variants(band, radius):
+    """Every band value within radius bits of band"""
+    variants = [band]
+    for flips in range(1, radius + 1):
+        for bits in itertools.combinations(range(BAND_BITS), flips):
+            flipped = band
+            for bit in bits:
+                flipped ^= 1 << bit
+            variants.append(flipped)
+    return variants
+
+
+def find_near_duplicate(fingerprint, username, task, user_type, model_name, prompt_id, max_distance=MAX_DISTANCE):
+    """Returns the closest earlier analysis of the same image by the same user, or None.
+
+    fingerprint is what fingerprint() returned. Only analyses made with the same
+    model and compiled prompt are considered. The result has the analysis id, its
+    response, its image name and the Hamming distance.
+    """
+    value, thumbnail = fingerprint
+    radius = max_distance // BANDS
+    candidates = {}
+    with connection() as conn:
+        for i, band in enumerate(_bands(value)):
+            variants = _band_variants(band, radius)
+            placeholders = ",".join("?" * len(variants))
+            rows = conn.execute(
+                f"SELECT f.analysis_id, f.hash, f.thumbnail FROM image_fingerprints f JOIN analyses a ON a.id = f.analysis_id "
+                f"WHERE f.task=? AND f.user_type=? AND f.model_name=? AND f.band{i} IN ({placeholders}) "
+                f"AND a.prompt_id IS ? AND a.username=?",
+                (task, user_type, model_name, *variants, prompt_id, username),
+            ).fetchall()
+            for analysis_id, stored, stored_thumbnail in rows:
+                candidates[analysis_id] = (bin((stored & ((1 << 64) - 1)) ^ value).count("1"), stored_thumbnail)
+
+        close = [(analysis_id, distance, stored_thumbnail)
+                 for analysis_id, (distance, stored_thumbnail) in candidates.items() if distance <= max_distance]
+        # Rows indexed before thumbnails were stored can't be confirmed and are never reused
+        matches = [(analysis_id, distance) for analysis_id, distance, stored_thumbnail in close
+                   if stored_thumbnail and _correlation(thumbnail, stored_thumbnail) >= MIN_CORRELATION]
+        if not matches:
+            near_dup_lookups.inc(outcome="rejected" if close else "miss")
+            return None
+        analysis_id, distance = min(matches, key=lambda match: (match[1], -match[0]))  # closest, then newest
+        row = conn.execute("SELECT image_name, response FROM analyses WHERE id=?", (analysis_id,)).fetchone()
+    if row is None:
+        near_dup_lookups.inc(outcome="miss")
+        return None
+    near_dup_lookups.inc(outcome="hit")
+    return {"analysis_id": analysis_id, "image_name": row[0], "response": row[1], "distance": distance}
+
+
+def index_fingerprint(analysis_id, fingerprint, task, user_type, model_name):
+    """Adds a freshly analyzed image's hash and thumbnail to the index"""
+    value, thumbnail = fingerprint
+    with connection() as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO image_fingerprints (analysis_id, task, user_type, model_name, hash, band0, band1, band2, band3, thumbnail) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (analysis_id, task, user_type, model_name, _signed(value), *_bands(value), thumbnail),
+        )
+
+
+def reuse_note(match):
+    """Visible note prepended to a reused analysis"""
+    return (
+        f"♻️ _This image matches one you analyzed earlier ({match['distance']} of 64 fingerprint bits differ), "
+        "so that analysis was reused. Tick **Force fresh analysis** to run a new one._\n\n"
+    )
@@ -0,0 +1,122 @@
+"""Task prompt templates, compiled once per (task, audience) pair.
+
+Each template holds the task instruction and one section per audience. A compiled
+prompt carries only the section for the requesting audience plus the shared suffix,
+so no request pays for instructions meant for the other audience. Compiled prompts
+get a versioned id that is stored with every result.
+"""
+import hashlib
+import re
+from collections import namedtuple
+
+# Bump when the template wording changes in a way that should not reuse old results
+PROMPT_VERSION = 2
+
+USER_TYPES = ("Common User", "Doctor")
+
+# Shared suffix; every audience section of every task used to repeat it
+CARE_SUFFIX = "Provide a nutrition plan and steps to recover, like remedies and exercises, if required."
+
+CompiledPrompt = namedtuple("CompiledPrompt", ["id", "text"])
+
+
+def expertise_prompt_for(user_type):
+    """Expertise level prompt based on user type"""
+    return f"Generate a response suitable for a {'common user' if user_type == 'Common User' else 'doctor'}"
+
+
+# Task Prompts
+task_prompts = {
+    "Bone Fracture Detection": {
+        "task": "Analyze the X-ray, MRI, or CT scan image for fractures and classify into different fracture types with detailed severity assessment.",
+        "Common User": (
+            "The image will be analyzed to check for fractures, identifying the affected bone and the type of break. "
+            "You will receive an easy-to-understand explanation of the fracture, including its severity and possible effects on movement."
+        ),
+        "Doctor": "Suggest medical treatment options, possible surgeries, immobilization techniques, and follow-up care strategies.",
+    },
+
+    "Bone Marrow Cell Classification": {
+        "task": "Analyze the biopsy or MRI image and classify bone marrow cells into relevant categories, identifying concerning cells.",
+        "Common User": (
+            "The image will be analyzed to check for abnormalities in bone marrow cells. "
+            "You will receive a simple explanation of the findings, including whether there are unusual cell changes and what they might indicate."
+        ),
+        "Doctor": "Provide detailed insights into abnormal cell structures, possible diagnoses, and recommended medical interventions.",
+    },
+
+    "Knee Joint Osteoarthritis Detection": {
+        "task": "Analyze the knee X-ray or MRI and classify osteoarthritis severity based on clinical grading.",
+        "Common User": (
+            "The image will be assessed for signs of knee osteoarthritis, including joint space narrowing and bone changes. "
+            "You will get an easy-to-understand report on whether osteoarthritis is present and its severity level, along with its impact on knee function."
+        ),
+        "Doctor": "Suggest advanced treatments, medications, physiotherapy plans, and surgical options such as knee replacement.",
+    },
+
+    "Osteoporosis Stage Prediction & BMD Score": {
+        "task": "Analyze the bone X-ray and determine osteoporosis stage with estimated Bone Mineral Density (BMD) score.",
+        "Common User": (
+            "The scan will be analyzed to determine how strong or weak the bones are and whether osteoporosis is present. "
+            "You will receive a simple explanation of the results, including whether bone density is lower than normal and what it means for bone health."
+        ),
+        "Doctor": "Recommend specific medications, hormone therapy, and advanced treatments to manage and prevent complications.",
+    },
+
+    "Bone Age Detection": {
+        "task": "Analyze the X-ray of a child's hand and predict bone age with insights into growth patterns.",
+        "Common User": (
+            "The scan will be assessed to check how well the bones are developing compared to the expected growth pattern for the child’s age. "
+            "You will receive an easy-to-understand result explaining whether the bone growth is normal, advanced, or delayed."
+        ),
+        "Doctor": "Offer insights into growth abnormalities, hormonal imbalances, and necessary medical interventions if delayed growth is detected.",
+    },
+
+    "Cervical Spine Fracture Detection": {
+        "task": "Analyze the X-ray, MRI, or CT scan of the cervical spine for fractures and provide a severity assessment.",
+        "Common User": (
+            "The scan will be analyzed for fractures in the neck bones, and you will receive an explanation of the findings. "
+            "The report will describe whether a fracture is present, its severity, and how it may affect movement or pain levels."
+        ),
+        "Doctor": "Suggest medical treatment plans, possible surgical options, and rehabilitation strategies for full recovery.",
+    },
+
+    "Bone Tumor/Cancer Detection": {
+        "task": "Analyze the X-ray, MRI, CT scan, or biopsy image for possible bone tumors or cancerous growths.",
+        "Common User": (
+            "The image will be checked for any unusual growths or masses in the bone, and you will receive a simple explanation of the findings. "
+            "If any suspicious areas are detected, the report will describe their size, location, and whether they appear concerning."
+        ),
+        "Doctor": "Provide detailed insights into tumor classification, possible malignancy assessment, and treatment options.",
+    },
+
+    "Bone Infection (Osteomyelitis) Detection": {
+        "task": "Analyze the X-ray, MRI, CT scan, or biopsy image for signs of bone infection (osteomyelitis).",
+        "Common User": (
+            "The image will be checked for any signs of infection in the bone, such as swelling, bone damage, or abscess formation. "
+            "You will receive an easy-to-understand explanation of whether an infection is present and how it may be affecting the bone."
+        ),
+        "Doctor": "Provide insights on infection severity, possible antibiotic treatments, and surgical recommendations if needed.",
+    },
+}
+
+
+def compile_prompt(task, user_type):
+    """Builds the prompt for one (task, audience) pair and its versioned id"""
+    template = task_prompts[task]
+    text = " ".join((template["task"], template[user_type], CARE_SUFFIX, expertise_prompt_for(user_type) + "."))
+    slug = re.sub(r"[^a-z0-9]+", "-", task.lower()).strip("-")
+    audience = "doctor" if user_type == "Doctor" else "common"
+    # The digest changes with the wording, so edited templates never pass for old ones
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()[:8]
+    return CompiledPrompt(f"{slug}/{audience}@v{PROMPT_VERSION}-{digest}", text)
+
+
+# Compiled once per process; Streamlit reruns don't re-import modules
+compiled_prompts = {(task, user_type): compile_prompt(task, user_type)
+                    for task in task_prompts for user_type in USER_TYPES}
+
+
+def prompt_for(task, user_type):
+    """Returns the compiled prompt for a task and audience"""
+    return compiled_prompts[(task, user_type if user_type in USER_TYPES else "Common User")]
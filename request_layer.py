@@ -0,0 +1,250 @@
+import os
+import random
+import threading
+import time
+
+from google.api_core import exceptions as api_exceptions
+
+from metrics import Counter, register
+from model_client import REQUEST_TIMEOUT
+from shared_state import PROCESS_ID, state
+
+# Request policy (override through environment variables / .env)
+RATE_LIMIT_RPS = float(os.getenv("BONEHEALTH_RATE_LIMIT_RPS", "5"))  # 0 = unlimited
+RATE_LIMIT_BURST = int(os.getenv("BONEHEALTH_RATE_LIMIT_BURST", "10"))
+RETRY_DEADLINE = float(os.getenv("BONEHEALTH_RETRY_DEADLINE", "90"))
+RETRY_MAX_ATTEMPTS = int(os.getenv("BONEHEALTH_RETRY_MAX_ATTEMPTS", "5"))
+RETRY_BASE_DELAY = 0.5
+CLAIM_POLL_SECONDS = 0.25
+# A claim has to outlive the call it guards: the last retry may start just before
+# RETRY_DEADLINE and then run for up to REQUEST_TIMEOUT
+CLAIM_TTL = RETRY_DEADLINE + REQUEST_TIMEOUT + 10
+RETRY_MAX_DELAY = 16.0
+
+TRANSIENT_ERRORS = (
+    api_exceptions.TooManyRequests,  # 429, includes ResourceExhausted
+    api_exceptions.InternalServerError,
+    api_exceptions.BadGateway,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.GatewayTimeout,
+    api_exceptions.DeadlineExceeded,
+    ConnectionError,
+    TimeoutError,
+)
+
+request_events = register(Counter("bonehealth_model_request_events_total",
+                                  "Request-layer events (coalesced, retry, rate_limited, claim_waited)"))
+
+
+_PULL = object()  # SingleFlight: this caller should advance the producer
+
+
+class RateLimitTimeout(Exception):
+    """Raised when no request slot frees up before the deadline"""
+
+
+class SharedRateLimiter:
+    """Token bucket shared by every process using the same state backend.
+
+    Holds up to burst tokens and refills at rate per second, so at most burst
+    requests go out back to back and the long-run rate never exceeds rate.
+    """
+
+    def __init__(self, rate, burst, store=state):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.store = store
+
+    def acquire(self, timeout):
+        """Takes one token, waiting up to timeout seconds for the bucket to refill"""
+        if self.rate <= 0:
+            return
+        deadline = time.monotonic() + timeout
+        waited = False
+        while True:
+            wait = self.store.take_token("ratelimit", self.rate, self.burst)
+            if wait <= 0:
+                return
+            if not waited:
+                request_events.inc(event="rate_limited")
+                waited = True
+            if time.monotonic() + wait > deadline:
+                raise RateLimitTimeout("Model request rate limit reached; try again shortly")
+            # Jitter keeps every waiting process from asking again at the same instant
+            time.sleep(wait + random.uniform(0, min(0.05, 0.1 / self.rate)))
+
+
+class _Flight:
+    def __init__(self, producer):
+        self.producer = producer
+        self.iterator = None  # started by whichever caller pulls first
+        self.items = []
+        self.done = False
+        self.error = None
+        self.pulling = False  # a caller is advancing the producer
+        self.consumers = 0  # guarded by SingleFlight._lock
+        self.cond = threading.Condition()
+
+
+class SingleFlight:
+    """Merges identical in-flight requests: one producer runs, and every caller gets all of its output.
+
+    Whichever caller needs the next item advances the shared producer, so it keeps
+    going while anyone still wants its output. It is closed when the last caller leaves.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def stream(self, key, producer):
+        """Yields producer()'s items; concurrent callers with the same key share one producer"""
+        if key is None:
+            yield from producer()
+            return
+
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight(producer)
+            else:
+                request_events.inc(event="coalesced")
+            flight.consumers += 1
+        try:
+            yield from self._consume(key, flight)
+        finally:
+            self._leave(key, flight)
+
+    def _consume(self, key, flight):
+        index = 0
+        while True:
+            with flight.cond:
+                while index >= len(flight.items) and not flight.done and flight.pulling:
+                    flight.cond.wait()
+                if index < len(flight.items):
+                    item = flight.items[index]
+                    index += 1
+                elif flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                else:
+                    flight.pulling = True
+                    item = _PULL
+            if item is _PULL:
+                self._pull(key, flight)
+            else:
+                yield item
+
+    def _pull(self, key, flight):
+        """Advances the shared producer by one item on this caller's thread"""
+        item = error = None
+        finished = False
+        try:
+            if flight.iterator is None:
+                flight.iterator = iter(flight.producer())
+            item = next(flight.iterator)
+        except StopIteration:
+            finished = True
+        except BaseException as exc:
+            finished, error = True, exc
+        if finished:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+        with flight.cond:
+            if finished:
+                flight.done, flight.error = True, error
+            else:
+                flight.items.append(item)
+            flight.pulling = False
+            flight.cond.notify_all()
+
+    def _leave(self, key, flight):
+        # One caller giving up (e.g. a cancelled job) must not fail the others
+        with self._lock:
+            flight.consumers -= 1
+            abandoned = flight.consumers == 0 and not flight.done
+            if abandoned and self._flights.get(key) is flight:
+                del self._flights[key]
+        if abandoned:
+            with flight.cond:
+                flight.done = True
+                flight.error = RuntimeError("The shared request was abandoned before it finished")
+            if hasattr(flight.iterator, "close"):
+                flight.iterator.close()
+
+    def call(self, key, fn):
+        """Returns fn(); concurrent callers with the same key share one call"""
+        return list(self.stream(key, lambda: iter([fn()])))[0]
+
+
+def _backoff(attempt):
+    # Full jitter: uniform over [0, base * 2^attempt], capped
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def _retrying(producer, deadline):
+    """Yields producer()'s items, retrying transient failures that happen before the first item"""
+    attempt = 0
+    while True:
+        bucket.acquire(timeout=max(0.0, deadline - time.monotonic()))
+        started = False
+        try:
+            for item in producer():
+                started = True
+                yield item
+            return
+        except TRANSIENT_ERRORS:
+            attempt += 1
+            delay = _backoff(attempt)
+            # Once output has been handed to the caller a retry would duplicate it
+            if started or attempt >= RETRY_MAX_ATTEMPTS or time.monotonic() + delay > deadline:
+                raise
+            request_events.inc(event="retry")
+            time.sleep(delay)
+
+
+def guarded_stream(producer, key=None, deadline=RETRY_DEADLINE):
+    """Streams a model call through coalescing, rate limiting and retries"""
+    absolute_deadline = time.monotonic() + deadline
+    return single_flight.stream(key, lambda: _retrying(producer, absolute_deadline))
+
+
+def guarded_call(fn, key=None, deadline=RETRY_DEADLINE):
+    """Runs a model call through coalescing, rate limiting and retries"""
+    absolute_deadline = time.monotonic() + deadline
+    return single_flight.call(key, lambda: next(_retrying(lambda: iter([fn()]), absolute_deadline)))
+
+
+def claim(key, lookup, timeout=CLAIM_TTL):
+    """Claims key across processes before an expensive call; single_flight covers threads of one process.
+
+    Returns (claimed, result). When another process holds the claim this waits for it
+    to finish and returns lookup()'s value (None if it found nothing, e.g. the call failed).
+    Whoever gets claimed=True must call release(key).
+    """
+    if state.add(f"claim:{key}", PROCESS_ID, ttl=timeout):
+        return True, None
+    deadline = time.monotonic() + timeout
+    waited = False
+    while time.monotonic() < deadline:
+        owner = state.get(f"claim:{key}")
+        if owner is None or owner == PROCESS_ID:
+            break
+        waited = True
+        time.sleep(CLAIM_POLL_SECONDS)
+    else:
+        return False, None
+    if waited:
+        request_events.inc(event="claim_waited")
+    return False, lookup()
+
+
+def release(key):
+    state.delete(f"claim:{key}")
+
+
+# Shared by all sessions (and, through the state backend, all processes)
+bucket = SharedRateLimiter(RATE_LIMIT_RPS, RATE_LIMIT_BURST)
+single_flight = SingleFlight()
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import CallbackGauge, register
+from shared_state import STATE_BACKEND, state
+
+# Cache settings (override through environment variables / .env)
+CACHE_DB_PATH = os.getenv("BONEHEALTH_CACHE_DB", "analysis_cache.db")
+CACHE_TTL_SECONDS = int(os.getenv("BONEHEALTH_CACHE_TTL", str(7 * 24 * 3600)))
+CACHE_MEMORY_ENTRIES = int(os.getenv("BONEHEALTH_CACHE_MEMORY_ENTRIES", "256"))
+CACHE_DISK_ENTRIES = int(os.getenv("BONEHEALTH_CACHE_DISK_ENTRIES", "10000"))
+CACHE_DISABLED = os.getenv("BONEHEALTH_CACHE_DISABLED", "").lower() in ("1", "true", "yes")
+
+
+def make_cache_key(image_bytes, task_prompt, model_name, additional_input=""):
+    """Builds a content-addressed key for one analysis request"""
+    digest = hashlib.sha256()
+    for part in (image_bytes, task_prompt, model_name, additional_input):
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        # Length prefix keeps ("ab", "c") and ("a", "bc") from colliding
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class AnalysisCache:
+    """Two-tier cache for model responses: an in-process LRU in front of a SQLite file.
+
+    With a shared store (the redis state backend) the second tier lives there instead,
+    so every host sees every cached analysis; the store's own eviction bounds its size.
+    """
+
+    def __init__(self, db_path=CACHE_DB_PATH, ttl_seconds=CACHE_TTL_SECONDS,
+                 max_memory_entries=CACHE_MEMORY_ENTRIES, max_disk_entries=CACHE_DISK_ENTRIES,
+                 enabled=not CACHE_DISABLED, shared=None):
+        self.db_path = db_path
+        self.shared = shared
+        self.ttl_seconds = ttl_seconds
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.enabled = enabled
+        self._memory = OrderedDict()  # key -> (created_at, text)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _connection(self):
+        # sqlite3 connections can't be shared across Streamlit session threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS analysis_cache (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_cache_last_access ON analysis_cache (last_access)")
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def _expired(self, created_at, now):
+        return self.ttl_seconds > 0 and now - created_at > self.ttl_seconds
+
+    def get(self, key):
+        """Returns the cached response for key, or None on a miss"""
+        if not self.enabled:
+            return None
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if self._expired(entry[0], now):
+                    del self._memory[key]
+                else:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry[1]
+
+        if self.shared is not None:
+            raw = self.shared.get(f"cache:{key}")
+            created_at, response = json.loads(raw) if raw is not None else (None, None)
+            with self._lock:
+                if response is None or self._expired(created_at, now):
+                    self.misses += 1
+                    return None
+                self.disk_hits += 1
+                self._remember(key, created_at, response)
+            return response
+
+        conn = self._connection()
+        row = conn.execute("SELECT response, created_at FROM analysis_cache WHERE key=?", (key,)).fetchone()
+        if row is None or self._expired(row[1], now):
+            if row is not None:
+                conn.execute("DELETE FROM analysis_cache WHERE key=?", (key,))
+                conn.commit()
+            with self._lock:
+                self.misses += 1
+            return None
+
+        conn.execute("UPDATE analysis_cache SET last_access=? WHERE key=?", (now, key))
+        conn.commit()
+        with self._lock:
+            self.disk_hits += 1
+            self._remember(key, row[1], row[0])
+        return row[0]
+
+    def set(self, key, response):
+        """Stores a response in both tiers"""
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, response)
+
+        if self.shared is not None:
+            self.shared.set(f"cache:{key}", json.dumps([now, response]), ttl=self.ttl_seconds or None)
+            return
+
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO analysis_cache (key, response, created_at, last_access) VALUES (?, ?, ?, ?)",
+            (key, response, now, now),
+        )
+        self._evict_disk(conn, now)
+        conn.commit()
+
+    def _remember(self, key, created_at, response):
+        # Caller holds self._lock
+        self._memory[key] = (created_at, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self, conn, now):
+        if self.ttl_seconds > 0:
+            conn.execute("DELETE FROM analysis_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        # Drop least recently used rows beyond the size limit
+        conn.execute("""
+        DELETE FROM analysis_cache WHERE key IN (
+            SELECT key FROM analysis_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?
+        )
+        """, (self.max_disk_entries,))
+
+    def clear(self):
+        """Empties both tiers and resets the counters"""
+        with self._lock:
+            self._memory.clear()
+            self.memory_hits = self.disk_hits = self.misses = 0
+        if self.shared is not None:
+            return  # shared entries expire on their own
+        conn = self._connection()
+        conn.execute("DELETE FROM analysis_cache")
+        conn.commit()
+
+    def stats(self):
+        """Returns hit/miss counters for display or logging"""
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            total = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / total if total else 0.0,
+                "memory_entries": len(self._memory),
+            }
+
+
+# Process-wide instance; Streamlit reruns the script but keeps imported modules
+analysis_cache = AnalysisCache(shared=state if STATE_BACKEND == "redis" else None)
+register(CallbackGauge(
+    "bonehealth_analysis_cache_lookups", "Analysis cache lookups by outcome",
+    lambda: {(("outcome", k),): v for k, v in analysis_cache.stats().items() if k in ("memory_hits", "disk_hits", "misses")},
+))
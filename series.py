@@ -0,0 +1,172 @@
+"""CT/MRI series ingestion: picks informative slices and tiles them into a few montages.
+
+A ZIP of slice images or a multi-frame TIFF is read one frame at a time, so only
+the current slice and the best candidates (at tile size) are ever decoded.
+"""
+import io
+import math
+import os
+import re
+import zipfile
+
+from image_prep import OUTPUT_QUALITY, _pil, _stretch_to_l, _to_output_mode, preprocess_image
+
+# Series settings (override through environment variables / .env)
+SERIES_TILES_PER_MONTAGE = int(os.getenv("BONEHEALTH_SERIES_TILES", "9"))
+SERIES_MONTAGES = int(os.getenv("BONEHEALTH_SERIES_MONTAGES", "2"))
+SERIES_MAX_SLICES = int(os.getenv("BONEHEALTH_SERIES_MAX_SLICES", "1000"))  # larger series are subsampled
+
+SERIES_EXTENSIONS = (".zip", ".tif", ".tiff")
+SLICE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
+TILE_SIDE = 512
+SCORE_SIDE = 256
+BLANK_STDDEV = 4.0  # slices flatter than this (air, padding) are never picked
+MAX_SLICE_BYTES = 64 * 1024 * 1024  # guards against zip bombs
+
+
+def is_series(name):
+    """True when an upload should go through series ingestion rather than single-image prep"""
+    return bool(name) and name.lower().endswith(SERIES_EXTENSIONS)
+
+
+def _natural_key(name):
+    # slice_2.png sorts before slice_10.png
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", name)]
+
+
+def _frame_sources(data, name):
+    """Returns (slice count, iterator of (slice index, PIL frame)) without decoding every frame up front"""
+    Image, _ = _pil()
+    if name.lower().endswith(".zip"):
+        archive = zipfile.ZipFile(io.BytesIO(data))
+        members = sorted(
+            (info for info in archive.infolist()
+             if not info.is_dir() and not info.filename.startswith("__MACOSX/")
+             and info.filename.lower().endswith(SLICE_EXTENSIONS) and info.file_size <= MAX_SLICE_BYTES),
+            key=lambda info: _natural_key(info.filename),
+        )
+
+        def frames(indices):
+            for index in indices:
+                with Image.open(io.BytesIO(archive.read(members[index]))) as frame:
+                    frame.load()
+                    yield index, frame
+
+        return len(members), frames
+
+    image = Image.open(io.BytesIO(data))
+
+    def frames(indices):
+        for index in indices:
+            image.seek(index)
+            yield index, image
+
+    return getattr(image, "n_frames", 1), frames
+
+
+def _to_gray(frame):
+    """8-bit grayscale; 16-bit and float slices are stretched over their own range instead of clipped"""
+    if frame.mode in ("I;16", "I;16B", "I;16L", "I", "F"):
+        return _stretch_to_l(frame)
+    return _to_output_mode(frame, grayscale=True)
+
+
+def score_slice(image):
+    """Cheap informativeness score: edge density plus a contrast term, 0 for near-blank slices"""
+    from PIL import ImageFilter, ImageStat
+
+    thumb = image.copy()
+    thumb.thumbnail((SCORE_SIDE, SCORE_SIDE))
+    stddev = ImageStat.Stat(thumb).stddev[0]
+    if stddev < BLANK_STDDEV:
+        return 0.0
+    edges = ImageStat.Stat(thumb.filter(ImageFilter.FIND_EDGES)).mean[0]
+    return edges + 0.25 * stddev
+
+
+def _tile(gray):
+    _, ImageOps = _pil()
+    tile = gray.copy()
+    tile.thumbnail((TILE_SIDE, TILE_SIDE))
+    # Windowing differs per scanner; stretch each slice so faint anatomy stays visible
+    return ImageOps.autocontrast(tile, cutoff=0.5)
+
+
+def select_slices(data, name, count):
+    """Streams the series and keeps the best-scoring slice in each of count equal runs of slices.
+
+    Returns (slice count, [(slice index, tile image)...]) in series order.
+    """
+    total, frames = _frame_sources(data, name)
+    if total == 0:
+        raise ValueError(f"No image slices found in {name}")
+    step = max(1, math.ceil(total / SERIES_MAX_SLICES))
+    count = min(count, math.ceil(total / step))
+
+    # Splitting the series into runs keeps the picks spread from first slice to last
+    best = {}  # run -> (score, slice index, tile)
+    for index, frame in frames(range(0, total, step)):
+        run = index * count // total
+        gray = _to_gray(frame)
+        score = score_slice(gray)
+        if run not in best or score > best[run][0]:
+            best[run] = (score, index, _tile(gray))
+    return total, [(index, tile) for _, index, tile in sorted(best.values(), key=lambda entry: entry[1])]
+
+
+def build_montages(tiles, per_montage=SERIES_TILES_PER_MONTAGE):
+    """Lays labelled tiles out in grids and returns them as JPEG image parts"""
+    Image, _ = _pil()
+    from PIL import ImageDraw
+
+    parts = []
+    for start in range(0, len(tiles), per_montage):
+        group = tiles[start:start + per_montage]
+        columns = math.ceil(math.sqrt(len(group)))
+        rows = math.ceil(len(group) / columns)
+        montage = Image.new("L", (columns * TILE_SIDE, rows * TILE_SIDE), 0)
+        draw = ImageDraw.Draw(montage)
+        for position, (index, tile) in enumerate(group):
+            x, y = (position % columns) * TILE_SIDE, (position // columns) * TILE_SIDE
+            montage.paste(tile, (x + (TILE_SIDE - tile.width) // 2, y + (TILE_SIDE - tile.height) // 2))
+            # 1-based slice numbers so the model can point at them in its answer
+            draw.rectangle((x, y, x + 90, y + 24), fill=0)
+            draw.text((x + 6, y + 6), f"#{index + 1}", fill=255)
+        buffer = io.BytesIO()
+        montage.save(buffer, format="JPEG", quality=OUTPUT_QUALITY, optimize=True)
+        parts.append({"mime_type": "image/jpeg", "data": buffer.getvalue()})
+    return parts
+
+
+def prepare_series(data, name):
+    """Turns a series upload into a few montage image parts plus size stats"""
+    total, tiles = select_slices(data, name, SERIES_TILES_PER_MONTAGE * SERIES_MONTAGES)
+    parts = build_montages(tiles)
+    stats = {
+        "original_bytes": len(data),
+        "processed_bytes": sum(len(part["data"]) for part in parts),
+        "slices": total,
+        "selected_slices": [index + 1 for index, _ in tiles],
+        "montages": len(parts),
+    }
+    return parts, stats
+
+
+def series_note(stats):
+    """Extra prompt text telling the model what the montages contain"""
+    return (
+        f"The images are montages of {len(stats['selected_slices'])} representative slices, "
+        f"chosen from a series of {stats['slices']} slices and ordered from first to last. "
+        "Each tile is labelled with its slice number; cite slice numbers for any findings."
+    )
+
+
+def prepare_upload(data, name, task, mime_type):
+    """Returns (image parts, stats, additional prompt text) for a single image or a series"""
+    if is_series(name):
+        parts, stats = prepare_series(data, name)
+        # A single-page TIFF is just an image; keep its full resolution
+        if stats["slices"] > 1 or name.lower().endswith(".zip"):
+            return parts, stats, series_note(stats)
+    part, stats = preprocess_image(data, task, mime_type)
+    return [part], stats, ""
@@ -0,0 +1,285 @@
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+
+from metrics import CallbackGauge, register
+
+
+def _default_spill_dir():
+    # One directory per OS user; a shared name would let other local users read or plant files
+    owner = os.getuid() if hasattr(os, "getuid") else os.getenv("USERNAME", "user")
+    return os.path.join(tempfile.gettempdir(), f"bonehealth-spill-{owner}")
+
+
+# Memory limits (override through environment variables / .env)
+SPILL_DIR = os.getenv("BONEHEALTH_SPILL_DIR") or _default_spill_dir()
+SESSION_MEMORY_BUDGET = int(os.getenv("BONEHEALTH_SESSION_MEMORY_KB", "256")) * 1024
+SESSION_IDLE_SECONDS = float(os.getenv("BONEHEALTH_SESSION_IDLE_SECONDS", "600"))
+SPILL_FILE_TTL = float(os.getenv("BONEHEALTH_SPILL_FILE_TTL", str(24 * 3600)))  # unused images/previews
+SWEEP_INTERVAL = 60
+
+IMAGE_DIR = os.path.join(SPILL_DIR, "images")
+PREVIEW_DIR = os.path.join(SPILL_DIR, "previews")
+SESSION_DIR = os.path.join(SPILL_DIR, "sessions")
+
+
+def _private_dir(path):
+    """Creates path readable only by this user; refuses a directory someone else owns or can write to"""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise RuntimeError(f"Spill directory {path} is not a directory")
+    if hasattr(os, "getuid"):
+        if info.st_uid != os.getuid():
+            raise RuntimeError(f"Spill directory {path} is owned by another user; set BONEHEALTH_SPILL_DIR")
+        if info.st_mode & 0o077:
+            os.chmod(path, 0o700)
+    return path
+
+
+def _write_once(path, data):
+    """Writes data to path unless it already exists; content-addressed files never change"""
+    if os.path.exists(path):
+        os.utime(path)  # keeps the sweeper from deleting a file that is still in use
+        return
+    _private_dir(SPILL_DIR)
+    _private_dir(os.path.dirname(path))
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)  # readers never see a half-written file
+
+
+def store_bytes(data):
+    """Writes image bytes to the content-addressed spill directory and returns their digest"""
+    digest = hashlib.sha256(data).hexdigest()
+    _write_once(os.path.join(IMAGE_DIR, digest), data)
+    return digest
+
+
+def read_bytes(digest):
+    """Reads image bytes stored by store_bytes; raises FileNotFoundError once they are swept"""
+    with open(os.path.join(IMAGE_DIR, digest), "rb") as f:
+        return f.read()
+
+
+# Process-wide registry of live StoredImage handles; entries vanish with their sessions
+_images = weakref.WeakSet()
+_images_lock = threading.Lock()
+
+
+class StoredImage:
+    """An uploaded image kept on disk by content hash instead of in session memory"""
+
+    def __init__(self, name, mime_type, data):
+        self.name = name
+        self.type = mime_type
+        self.size = len(data)
+        self.digest = store_bytes(data)
+        # The sweeper leaves files alone while a handle to them is alive
+        with _images_lock:
+            _images.add(self)
+
+    def getvalue(self):
+        """Reads the image bytes back from disk"""
+        return read_bytes(self.digest)
+
+    def available(self):
+        """Whether the bytes are still on disk, e.g. for a handle from before a restart"""
+        return os.path.exists(os.path.join(IMAGE_DIR, self.digest))
+
+    def preview_path(self, render):
+        """Returns the on-disk preview, rendering it with render(bytes) the first time"""
+        path = os.path.join(PREVIEW_DIR, f"{self.digest}.jpg")
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            _write_once(path, render(self.getvalue()))
+        return path
+
+
+def _estimate_size(value):
+    # Rough resident size of chat state; strings dominate
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_estimate_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_estimate_size(v) for v in value)
+    return 64
+
+
+class SessionVault:
+    """A session's bulky chat state; parked on disk when idle or over budget, reloaded on access.
+
+    Parked values are written as JSON, so they must be plain strings, numbers,
+    lists and dicts. Keys listed in derived are caches that are dropped instead.
+    """
+
+    def __init__(self, derived=()):
+        self.derived = set(derived)
+        self.path = os.path.join(SESSION_DIR, f"{uuid.uuid4().hex}.json")
+        self.last_access = time.monotonic()
+        self._values = {}
+        self._parked = False
+        self._lock = threading.RLock()
+        # Streamlit drops session_state when the session ends; take the spill file with it
+        weakref.finalize(self, _remove_quietly, self.path)
+        with _vaults_lock:
+            _vaults.add(self)
+
+    def _load(self):
+        # Caller holds self._lock
+        self.last_access = time.monotonic()
+        if self._parked:
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    self._values = json.load(f)
+            except FileNotFoundError:
+                self._values = {}
+            self._parked = False
+            _counters["restored"] += 1
+        return self._values
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._load()[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._load()[key] = value
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._load()
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._load().get(key, default)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._load().pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._values, self._parked = {}, False
+            _remove_quietly(self.path)
+
+    def resident_bytes(self):
+        with self._lock:
+            return 0 if self._parked else _estimate_size(self._values)
+
+    def park(self):
+        """Writes the state to disk and frees it from memory"""
+        with self._lock:
+            if self._parked:
+                return
+            kept = {k: v for k, v in self._values.items() if k not in self.derived}
+            _private_dir(SPILL_DIR)
+            _private_dir(SESSION_DIR)
+            # JSON rather than pickle: loading a parked file must never run code
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(kept, f)
+            self._values, self._parked = {}, True
+            _counters["parked"] += 1
+
+    def enforce_budget(self, budget=SESSION_MEMORY_BUDGET):
+        """Parks the state if it is over budget; call at the end of a script run"""
+        if budget > 0 and self.resident_bytes() > budget:
+            self.park()
+
+    def touch(self):
+        self.last_access = time.monotonic()
+
+    @property
+    def parked(self):
+        return self._parked
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# Process-wide registry of live vaults; entries vanish with their sessions
+_vaults = weakref.WeakSet()
+_vaults_lock = threading.Lock()
+_counters = {"parked": 0, "restored": 0}
+
+
+def _sweep_files(directory, max_age, keep=()):
+    if not os.path.isdir(directory):
+        return
+    cutoff = time.time() - max_age
+    for name in os.listdir(directory):
+        if name in keep:
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def sweep():
+    """Parks idle sessions and deletes spilled images no live session holds and nobody has used for a while"""
+    now = time.monotonic()
+    with _vaults_lock:
+        vaults = list(_vaults)
+    for vault in vaults:
+        if not vault.parked and now - vault.last_access > SESSION_IDLE_SECONDS:
+            vault.park()
+    # Images a session still holds a StoredImage for are kept however old they are
+    with _images_lock:
+        live = {image.digest for image in _images}
+    _sweep_files(IMAGE_DIR, SPILL_FILE_TTL, keep=live)
+    _sweep_files(PREVIEW_DIR, SPILL_FILE_TTL, keep={f"{digest}.jpg" for digest in live})
+    # Files left behind by sessions of a previous process
+    _sweep_files(SESSION_DIR, max(SPILL_FILE_TTL, SESSION_IDLE_SECONDS * 2))
+
+
+def _sweep_forever():
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        sweep()
+
+
+_sweeper_started = False
+_sweeper_lock = threading.Lock()
+
+
+def start_sweeper():
+    """Starts the idle-session sweeper once per process"""
+    global _sweeper_started
+    with _sweeper_lock:
+        if _sweeper_started:
+            return
+        _sweeper_started = True
+    threading.Thread(target=_sweep_forever, name="session-sweeper", daemon=True).start()
+
+
+def _memory_stats():
+    with _vaults_lock:
+        vaults = list(_vaults)
+    parked = sum(1 for v in vaults if v.parked)
+    return {
+        (("state", "resident"),): len(vaults) - parked,
+        (("state", "parked"),): parked,
+        (("state", "resident_bytes"),): sum(v.resident_bytes() for v in vaults),
+        (("state", "parked_total"),): _counters["parked"],
+        (("state", "restored_total"),): _counters["restored"],
+    }
+
+
+register(CallbackGauge("bonehealth_session_memory", "Per-session chat state held in memory vs parked on disk",
+                       _memory_stats))
@@ -0,0 +1,5 @@
+"""One-time process setup; import before any module that reads BONEHEALTH_* settings"""
+from dotenv import load_dotenv
+
+# Load environment variables once per process (Streamlit reruns don't re-import modules)
+load_dotenv()
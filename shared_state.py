@@ -0,0 +1,222 @@
+"""Shared state for running several app processes side by side on one host.
+
+Result caches, job progress, the rate-limit token bucket, worker heartbeats and login
+sessions go through one small key-value interface with expiry. The default
+backend is its own SQLite file (BONEHEALTH_STATE_DB, WAL, one statement per
+transaction), so this chatty traffic never waits behind the app database's
+writes. BONEHEALTH_STATE_BACKEND=redis points it at any server that speaks the
+Redis protocol (bench/fake_redis.py is a local stand-in). Accounts, jobs, history
+and usage live in the app database file, so either way every process must run on
+the host that holds it: this scales across the cores of one host, not across hosts.
+"""
+import json
+import os
+import secrets
+import time
+import uuid
+
+from db import connection
+
+# Shared state settings (override through environment variables / .env)
+STATE_BACKEND = os.getenv("BONEHEALTH_STATE_BACKEND", "sqlite").lower()  # sqlite | redis
+REDIS_URL = os.getenv("BONEHEALTH_REDIS_URL", "redis://localhost:6379/0")
+STATE_PREFIX = os.getenv("BONEHEALTH_STATE_PREFIX", "bonehealth:")
+STATE_DB_PATH = os.getenv("BONEHEALTH_STATE_DB", "shared_state.db")  # sqlite backend only
+LOGIN_TTL = float(os.getenv("BONEHEALTH_LOGIN_TTL", str(12 * 3600)))
+
+# Identifies this process in claims and job ownership
+PROCESS_ID = uuid.uuid4().hex
+
+# Token bucket kept as the time it will next be full (GCRA): one atomic step checks and
+# takes a token. Returns 0 when a token was taken, otherwise seconds until one frees up.
+TOKEN_BUCKET_LUA = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local interval, limit = tonumber(ARGV[1]), tonumber(ARGV[2])
+local tat = math.max(tonumber(redis.call('GET', KEYS[1]) or '0'), now)
+if tat + interval - now > limit then
+    return tostring(tat + interval - now - limit)
+end
+redis.call('SET', KEYS[1], tostring(tat + interval), 'PX', math.ceil(limit * 1000) + 1000)
+return '0'
+"""
+
+
+# Schema of the sqlite backend's file, applied like db.MIGRATIONS
+STATE_MIGRATIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS shared_state (
+        key TEXT PRIMARY KEY,
+        value,
+        expires_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS idx_shared_state_expires ON shared_state (expires_at);
+    """,
+]
+
+
+def _redis():
+    """Imports the Redis client on first use; only the redis backend needs it"""
+    import redis
+
+    return redis
+
+
+class SQLiteState:
+    """Key-value state in a SQLite file of its own; shared by every process on this host"""
+
+    def __init__(self, path=STATE_DB_PATH):
+        self.path = path
+
+    def _connection(self):
+        return connection(self.path, STATE_MIGRATIONS)
+
+    def get(self, key):
+        now = time.time()
+        with self._connection() as conn:
+            row = conn.execute("SELECT value, expires_at FROM shared_state WHERE key=?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= now):
+            return None
+        return row[0]
+
+    def set(self, key, value, ttl=None):
+        with self._connection() as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)",
+                         (key, value, time.time() + ttl if ttl else None))
+
+    def add(self, key, value, ttl=None):
+        """Sets key only if it is absent (or expired); returns whether it was set"""
+        now = time.time()
+        with self._connection() as conn, conn:
+            conn.execute("DELETE FROM shared_state WHERE key=? AND expires_at <= ?", (key, now))
+            cursor = conn.execute("INSERT OR IGNORE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)",
+                                  (key, value, now + ttl if ttl else None))
+            return cursor.rowcount == 1
+
+    def incr(self, key, amount=1, ttl=None):
+        """Atomically adds amount and returns the new value; ttl applies when the key is created"""
+        now = time.time()
+        with self._connection() as conn, conn:
+            return int(conn.execute(
+                "INSERT INTO shared_state (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET "
+                "value = CASE WHEN expires_at <= ? THEN excluded.value ELSE CAST(value AS INTEGER) + excluded.value END, "
+                "expires_at = CASE WHEN expires_at <= ? THEN excluded.expires_at ELSE expires_at END "
+                "RETURNING value",
+                (key, amount, now + ttl if ttl else None, now, now),
+            ).fetchone()[0])
+
+    def take(self, key):
+        """Atomically returns and deletes key; of several callers racing for it, only one gets the value"""
+        with self._connection() as conn, conn:
+            row = conn.execute("DELETE FROM shared_state WHERE key=? RETURNING value, expires_at", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return row[0]
+
+    def take_token(self, key, rate, burst):
+        """Takes a token from a bucket of burst tokens refilled at rate per second; returns 0 or seconds to wait"""
+        now, interval = time.time(), 1 / rate
+        limit = burst * interval
+        # The WHERE makes the update (and so RETURNING) happen only when a token is available
+        with self._connection() as conn, conn:
+            taken = conn.execute(
+                "INSERT INTO shared_state (key, value, expires_at) VALUES (?1, ?2 + ?3, ?2 + ?3 + ?4) "
+                "ON CONFLICT (key) DO UPDATE SET value = MAX(CAST(value AS REAL), ?2) + ?3, "
+                "expires_at = MAX(CAST(value AS REAL), ?2) + ?3 + ?4 "
+                "WHERE MAX(CAST(value AS REAL), ?2) + ?3 - ?2 <= ?4 "
+                "RETURNING value",
+                (key, now, interval, limit),
+            ).fetchone()
+        if taken is not None:
+            return 0.0
+        tat = float(self.get(key) or now)
+        return max(0.0, max(tat, now) + interval - now - limit)
+
+    def delete(self, key):
+        with self._connection() as conn, conn:
+            conn.execute("DELETE FROM shared_state WHERE key=?", (key,))
+
+    def purge_expired(self):
+        """Deletes expired keys; Redis does this on its own"""
+        with self._connection() as conn, conn:
+            conn.execute("DELETE FROM shared_state WHERE expires_at <= ?", (time.time(),))
+
+
+class RedisState:
+    """Key-value state on a Redis-protocol server"""
+
+    def __init__(self, url=REDIS_URL, prefix=STATE_PREFIX):
+        self.prefix = prefix
+        self.client = _redis().Redis.from_url(url, decode_responses=True)
+        self._token_bucket = self.client.register_script(TOKEN_BUCKET_LUA)
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value, px=int(ttl * 1000) if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        return bool(self.client.set(self.prefix + key, value, nx=True, px=int(ttl * 1000) if ttl else None))
+
+    def incr(self, key, amount=1, ttl=None):
+        value = self.client.incrby(self.prefix + key, amount)
+        if ttl and value == amount:
+            self.client.pexpire(self.prefix + key, int(ttl * 1000))
+        return value
+
+    def take(self, key):
+        return self.client.getdel(self.prefix + key)
+
+    def take_token(self, key, rate, burst):
+        # Runs on the server, against the server's clock, so hosts with skewed clocks agree
+        return float(self._token_bucket(keys=[self.prefix + key], args=[1 / rate, burst / rate]))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def purge_expired(self):
+        pass
+
+
+def open_state(backend=STATE_BACKEND):
+    """Returns the configured backend"""
+    if backend == "redis":
+        return RedisState()
+    if backend == "sqlite":
+        return SQLiteState()
+    raise ValueError(f"Unknown BONEHEALTH_STATE_BACKEND {backend!r}; use 'sqlite' or 'redis'")
+
+
+# Process-wide instance; Streamlit reruns the script but keeps imported modules
+state = open_state()
+
+
+# Login sessions: a token in a browser cookie lets any app process pick the session up after a reconnect
+def create_login_session(username, user_type):
+    """Stores a login and returns its token"""
+    token = secrets.token_urlsafe(24)
+    state.set(f"login:{token}", json.dumps({"username": username, "user_type": user_type}), ttl=LOGIN_TTL)
+    return token
+
+
+def resume_login_session(token):
+    """Spends a live token and returns {"username", "user_type", "token"} with a fresh token, or None.
+
+    Each token works once, so a copied token stops working after its next use, and
+    the account is looked up again in case it was deleted or changed type.
+    """
+    raw = state.take(f"login:{token}")
+    if raw is None:
+        return None
+    username = json.loads(raw)["username"]
+    with connection() as conn:
+        row = conn.execute("SELECT user_type FROM users WHERE username=?", (username,)).fetchone()
+    if row is None:
+        return None
+    return {"username": username, "user_type": row[0], "token": create_login_session(username, row[0])}
+
+
+def end_login_session(token):
+    state.delete(f"login:{token}")
@@ -0,0 +1,26 @@
+"""The app stylesheet, read once per process.
+
+Streamlit re-executes BoneHealth.py on every rerun, so a cache defined there
+(even st.cache_resource) costs a decorator call and a lookup each time; this
+module is imported once and keeps the tag in a plain function cache.
+"""
+import functools
+import hashlib
+import os
+
+STYLESHEET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "bonehealth.css")
+
+
+@functools.lru_cache(maxsize=None)
+def stylesheet_tag(static_serving):
+    """The stylesheet as a <link> to the static file server, so reruns don't resend it.
+
+    The ?v= content hash lets the browser cache the file until it changes. Without
+    static serving (see .streamlit/config.toml) it falls back to an inline <style>.
+    """
+    with open(STYLESHEET_PATH, "rb") as f:
+        css = f.read()
+    if static_serving:
+        version = hashlib.sha256(css).hexdigest()[:12]
+        return f'<link rel="stylesheet" href="app/static/bonehealth.css?v={version}">'
+    return f"<style>\n{css.decode('utf-8')}</style>"
@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# App modules read their settings on import; point them at a scratch directory first
+_scratch = tempfile.mkdtemp(prefix="bonehealth-tests-")
+os.environ["BONEHEALTH_DB_PATH"] = os.path.join(_scratch, "users.db")
+os.environ["BONEHEALTH_CACHE_DB"] = os.path.join(_scratch, "analysis_cache.db")
+os.environ["BONEHEALTH_STATE_DB"] = os.path.join(_scratch, "shared_state.db")
+os.environ["BONEHEALTH_SPILL_DIR"] = os.path.join(_scratch, "spill")
+os.environ["BONEHEALTH_STATE_BACKEND"] = "sqlite"
+os.environ["BONEHEALTH_RATE_LIMIT_RPS"] = "0"
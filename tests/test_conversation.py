@@ -0,0 +1,35 @@
+from conversation import compact_analysis, estimate_tokens
+
+ANALYSIS = """## Findings
+The radiograph shows a transverse fracture of the distal radius with mild dorsal angulation. The ulnar styloid appears intact. Bone density looks reduced for the patient's age, which suggests early osteopenia.
+
+## Impression
+Distal radius fracture with dorsal angulation. Possible osteopenia.
+
+## Recommendations
+- Immobilize the wrist in a cast for six weeks and repeat imaging in two weeks.
+- Refer for a DEXA scan to assess bone mineral density.
+
+## Conclusion
+This is a stable fracture that should heal well with conservative treatment. Follow-up is important to monitor alignment.
+"""
+
+
+def test_fitting_analysis_is_unchanged():
+    assert compact_analysis(ANALYSIS, 1000) == ANALYSIS
+
+
+def test_budget_is_spread_across_sections():
+    budget = 120
+    summary = compact_analysis(ANALYSIS, budget)
+    assert budget * 0.8 <= estimate_tokens(summary) <= budget
+    for heading in ("## Findings", "## Impression", "## Recommendations", "## Conclusion"):
+        assert heading in summary
+    # The closing section survives and a paragraph keeps more than its first sentence when there is room
+    assert "stable fracture" in summary
+    assert "The ulnar styloid appears intact." in summary
+
+
+def test_headings_survive_a_tiny_budget():
+    summary = compact_analysis(ANALYSIS, 10)
+    assert summary.splitlines() == ["## Findings", "## Impression", "## Recommendations", "## Conclusion"]
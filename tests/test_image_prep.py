@@ -0,0 +1,23 @@
+import io
+
+from PIL import Image, ImageStat
+
+from series import prepare_upload
+
+
+def _tiff(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="TIFF")
+    return buffer.getvalue()
+
+
+def test_float_and_int32_images_are_stretched_not_blacked_out():
+    gradient = Image.linear_gradient("L")
+    for image in (gradient.convert("F").point(lambda v: v / 255),  # float, 0..1
+                  gradient.convert("I").point(lambda v: v * 16)):  # 12-bit values in a 32-bit image
+        parts, _, _ = prepare_upload(_tiff(image), "slice.tif", "Bone Fracture Detection", "image/tiff")
+
+        processed = Image.open(io.BytesIO(parts[0]["data"]))
+        low, high = ImageStat.Stat(processed).extrema[0]
+        assert processed.mode == "L"
+        assert low < 10 and high > 245
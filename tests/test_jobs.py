@@ -0,0 +1,55 @@
+import io
+import time
+
+import pytest
+from PIL import Image
+
+import jobs
+from db import connection
+
+
+def png_bytes(colour=(200, 200, 200)):
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), colour).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def wait_for(job_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = jobs.get_job(job_id)
+        if job["status"] not in jobs.ACTIVE_STATUSES:
+            return job
+        time.sleep(0.02)
+    pytest.fail(f"job {job_id} still {job['status']}")
+
+
+def saved_analyses(username):
+    with connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM analyses WHERE username=?", (username,)).fetchone()[0]
+
+
+def test_finished_job_is_saved(monkeypatch):
+    monkeypatch.setattr(jobs, "stream_gemini_response", lambda *args, **kwargs: iter(["No ", "fracture."]))
+    job = wait_for(jobs.submit_analysis("job_saver", "Bone Fracture Detection", "Doctor", "wrist.png",
+                                        png_bytes(), "image/png", use_cache=False))
+    assert job["status"] == "done"
+    assert job["result"] == "No fracture."
+    assert job["analysis_id"] is not None
+    assert saved_analyses("job_saver") == 1
+
+
+def test_cancel_during_streaming_wins_over_done(monkeypatch):
+    def stream(*args, **kwargs):
+        yield "Partial analysis"
+        # Cancelled from another process after the last chunk, before the job records its result
+        with connection() as conn, conn:
+            conn.execute("UPDATE analysis_jobs SET status='cancelled' WHERE username='job_canceller'")
+
+    monkeypatch.setattr(jobs, "stream_gemini_response", stream)
+    job = wait_for(jobs.submit_analysis("job_canceller", "Bone Fracture Detection", "Doctor", "wrist.png",
+                                        png_bytes((90, 90, 90)), "image/png", use_cache=False))
+    assert job["status"] == "cancelled"
+    assert job["analysis_id"] is None
+    assert saved_analyses("job_canceller") == 0
+    assert jobs.undelivered_jobs("job_canceller", "Bone Fracture Detection") == []
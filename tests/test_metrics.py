@@ -0,0 +1,13 @@
+from metrics import CallbackGauge, Histogram
+
+
+def test_quantiles_interpolate_within_buckets_and_are_exported():
+    histogram = Histogram("test_seconds", "Test latencies", buckets=(1, 2, 4))
+    for value in (0.5, 1.5, 1.5, 3):
+        histogram.observe(value, stage="analysis")
+
+    assert histogram.quantile(0.5, stage="analysis") == 1.5
+    assert histogram.quantile(0.5, stage="chat") is None
+
+    gauge = CallbackGauge("test_seconds_quantile", "Estimated latencies", lambda: histogram.quantiles((0.5,)))
+    assert 'test_seconds_quantile{stage="analysis",quantile="0.5"} 1.5' in gauge.expose()
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from bench import fake_gemini
+import model_files
+import session_memory
+from model_files import FileHandleCache, attachments_for
+
+
+@pytest.fixture
+def files(monkeypatch):
+    """A fresh fake file service and handle cache per test"""
+    service = fake_gemini.FakeFileService(latency=0)
+    fake_gemini.install(files=service)
+    monkeypatch.setattr(model_files, "file_handles", FileHandleCache())
+    return service
+
+
+def stored_image(data=b"\x89PNG fake image bytes"):
+    return [(session_memory.store_bytes(data), "image/png")]
+
+
+def test_one_upload_serves_every_turn(files):
+    parts = stored_image()
+    handles = [attachments_for(parts) for _ in range(5)]
+    assert files.uploads == 1
+    assert all(turn == handles[0] for turn in handles)
+    assert handles[0][0].name in files.files
+
+
+def test_handle_near_expiry_is_uploaded_again_and_old_file_deleted(files):
+    files.ttl = model_files.REFRESH_MARGIN / 2  # every handle is already inside the refresh margin
+    parts = stored_image()
+    first = attachments_for(parts)[0]
+    second = attachments_for(parts)[0]
+    assert files.uploads == 2
+    assert second.name != first.name
+    assert files.deletes == 1
+    assert first.name not in files.files
+
+
+def test_forget_after_rejected_handle_uploads_again(files):
+    parts = stored_image()
+    rejected = attachments_for(parts)[0]
+    files.delete_file(rejected.name)  # the service no longer knows the file
+    model_files.file_handles.forget(digest for digest, _ in parts)
+    fresh = attachments_for(parts)[0]
+    assert files.uploads == 2
+    assert fresh.name != rejected.name
+    assert fresh.name in files.files
+
+
+def test_swept_spill_bytes_fall_back_to_text_only(files):
+    parts = stored_image(b"bytes that the sweeper removes")
+    os.remove(os.path.join(session_memory.IMAGE_DIR, parts[0][0]))
+    assert attachments_for(parts) == []
+    assert files.uploads == 0
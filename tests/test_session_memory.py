@@ -0,0 +1,37 @@
+import gc
+import os
+
+import session_memory
+from session_memory import StoredImage, store_bytes
+
+
+def test_sweep_keeps_images_a_session_still_holds(monkeypatch):
+    monkeypatch.setattr(session_memory, "SPILL_FILE_TTL", -1)  # everything counts as old
+    held = StoredImage("held.png", "image/png", b"image a session still shows")
+    preview = held.preview_path(lambda data: b"preview")
+    orphan = store_bytes(b"image nobody holds any more")
+
+    session_memory.sweep()
+
+    assert held.getvalue() == b"image a session still shows"
+    assert os.path.exists(preview)
+    assert not os.path.exists(os.path.join(session_memory.IMAGE_DIR, orphan))
+
+
+def test_released_images_are_swept(monkeypatch):
+    monkeypatch.setattr(session_memory, "SPILL_FILE_TTL", -1)
+    image = StoredImage("gone.png", "image/png", b"image of a session that ended")
+    digest = image.digest
+    del image
+    gc.collect()
+
+    session_memory.sweep()
+
+    assert not os.path.exists(os.path.join(session_memory.IMAGE_DIR, digest))
+
+
+def test_handle_reports_when_its_file_is_gone():
+    image = StoredImage("scan.png", "image/png", b"image swept by another process")
+    assert image.available()
+    os.remove(os.path.join(session_memory.IMAGE_DIR, image.digest))
+    assert not image.available()
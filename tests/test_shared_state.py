@@ -0,0 +1,59 @@
+import time
+
+import pytest
+
+pytest.importorskip("redis")
+
+import db
+import shared_state
+from bench.fake_redis import FakeRedisServer
+from shared_state import RedisState
+
+
+@pytest.fixture
+def redis_state():
+    server = FakeRedisServer().start()
+    yield RedisState(url=server.url, prefix="test:")
+    server.shutdown()
+    server.server_close()
+
+
+def test_get_set_and_expiry(redis_state):
+    assert redis_state.get("missing") is None
+    redis_state.set("key", "value")
+    redis_state.set("short", "value", ttl=0.05)
+    assert redis_state.get("key") == "value"
+    time.sleep(0.1)
+    assert redis_state.get("short") is None
+
+
+def test_add_only_sets_absent_keys(redis_state):
+    assert redis_state.add("claim", "a", ttl=5)
+    assert not redis_state.add("claim", "b", ttl=5)
+    assert redis_state.get("claim") == "a"
+
+
+def test_incr_and_take(redis_state):
+    assert redis_state.incr("counter", 5, ttl=5) == 5
+    assert redis_state.incr("counter") == 6
+    assert redis_state.take("counter") == "6"
+    assert redis_state.take("counter") is None
+    redis_state.set("gone", "1")
+    redis_state.delete("gone")
+    assert redis_state.get("gone") is None
+
+
+def test_token_bucket_allows_burst_then_waits(redis_state):
+    waits = [redis_state.take_token("bucket", rate=5, burst=3) for _ in range(4)]
+    assert waits[:3] == [0.0, 0.0, 0.0]
+    assert 0 < waits[3] <= 0.2 + 0.01
+
+
+def test_login_tokens_work_once(redis_state, monkeypatch):
+    monkeypatch.setattr(shared_state, "state", redis_state)
+    db.register("redis_user", "pw", "Doctor")
+    token = shared_state.create_login_session("redis_user", "Doctor")
+    login = shared_state.resume_login_session(token)
+    assert login["username"] == "redis_user" and login["user_type"] == "Doctor"
+    assert shared_state.resume_login_session(token) is None
+    assert shared_state.resume_login_session(login["token"])["username"] == "redis_user"
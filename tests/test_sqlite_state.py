@@ -0,0 +1,22 @@
+import os
+
+from db import connection
+from shared_state import SQLiteState, state
+
+
+def test_state_lives_in_its_own_file():
+    assert state.path == os.environ["BONEHEALTH_STATE_DB"]
+    state.set("probe", "1")
+    with connection() as conn:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    assert "shared_state" not in tables  # the app database only carries accounts, jobs and history
+
+
+def test_take_and_token_bucket(tmp_path):
+    local = SQLiteState(str(tmp_path / "state.db"))
+    local.set("once", "value")
+    assert local.take("once") == "value"
+    assert local.take("once") is None
+    waits = [local.take_token("bucket", rate=1, burst=2) for _ in range(3)]
+    assert waits[:2] == [0.0, 0.0]
+    assert waits[2] > 0
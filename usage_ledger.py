@@ -0,0 +1,188 @@
+"""Per-user model usage accounting and daily token quotas.
+
+Every model call adds its token counts and latency to an in-memory aggregate keyed
+by (hour, username, task, user type, call). A background thread upserts the
+aggregates into the model_usage table in one transaction, so the request path
+never waits on a database write. Each flush also adds the users' tokens to a
+per-day counter in the shared state, so quotas hold across app processes; a
+check adds this process's not-yet-flushed tokens to that counter.
+"""
+import atexit
+import os
+import threading
+import time
+
+from db import connection
+from metrics import CallbackGauge, Counter, register
+from shared_state import state
+
+# Accounting and quotas (override through environment variables / .env)
+FLUSH_SECONDS = float(os.getenv("BONEHEALTH_USAGE_FLUSH_SECONDS", "5"))
+FLUSH_ROWS = int(os.getenv("BONEHEALTH_USAGE_FLUSH_ROWS", "200"))  # flush early once this many aggregates are pending
+DAILY_TOKEN_QUOTA = int(os.getenv("BONEHEALTH_DAILY_TOKEN_QUOTA", "0"))  # per user; 0 = unlimited
+BUCKET_SECONDS = 3600
+DAY_SECONDS = 86400
+
+ledger_events = register(Counter("bonehealth_usage_ledger_events_total",
+                                 "Usage ledger events (flush, flush_error, quota_sync_error, quota_rejected)"))
+
+
+class QuotaExceeded(Exception):
+    """Raised before a model call when the user has used up their daily token quota"""
+
+    def __init__(self, username, used, quota):
+        super().__init__(f"Daily model quota reached ({used:,} of {quota:,} tokens). It resets at 00:00 UTC.")
+        self.username, self.used, self.quota = username, used, quota
+
+
+def _tokens(usage):
+    fields = ("prompt_token_count", "candidates_token_count", "thoughts_token_count")
+    return [(getattr(usage, field, 0) or 0) for field in fields] if usage is not None else [0, 0, 0]
+
+
+class UsageLedger:
+    """Process-wide write-behind usage aggregates plus per-user daily totals"""
+
+    def __init__(self, daily_quota=DAILY_TOKEN_QUOTA):
+        self.daily_quota = daily_quota
+        self._pending = {}  # (bucket_start, username, task, user_type, call) -> [calls, prompt, output, thinking, seconds, max_seconds]
+        self._quotas = {}  # username -> (day, quota), read from the users table once a day
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._started = False
+
+    def _quota(self, username, day):
+        with self._lock:
+            cached = self._quotas.get(username)
+        if cached is not None and cached[0] == day:
+            return cached[1]
+        with connection() as conn:
+            override = conn.execute("SELECT daily_token_quota FROM users WHERE username=?", (username,)).fetchone()
+        quota = override[0] if override and override[0] is not None else self.daily_quota
+        with self._lock:
+            self._quotas[username] = (day, quota)
+        return quota
+
+    def _shared_used(self, username, day):
+        """Tokens the user has spent today in every process, as of their last flushes"""
+        key = f"quota:{username}:{day}"
+        raw = state.get(key)
+        if raw is None:
+            # First look today (or the state was reset): start from what the table already holds.
+            # Flushes seed before they write, so no flushed batch is counted twice.
+            with connection() as conn:
+                used = conn.execute(
+                    "SELECT COALESCE(SUM(prompt_tokens + output_tokens + thinking_tokens), 0) FROM model_usage "
+                    "WHERE username=? AND bucket_start>=?", (username, day * DAY_SECONDS),
+                ).fetchone()[0]
+            state.add(key, used, ttl=2 * DAY_SECONDS)
+            raw = state.get(key)  # another process may have seeded it first
+        return int(raw or 0)
+
+    def check_quota(self, username):
+        """Raises QuotaExceeded if username has no tokens left today"""
+        if not username:
+            return
+        day = int(time.time() // DAY_SECONDS)
+        quota = self._quota(username, day)
+        if not quota:
+            return
+        with self._lock:
+            unflushed = sum(row[1] + row[2] + row[3] for key, row in self._pending.items()
+                            if key[1] == username and key[0] >= day * DAY_SECONDS)
+        used = self._shared_used(username, day) + unflushed
+        if used >= quota:
+            ledger_events.inc(event="quota_rejected")
+            raise QuotaExceeded(username, used, quota)
+
+    def record(self, username, task, user_type, call, usage, seconds):
+        """Adds one model call's usage_metadata and latency; never touches the database"""
+        now = time.time()
+        prompt, output, thinking = _tokens(usage)
+        key = (int(now // BUCKET_SECONDS) * BUCKET_SECONDS, username or "", task or "", user_type or "", call)
+        with self._lock:
+            row = self._pending.setdefault(key, [0, 0, 0, 0, 0.0, 0.0])
+            row[0] += 1
+            row[1] += prompt
+            row[2] += output
+            row[3] += thinking
+            row[4] += seconds
+            row[5] = max(row[5], seconds)
+            backlog = len(self._pending)
+        self._start()
+        if backlog >= FLUSH_ROWS:
+            self._wake.set()
+
+    def flush(self):
+        """Writes pending aggregates in one transaction; they are kept for the next try if it fails"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+            spent = {}  # (username, day) -> tokens in this batch
+            for key, row in batch.items():
+                if key[1]:
+                    user_day = (key[1], key[0] // DAY_SECONDS)
+                    spent[user_day] = spent.get(user_day, 0) + row[1] + row[2] + row[3]
+            try:
+                for username, day in spent:
+                    self._shared_used(username, day)
+                with connection() as conn, conn:
+                    conn.executemany(
+                        "INSERT INTO model_usage (bucket_start, username, task, user_type, call, calls, prompt_tokens, "
+                        "output_tokens, thinking_tokens, latency_seconds, max_latency_seconds) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (bucket_start, username, task, user_type, call) DO UPDATE SET "
+                        "calls=calls+excluded.calls, prompt_tokens=prompt_tokens+excluded.prompt_tokens, "
+                        "output_tokens=output_tokens+excluded.output_tokens, "
+                        "thinking_tokens=thinking_tokens+excluded.thinking_tokens, "
+                        "latency_seconds=latency_seconds+excluded.latency_seconds, "
+                        "max_latency_seconds=MAX(max_latency_seconds, excluded.max_latency_seconds)",
+                        [(*key, *row) for key, row in batch.items()],
+                    )
+            except Exception:
+                ledger_events.inc(event="flush_error")
+                with self._lock:
+                    for key, row in batch.items():
+                        merged = self._pending.setdefault(key, [0, 0, 0, 0, 0.0, 0.0])
+                        for i in range(5):
+                            merged[i] += row[i]
+                        merged[5] = max(merged[5], row[5])
+                return 0
+            for (username, day), tokens in spent.items():
+                try:
+                    state.incr(f"quota:{username}:{day}", tokens, ttl=2 * DAY_SECONDS)
+                except Exception:
+                    ledger_events.inc(event="quota_sync_error")
+            ledger_events.inc(event="flush")
+            return len(batch)
+
+    def pending_rows(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _flush_forever(self):
+        while True:
+            self._wake.wait(FLUSH_SECONDS)
+            self._wake.clear()
+            self.flush()
+
+    def _start(self):
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._flush_forever, name="usage-flusher", daemon=True).start()
+        # Daemon threads die with the process; write out whatever is left
+        atexit.register(self.flush)
+
+
+# Process-wide instance; Streamlit reruns the script but keeps imported modules
+usage_ledger = UsageLedger()
+
+register(CallbackGauge("bonehealth_usage_pending_rows", "Usage aggregates waiting to be written",
+                       usage_ledger.pending_rows))